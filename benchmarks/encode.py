@@ -0,0 +1,97 @@
+"""
+Micro-benchmark for encoding payment requests to NVP pairs.
+
+Compares the table-driven encoder in ``txievery.expresscheckout.encode``
+with the previous, template-formatting encoder (reproduced below), and
+checks that both produce identical pairs.
+
+Payment request totals are computed once up front, so that only the
+encoding itself is measured.
+
+Run with ``PYTHONPATH=. python benchmarks/encode.py`` from the root of the
+repository.
+"""
+import itertools
+import timeit
+
+from txievery.expresscheckout import api, encode
+
+
+def _legacyEncodePaymentRequests(*requests):
+    encodedRequests = itertools.starmap(_legacyEncodeRequest,
+                                        enumerate(requests))
+    return itertools.chain.from_iterable(encodedRequests)
+
+
+def _legacyEncodeRequest(requestIndex, request):
+    requestTemplate = "PAYMENTREQUEST_{0}_{{0}}".format(requestIndex)
+    requestPairs = _legacyEncodeAttributes(request, requestTemplate,
+                                           encode.REQUEST_KEYS)
+
+    encodedItems = (_legacyEncodeItem(requestTemplate, itemIndex, item, qty)
+                    for itemIndex, (item, qty)
+                    in enumerate(request.itemDetails))
+    itemPairs = itertools.chain.from_iterable(encodedItems)
+
+    return itertools.chain(requestPairs, itemPairs)
+
+
+def _legacyEncodeItem(requestTemplate, index, item, quantity):
+    itemTemplate = "L_{0}{1}".format(requestTemplate, index)
+    quantityPairs = [(itemTemplate.format("QTY"), quantity)]
+    itemPairs = _legacyEncodeAttributes(item, itemTemplate, encode.ITEM_KEYS)
+    return itertools.chain(quantityPairs, itemPairs)
+
+
+def _legacyEncodeAttributes(obj, template, keysAndAttributes):
+    for key, attribute in keysAndAttributes:
+        value = getattr(obj, attribute, None)
+        if value is not None:
+            yield template.format(key), value
+
+
+
+class _Snapshot(object):
+    """
+    A payment request with its attributes computed in advance.
+    """
+    def __init__(self, request):
+        self.action = request.action
+        self.totalAmount = request.totalAmount
+        self.itemDetails = request.itemDetails
+
+
+
+def makeCart(numRequests, numItems):
+    """
+    Makes a cart with the given number of payment requests and items.
+    """
+    items = [(api.Item("Item {0}".format(i), "1.{0:02d}".format(i)), i + 1)
+             for i in xrange(numItems)]
+    return [_Snapshot(api.PaymentRequest(items)) for _ in xrange(numRequests)]
+
+
+def main():
+    print "{0:>8} {1:>6} {2:>12} {3:>12} {4:>8}".format(
+        "requests", "items", "legacy (us)", "tables (us)", "speedup")
+
+    for numRequests, numItems in [(1, 1), (1, 10), (10, 1), (10, 10)]:
+        cart = makeCart(numRequests, numItems)
+
+        legacy = list(_legacyEncodePaymentRequests(*cart))
+        assert encode.encodePaymentRequests(*cart) == legacy
+
+        results = []
+        for f in [_legacyEncodePaymentRequests, encode.encodePaymentRequests]:
+            timer = timeit.Timer(lambda: list(f(*cart)))
+            number = 500
+            best = min(timer.repeat(repeat=5, number=number)) / number
+            results.append(best * 1e6)
+
+        print "{0:>8} {1:>6} {2:>12.1f} {3:>12.1f} {4:>7.2f}x".format(
+            numRequests, numItems, results[0], results[1],
+            results[0] / results[1])
+
+
+if __name__ == "__main__":
+    main()
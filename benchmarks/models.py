@@ -0,0 +1,90 @@
+"""
+Memory and throughput comparison of the regular and the compact payment
+request and item classes.
+
+Memory is the shallow size of every object making up a cart (instances,
+their ``__dict__`` if any, item details containers, and the references
+from compact items to their payment requests); the amounts and names
+themselves are shared between both variants and not counted.
+
+Run with ``PYTHONPATH=. python benchmarks/models.py`` from the root of the
+repository.
+"""
+import sys
+import timeit
+import weakref
+
+from txievery.expresscheckout import api
+from txievery.expresscheckout.encode import encodePaymentRequests
+
+
+VARIANTS = [("regular", api.PaymentRequest, api.Item),
+            ("compact", api.CompactPaymentRequest, api.CompactItem)]
+
+
+def makeCart(paymentRequestClass, itemClass, numItems):
+    """
+    Makes a cart of a single payment request with some items.
+    """
+    itemDetails = [(itemClass("Item", "1.99"), 2) for _ in xrange(numItems)]
+    return paymentRequestClass(itemDetails)
+
+
+def _shallowSize(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def _itemSize(item):
+    """
+    Computes the size of an item, including the references to the payment
+    requests a compact item is in.
+    """
+    size = _shallowSize(item)
+    if isinstance(item, api.CompactItem):
+        size += sys.getsizeof(item._requests)
+    return size
+
+
+def cartSize(cart):
+    """
+    Computes the size of the objects making up a cart, in bytes.
+    """
+    size = _shallowSize(cart) + sys.getsizeof(cart.itemDetails)
+    if weakref.getweakrefcount(cart):
+        size += sys.getsizeof(weakref.ref(cart))
+    for detail in cart.itemDetails:
+        size += sys.getsizeof(detail) + _itemSize(detail[0])
+    return size
+
+
+def bestOf(f, number):
+    """
+    The best time for a call to ``f``, in microseconds.
+    """
+    return min(timeit.Timer(f).repeat(repeat=5, number=number)) / number * 1e6
+
+
+HEADER = "{0:>8} {1:>6} {2:>12} {3:>12} {4:>12} {5:>12}"
+ROW = "{0:>8} {1:>6} {2:>12} {3:>12.1f} {4:>12.1f} {5:>12.1f}"
+
+
+def main():
+    print HEADER.format("variant", "items", "bytes/cart", "create (us)",
+                        "total (us)", "encode (us)")
+
+    for numItems in [1, 10, 50]:
+        for name, paymentRequestClass, itemClass in VARIANTS:
+            cart = makeCart(paymentRequestClass, itemClass, numItems)
+            create = bestOf(lambda: makeCart(paymentRequestClass, itemClass,
+                                             numItems), 200)
+            total = bestOf(lambda: cart.totalAmount, 200)
+            encode = bestOf(lambda: encodePaymentRequests(cart), 200)
+            print ROW.format(name, numItems, cartSize(cart),
+                             create, total, encode)
+
+
+if __name__ == "__main__":
+    main()
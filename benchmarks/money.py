@@ -0,0 +1,84 @@
+"""
+Benchmark of ``Decimal`` amounts against integer-cents ``Money`` amounts
+over large carts.
+
+For every cart size, this builds a cart of compact items, computes its
+totals and urlencodes it, once with each kind of amount, and checks that
+both produce exactly the same encoded body.
+
+Run with ``PYTHONPATH=. python benchmarks/money.py`` from the root of the
+repository.
+"""
+import decimal
+import timeit
+import urllib
+
+from txievery.expresscheckout import api, money
+from txievery.expresscheckout.encode import encodePaymentRequests
+
+
+AMOUNT_TYPES = [("Decimal", decimal.Decimal),
+                ("Money", money.Money.fromAmount)]
+
+
+def makeAmounts(numItems):
+    return ["{0}.{1:02d}".format(i % 500, i % 100) for i in xrange(numItems)]
+
+
+def makeCart(makeAmount, amounts):
+    """
+    Makes a cart of a single payment request with one item per amount.
+    """
+    itemDetails = []
+    for i, amount in enumerate(amounts):
+        item = api.CompactItem("Item", makeAmount(amount))
+        item.taxAmount = makeAmount("0.07")
+        itemDetails.append((item, i % 5 + 1))
+    return api.CompactPaymentRequest(itemDetails)
+
+
+def totals(cart):
+    """
+    Computes the totals of a cart from scratch.
+    """
+    cart._totals = None
+    return cart.totalAmount
+
+
+def encodeCart(cart):
+    return urllib.urlencode(encodePaymentRequests(cart))
+
+
+def bestOf(f, number=20):
+    """
+    The best time for a call to ``f``, in milliseconds.
+    """
+    return min(timeit.Timer(f).repeat(repeat=5, number=number)) / number * 1e3
+
+
+HEADER = "{0:>8} {1:>8} {2:>12} {3:>12} {4:>12}"
+ROW = "{0:>8} {1:>8} {2:>12.3f} {3:>12.3f} {4:>12.3f}"
+
+
+def main():
+    print HEADER.format("amounts", "items", "create (ms)", "totals (ms)",
+                        "encode (ms)")
+
+    for numItems in [100, 1000, 10000]:
+        amounts = makeAmounts(numItems)
+        encoded = set()
+
+        for name, makeAmount in AMOUNT_TYPES:
+            cart = makeCart(makeAmount, amounts)
+            encoded.add(encodeCart(cart))
+
+            create = bestOf(lambda: makeCart(makeAmount, amounts), 2)
+            total = bestOf(lambda: totals(cart))
+            encode = bestOf(lambda: encodeCart(cart), 2)
+            print ROW.format(name, numItems, create, total, encode)
+
+        assert len(encoded) == 1, "Encoded carts differ"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+"""
+End-to-end benchmark suite.
+
+For carts of various sizes (payment requests x items per request), this
+measures:
+
+validate
+    Checking the cart with ``validate.findProblems``, as ``Client`` does
+    before creating a checkout.
+encode
+    Encoding the cart with ``encode.encodePaymentRequests``.
+decode
+    Decoding the encoded cart with ``decode._decodePaymentRequests``.
+callDetails
+    Building the mock sandbox's ``APICallDetails`` for the encoded cart.
+parseDetails
+    Parsing a ``GetExpressCheckoutDetails`` response for the cart with
+    ``nvp.NVPResponseParser``, and looking up three fields.
+lazyDetails
+    Looking up the same three fields in an ``nvp.LazyResponse``.
+parseQsl
+    Splitting the encoded cart into pairs with ``urlparse.parse_qsl``, as
+    the mock sandbox used to.
+tokenize
+    Splitting the encoded cart into pairs with ``nvp.NVPPairs``, as the
+    mock sandbox does.
+roundTrip
+    A complete checkout (``SetExpressCheckout``,
+    ``GetExpressCheckoutDetails`` and ``DoExpressCheckoutPayment``) made by
+    a ``Client`` against a ``mocksandbox.Endpoint`` over loopback HTTP.
+
+Results are written as JSON: for every benchmark, the number of iterations,
+the operations per second, and the median (``p50``) and 99th percentile
+(``p99``) latency of a single operation, in microseconds.
+
+Run from the root of the repository, so that ``txievery`` can be imported.
+Results can be compared against those of an earlier run::
+
+    PYTHONPATH=. python benchmarks/suite.py --output baseline.json
+    PYTHONPATH=. python benchmarks/suite.py --baseline baseline.json
+
+The comparison is printed to standard error. The exit status is 1 if any
+benchmark's throughput dropped by more than the tolerance.
+"""
+import argparse
+import json
+import math
+import platform
+import sys
+import timeit
+import urllib
+import urlparse
+
+from twisted.internet import defer, task
+from twisted.python import failure
+from twisted.web import client, server
+
+from txievery.expresscheckout import api, decode, nvp, validate
+from txievery.expresscheckout.encode import encodePaymentRequests
+from txievery.test import mocksandbox
+
+
+CART_SIZES = [(1, 1), (1, 10), (1, 50), (5, 10), (10, 1), (10, 10)]
+ROUND_TRIP_SIZES = [(1, 1), (1, 10), (10, 10)]
+DETAILS_FIELDS = ["ACK", "PAYERID", "PAYMENTREQUEST_0_AMT"]
+
+timer = timeit.default_timer
+
+
+def makeCart(numRequests, numItems):
+    """
+    Makes a cart with the given number of payment requests and items.
+    """
+    items = [(api.Item("Item {0}".format(i), "1.{0:02d}".format(i % 100)),
+              i + 1) for i in xrange(numItems)]
+    return [api.PaymentRequest(items) for _ in xrange(numRequests)]
+
+
+def wirePairs(cart):
+    """
+    Encodes a cart to pairs of strings, as they would be received.
+    """
+    return [(k, str(v)) for k, v in encodePaymentRequests(*cart)]
+
+
+def detailsBody(cart):
+    """
+    Makes the body of a ``GetExpressCheckoutDetails`` response for a cart.
+    """
+    pairs = [("ACK", "Success"), ("TOKEN", "EC-1"), ("PAYERID", "PAYER")]
+    return urllib.urlencode(pairs + wirePairs(cart))
+
+
+def parseDetails(body, done=failure.Failure(client.ResponseDone())):
+    parser = nvp.NVPResponseParser()
+    parser.dataReceived(body)
+    parser.connectionLost(done)
+    return [parser.pairs[field] for field in DETAILS_FIELDS]
+
+
+def lazyDetails(body):
+    response = nvp.LazyResponse(body)
+    return [response[field] for field in DETAILS_FIELDS]
+
+
+def percentile(sortedTimes, p):
+    """
+    Gets the ``p``th percentile of some sorted times (nearest rank).
+    """
+    rank = int(math.ceil(p / 100.0 * len(sortedTimes)))
+    return sortedTimes[max(rank - 1, 0)]
+
+
+def summarize(times, elapsed):
+    """
+    Summarizes the times of single operations, in seconds, which took
+    ``elapsed`` seconds in total.
+    """
+    times = sorted(times)
+    return {"iterations": len(times),
+            "opsPerSecond": len(times) / elapsed,
+            "p50": percentile(times, 50) * 1e6,
+            "p99": percentile(times, 99) * 1e6}
+
+
+def measure(f, iterations):
+    """
+    Measures a synchronous operation.
+    """
+    for _ in xrange(max(iterations // 10, 1)):
+        f()
+
+    times = []
+    start = timer()
+    for _ in xrange(iterations):
+        before = timer()
+        f()
+        times.append(timer() - before)
+    return summarize(times, timer() - start)
+
+
+@defer.inlineCallbacks
+def measureCheckouts(client, cart, iterations):
+    """
+    Measures complete checkouts of a cart, one at a time.
+    """
+    times = []
+    start = timer()
+    for _ in xrange(iterations):
+        before = timer()
+        checkout = yield client.createCheckout(*cart)
+        yield checkout.complete()
+        times.append(timer() - before)
+    defer.returnValue(summarize(times, timer() - start))
+
+
+def runLocal(results, iterations):
+    for numRequests, numItems in CART_SIZES:
+        size = "{0}x{1}".format(numRequests, numItems)
+        cart = makeCart(numRequests, numItems)
+        pairs = wirePairs(cart)
+        details = dict(pairs)
+
+        results["validate/" + size] = measure(
+            lambda: validate.findProblems(cart), iterations)
+        results["encode/" + size] = measure(
+            lambda: encodePaymentRequests(*cart), iterations)
+        results["decode/" + size] = measure(
+            lambda: decode._decodePaymentRequests(details), iterations)
+        results["callDetails/" + size] = measure(
+            lambda: mocksandbox.APICallDetails(pairs), iterations)
+
+        body = detailsBody(cart)
+        results["parseDetails/" + size] = measure(
+            lambda: parseDetails(body), iterations)
+        results["lazyDetails/" + size] = measure(
+            lambda: lazyDetails(body), iterations)
+
+        encoded = urllib.urlencode(pairs)
+        results["parseQsl/" + size] = measure(
+            lambda: urlparse.parse_qsl(encoded), iterations)
+        results["tokenize/" + size] = measure(
+            lambda: list(nvp.NVPPairs(encoded)), iterations)
+
+
+@defer.inlineCallbacks
+def runRoundTrips(reactor, results, iterations):
+    site = server.Site(mocksandbox.Endpoint())
+    port = reactor.listenTCP(0, site, interface="127.0.0.1")
+    apiURL = "http://127.0.0.1:{0}/".format(port.getHost().port)
+    credentials = api.Credentials("user", "password", None, apiURL)
+    pool = nvp.NVPConnectionPool(reactor)
+    client = api.Client(credentials, "http://return", "http://cancel", pool)
+
+    try:
+        for numRequests, numItems in ROUND_TRIP_SIZES:
+            cart = makeCart(numRequests, numItems)
+            yield measureCheckouts(client, cart, max(iterations // 10, 1))
+            name = "roundTrip/{0}x{1}".format(numRequests, numItems)
+            results[name] = yield measureCheckouts(client, cart, iterations)
+    finally:
+        yield pool.closeCachedConnections()
+        yield port.stopListening()
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares results against a baseline, and prints the comparison.
+
+    Returns ``True`` if no benchmark's throughput regressed by more than
+    ``tolerance`` (a fraction).
+    """
+    ok = True
+    row = "{0:<20} {1:>12} {2:>12} {3:>8}  {4}\n"
+    sys.stderr.write(row.format("benchmark", "baseline", "current",
+                                "change", ""))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]["opsPerSecond"]
+        new = results[name]["opsPerSecond"]
+        change = new / old - 1
+        regressed = change < -tolerance
+        ok = ok and not regressed
+        sys.stderr.write(row.format(name, "{0:.1f}".format(old),
+                                    "{0:.1f}".format(new),
+                                    "{0:+.1%}".format(change),
+                                    "REGRESSED" if regressed else ""))
+    return ok
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iterations", type=int, default=1000,
+                        help="iterations per local benchmark")
+    parser.add_argument("--round-trips", type=int, default=100,
+                        dest="roundTrips",
+                        help="checkouts per round trip benchmark")
+    parser.add_argument("--output", help="file to write results to "
+                        "(default: standard output)")
+    parser.add_argument("--baseline", help="results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="allowed throughput regression (default: 0.1)")
+    return parser.parse_args(argv)
+
+
+@defer.inlineCallbacks
+def main(reactor, *argv):
+    args = parseArgs(argv)
+
+    results = {}
+    runLocal(results, args.iterations)
+    yield runRoundTrips(reactor, results, args.roundTrips)
+
+    report = {"python": platform.python_version(), "benchmarks": results}
+    encoded = json.dumps(report, indent=2, sort_keys=True,
+                         separators=(",", ": "))
+    if args.output is None:
+        print encoded
+    else:
+        with open(args.output, "w") as f:
+            f.write(encoded + "\n")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["benchmarks"]
+        if not compare(results, baseline, args.tolerance):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
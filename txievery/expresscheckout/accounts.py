@@ -0,0 +1,167 @@
+"""
+Making NVP API calls with several Paypal API accounts.
+"""
+import itertools
+from collections import OrderedDict
+
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+from txievery.expresscheckout import limits, nvp
+
+
+class Account(object):
+    """
+    A Paypal API account, with its own connection pool and rate limit.
+    """
+    def __init__(self, credentials, pool=None, rate=None, burst=None):
+        """
+        Initializes an account.
+
+        :param credentials: The credentials of the account.
+        :type credentials: ``api.Credentials``
+        :param pool: The connection pool to use for API calls with this
+            account. If ``None``, every API call uses a fresh connection.
+        :param rate: The maximum number of API calls per second made with
+            this account, on average, or ``None``. See
+            ``limits.TokenBucket``.
+        :param burst: The maximum number of API calls made at once, if
+            there is a rate limit.
+        """
+        self.credentials = credentials
+        self.pool = pool
+        self.rate = rate
+        self.burst = burst
+
+
+    def makeAgent(self, prefixPairs=(), timeout=None, methodTimeouts=None,
+                  lazyMethods=(), clock=reactor, observer=None):
+        """
+        Makes an agent for API calls with this account.
+
+        The credentials are sent before the other ``prefixPairs``. See
+        ``nvp.NVPAgent`` for the other arguments.
+        """
+        credentials = self.credentials
+        pairs = [("USER", credentials.username), ("PWD", credentials.password)]
+        agent = nvp.NVPAgent(credentials, self.pool, pairs + list(prefixPairs),
+                             observer=observer, timeout=timeout,
+                             methodTimeouts=methodTimeouts,
+                             lazyMethods=lazyMethods)
+        if self.rate is not None:
+            bucket = limits.TokenBucket(self.rate, self.burst, clock)
+            agent = limits.RateLimitedAgent(agent, bucket, clock)
+        return agent
+
+
+
+def _findToken(pairs):
+    """
+    Finds the value of the ``TOKEN`` pair, consuming no more pairs than
+    necessary.
+
+    :return: The token (or ``None``), and all of the pairs.
+    """
+    pairs, seen = iter(pairs), []
+    for pair in pairs:
+        seen.append(pair)
+        if pair[0] == "TOKEN":
+            return pair[1], itertools.chain(seen, pairs)
+    return None, seen
+
+
+
+class BalancingAgent(object):
+    """
+    Spreads NVP API calls over several agents, each for a different
+    account.
+
+    New checkouts are created with the agent with the fewest calls in
+    flight. A checkout only exists for the account that created it, so
+    later calls for it (those with a ``TOKEN`` pair) are made with the same
+    agent. The agents for up to ``maxTokens`` of the most recently created
+    checkouts are remembered until those checkouts are completed; calls for
+    other tokens are spread like new checkouts.
+
+    This has the same ``makeRequest`` method as ``nvp.NVPAgent``, so it can
+    be used wherever an agent can.
+    """
+    def __init__(self, agents, maxTokens=100000):
+        self.agents = list(agents)
+        self.maxTokens = maxTokens
+        self.outstanding = [0] * len(self.agents)
+        self.calls = [0] * len(self.agents)
+        self._tokens = OrderedDict()
+        self._rotation = itertools.cycle(range(len(self.agents)))
+
+
+    @property
+    def statistics(self):
+        """
+        The balancing statistics, as a dictionary.
+
+        outstanding
+            The number of calls in flight per agent.
+        calls
+            The number of calls made per agent.
+        tokens
+            The number of tokens whose agent is remembered.
+        """
+        return {"outstanding": list(self.outstanding),
+                "calls": list(self.calls),
+                "tokens": len(self._tokens)}
+
+
+    def agentIndexFor(self, token):
+        """
+        Gets the index of the agent that created a checkout, or ``None``
+        if it isn't known.
+        """
+        return self._tokens.get(token)
+
+
+    def _leastOutstanding(self):
+        """
+        Gets the index of the agent with the fewest calls in flight,
+        rotating between agents that are tied.
+        """
+        start = next(self._rotation)
+        count = len(self.agents)
+        order = [(start + offset) % count for offset in xrange(count)]
+        return min(order, key=self.outstanding.__getitem__)
+
+
+    def makeRequest(self, pairs, method=None, deadline=None):
+        index = token = None
+        if method != "SetExpressCheckout":
+            token, pairs = _findToken(pairs)
+            index = self._tokens.get(token)
+        if index is None:
+            index = self._leastOutstanding()
+
+        self.outstanding[index] += 1
+        self.calls[index] += 1
+        d = defer.maybeDeferred(self.agents[index].makeRequest, pairs,
+                                method, deadline=deadline)
+        d.addBoth(self._callDone, index, method, token)
+        return d
+
+
+    def _callDone(self, result, index, method, token):
+        """
+        Remembers the agent of a newly created checkout, and forgets the
+        agent of a completed one.
+
+        A failed completion may be retried, so its agent is remembered.
+        """
+        self.outstanding[index] -= 1
+        if isinstance(result, failure.Failure):
+            return result
+
+        if method == "SetExpressCheckout" and "TOKEN" in result:
+            self._tokens[result["TOKEN"]] = index
+            while len(self._tokens) > self.maxTokens:
+                self._tokens.popitem(last=False)
+        elif method == "DoExpressCheckoutPayment":
+            self._tokens.pop(token, None)
+        return result
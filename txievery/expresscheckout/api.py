@@ -5,11 +5,16 @@ import decimal
 import itertools
 import operator
 import os
+import weakref
 
 from zope.interface import implements
 
-from txievery.expresscheckout import interface, nvp
-from txievery.expresscheckout.encode import encodePaymentRequests
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+from txievery.expresscheckout import accounts, cache, encode, interface
+from txievery.expresscheckout import limits, money, retry, scheduler
+from txievery.expresscheckout import validate
 
 
 SANDBOX_URL = "https://api.sandbox.paypal.com/nvp"
@@ -71,40 +76,191 @@ class Client(object):
     A client for dealing with Paypal's Express Checkout NVP API.
     """
     API_VERSION = "74.0"
-    MAX_PAYMENT_REQUESTS = 10
+    MAX_PAYMENT_REQUESTS = encode.MAX_PAYMENT_REQUESTS
+    LAZY_METHODS = frozenset(["GetExpressCheckoutDetails"])
     
-    def __init__(self, credentials, returnURL, cancelURL):
-        self.prefixes = [("RETURNURL", returnURL), ("CANCELURL", cancelURL)]
-        self.agent = nvp.NVPAgent(credentials)
+    def __init__(self, credentials, returnURL, cancelURL, pool=None,
+                 maxInFlight=None, detailsCache=None, retryPolicy=None,
+                 concurrencyLimit=None, circuitBreaker=None, timeout=None,
+                 methodTimeouts=None, observer=None):
+        """
+        Initializes a client.
+
+        :param credentials: The credentials to make API calls with, or a
+            sequence of ``accounts.Account`` to spread API calls over (see
+            ``accounts.BalancingAgent``).
+        :param pool: The connection pool to use for API calls. If ``None``,
+            every API call uses a fresh connection. Pass an
+            ``nvp.NVPConnectionPool`` to keep connections alive. With
+            several accounts, every account has its own pool instead.
+        :param maxInFlight: The maximum number of API calls in flight. If
+            not ``None``, further calls are queued by priority; see
+            ``scheduler.RequestScheduler``.
+        :param detailsCache: The cache for checkout details, if any.
+        :type detailsCache: ``cache.DetailsCache`` or ``None``
+        :param retryPolicy: How idempotent API calls are hedged and
+            retried. If ``None``, they aren't; see ``retry.RetryingAgent``.
+            Every attempt is scheduled separately, so hedges and retries
+            count towards ``maxInFlight`` and ``concurrencyLimit``.
+        :type retryPolicy: ``retry.RetryPolicy`` or ``None``
+        :param concurrencyLimit: An adaptive limit on the number of API
+            calls in flight, such as a ``limits.AIMDLimit``. If not
+            ``None``, this replaces ``maxInFlight``.
+        :param circuitBreaker: The circuit breaker every API call attempt
+            goes through, if any.
+        :type circuitBreaker: ``limits.CircuitBreaker`` or ``None``
+        :param timeout: The timeout for every API call, in seconds, or
+            ``None``.
+        :param methodTimeouts: Timeouts for API calls to particular
+            methods; see ``nvp.NVPAgent``.
+        :param observer: Called with an ``nvp.RequestTiming`` when every
+            API call attempt is done, such as ``nvp.logTiming``, or
+            ``None``.
+        """
+        prefixPairs = [("VERSION", self.API_VERSION),
+                       ("RETURNURL", returnURL),
+                       ("CANCELURL", cancelURL)]
+        if isinstance(credentials, (list, tuple)):
+            if pool is not None:
+                raise ValueError("Accounts have their own connection pools")
+            agents = [account.makeAgent(prefixPairs, timeout, methodTimeouts,
+                                        self.LAZY_METHODS, observer=observer)
+                      for account in credentials]
+            self.agent = accounts.BalancingAgent(agents)
+        else:
+            account = accounts.Account(credentials, pool)
+            self.agent = account.makeAgent(prefixPairs, timeout,
+                                           methodTimeouts, self.LAZY_METHODS,
+                                           observer=observer)
+        if circuitBreaker is not None:
+            self.agent = limits.BreakingAgent(self.agent, circuitBreaker)
+        if maxInFlight is not None or concurrencyLimit is not None:
+            self.agent = scheduler.RequestScheduler(self.agent, maxInFlight,
+                                                    limit=concurrencyLimit)
+        if retryPolicy is not None:
+            self.agent = retry.RetryingAgent(self.agent, retryPolicy)
+        self.detailsCache = detailsCache
+        self._detailsInFlight = cache.SingleFlight()
+        self._detailsFetches = {}
+        self.clock = reactor
+
+
+    def _makeRequest(self, method, extraPairs, deadline=None):
+        """
+        Makes an API call.
+
+        The agent adds the method, credentials, API version and URLs, which
+        it only encodes once.
+        """
+        return self.agent.makeRequest(extraPairs, method, deadline=deadline)
+
 
+    def deadlineFor(self, timeout):
+        """
+        Gets the deadline for something that must be done within a timeout
+        (in seconds) from now. Returns ``None`` if the timeout is ``None``.
 
-    def _makeRequest(self, method, extraPairs):
-        prefixPairs = [("METHOD", method),
-                       ("VERSION", self.API_VERSION),
-                       self.prefixes]
-        pairs = itertools.chain(prefixPairs, extraPairs)
-        return self.agent.makeRequest(pairs)
+        The deadline can be passed to the methods of this client that take
+        one, so that several API calls share a single time budget.
+        """
+        if timeout is None:
+            return None
+        return self.clock.seconds() + timeout
 
 
-    def createCheckout(self, *paymentRequests):
+    def createCheckout(self, *paymentRequests, **kwargs):
         """
         Creates a new checkout.
 
         Returns a deferred ``ICheckout``.
 
-        This maps to the ``SetExpressCheckout`` NVP API call.
-        """
-        if len(paymentRequests) > self.MAX_PAYMENT_REQUESTS:
-            msg = ("{0.__class__} supports up to {0.MAX_PAYMENT_REQUESTS}, "
-                   "requested {1}".format(self, len(paymentRequests)))
-            raise ValueError(msg)
+        This maps to the ``SetExpressCheckout`` NVP API call. The only
+        keyword argument is ``deadline``, the time by which the call must
+        be done (see ``deadlineFor``).
 
-        pairs = encodePaymentRequests(paymentRequests)
-        d = self._makeRequest("SetExpressCheckout", pairs)
+        The payment requests are checked before any call is made; if
+        there are problems with them, this raises
+        ``validate.InvalidCartError`` listing all of them.
+        """
+        deadline = kwargs.pop("deadline", None)
+        if kwargs:
+            raise TypeError("Unexpected keyword arguments: {0}"
+                            .format(", ".join(kwargs)))
+
+        validate.checkPaymentRequests(paymentRequests,
+                                      self.MAX_PAYMENT_REQUESTS)
+        pairs = encode.encodePaymentRequests(*paymentRequests)
+        d = self._makeRequest("SetExpressCheckout", pairs, deadline)
         d.addCallback(self._instantiateCheckout, paymentRequests)
         return d
 
 
+    def createCheckouts(self, carts, concurrency=10, timeout=None):
+        """
+        Creates many checkouts.
+
+        Each cart is a sequence of payment requests, as would be passed to
+        ``createCheckout``. At most ``concurrency`` checkouts are created at
+        the same time; when using a connection pool, this should usually
+        not exceed the number of persistent connections it keeps.
+
+        Returns a list of deferreds, one per cart and in the same order,
+        each of which fires with that cart's ``ICheckout`` as soon as it has
+        been created. A cart that can't be checked out only fails its own
+        deferred; the other checkouts are still created.
+
+        Because a deferred is returned for every cart, ``carts`` must be
+        finite; it is read up front. Only ``concurrency`` calls are ever
+        started or waiting at once: the next cart's checkout is only
+        created when an earlier one is done.
+
+        If ``timeout`` is not ``None``, all checkouts must be created within
+        that many seconds; checkouts that aren't fail with
+        ``nvp.NVPTimeoutError``.
+
+        Cancelling one of the deferreds cancels the creation of that
+        checkout, or skips it if it hasn't started yet. The other
+        checkouts are still created.
+        """
+        carts = list(carts)
+        creating = {}
+
+        def cancel(result):
+            d = creating.get(result)
+            if d is not None:
+                d.cancel()
+
+        def created(outcome, result):
+            creating.pop(result, None)
+            if result.called:
+                return
+            if isinstance(outcome, failure.Failure):
+                result.errback(outcome)
+            else:
+                result.callback(outcome)
+
+        results = [defer.Deferred(cancel) for _ in carts]
+        pending = itertools.izip(carts, results)
+        deadline = self.deadlineFor(timeout)
+
+        def createNext(_=None):
+            for cart, result in pending:
+                if result.called:
+                    continue
+                d = defer.maybeDeferred(self.createCheckout, *cart,
+                                        deadline=deadline)
+                if not d.called:
+                    creating[result] = d
+                d.addBoth(created, result)
+                if not d.called:
+                    d.addCallback(createNext)
+                    return
+
+        for _ in xrange(concurrency):
+            createNext()
+        return results
+
+
     def _instantiateCheckout(self, response, paymentRequests):
         """
         Instantiates a checkout object from a ``SetExpressCheckout`` response.
@@ -112,18 +268,88 @@ class Client(object):
         return Checkout(self, response["TOKEN"], paymentRequests)
 
 
-    def getCheckoutDetails(self, token):
+    def getCheckoutDetails(self, token, deadline=None):
         """
         Gets the details of a particular checkout.
 
         This maps to the ``GetExpressCheckoutDetails`` NVP API call.
         
         This should almost always be called by an ``ICheckout``.
+
+        The details are an ``nvp.LazyResponse``, which only decodes the
+        fields that are looked up.
+
+        If this client has a details cache, details are taken from it when
+        possible, and added to it otherwise. Concurrent calls for the same
+        token share a single API call (made with the first caller's
+        deadline), but every caller gets its own deferred.
         """
-        d = self._makeRequest("GetExpressCheckoutDetails", token)
+        if self.detailsCache is not None:
+            details = self.detailsCache.get(token)
+            if details is not None:
+                return defer.succeed(details)
+
+        return self._detailsInFlight.call(token, self._fetchDetails, token,
+                                          deadline)
+
+
+    def _fetchDetails(self, token, deadline):
+        d = self._makeRequest("GetExpressCheckoutDetails", [("TOKEN", token)],
+                              deadline)
+        if self.detailsCache is not None:
+            fetch = self._detailsFetches[token] = object()
+            d.addBoth(self._fetchDone, token, fetch)
         return d
 
 
+    def _fetchDone(self, result, token, fetch):
+        """
+        Caches fetched details, unless the details for their token were
+        invalidated while they were being fetched.
+        """
+        if self._detailsFetches.get(token) is fetch:
+            del self._detailsFetches[token]
+            if not isinstance(result, failure.Failure):
+                self.detailsCache.set(token, result)
+        return result
+
+
+    def completeCheckout(self, token, payerID, paymentRequests,
+                         deadline=None):
+        """
+        Completes a checkout.
+
+        This maps to the ``DoExpressCheckoutPayment`` NVP API call.
+
+        This should almost always be called by an ``ICheckout``.
+
+        If this client has a details cache, the details for this checkout
+        are removed from it.
+        """
+        tokenPairs = [("TOKEN", token), ("PAYERID", payerID)]
+        requestPairs = encode.encodePaymentRequests(*paymentRequests)
+        pairs = tokenPairs + requestPairs
+
+        self._invalidateDetails(None, token)
+        d = self._makeRequest("DoExpressCheckoutPayment", pairs, deadline)
+        d.addBoth(self._invalidateDetails, token)
+        return d
+
+
+    def _invalidateDetails(self, result, token):
+        """
+        Removes the details for a token from the details cache, if any.
+
+        The details are removed both before and after completing, and
+        details that are being fetched for the token won't be cached, so
+        that details fetched before or while completing aren't kept.
+        """
+        if self.detailsCache is not None:
+            self.detailsCache.invalidate(token)
+            self._detailsFetches.pop(token, None)
+        return result
+
+
 
 ZERO = decimal.Decimal("0")
 
@@ -139,6 +365,7 @@ def _combinedAmount(attr):
 
 
 
+@validate.computesTotalAmount
 class PaymentRequest(object):
     handlingAmount = shippingAmount = taxAmount = ZERO
     
@@ -173,8 +400,12 @@ class PaymentRequest(object):
 def _twoDecimalPlaces(amount):
     """
     Quantizes to two decimal places.
+
+    ``Money`` amounts are always in whole cents, so they are left alone.
     """
-    return decimal.Decimal(amount).quantize(decimal.Decimal("0.01"))
+    if isinstance(amount, money.Money):
+        return amount
+    return money.quantize(amount)
 
 
 
@@ -206,6 +437,171 @@ class Item(object):
 
 
 
+def _itemAmountsChanged(item):
+    """
+    Invalidates the cached totals of the compact payment requests that a
+    compact item is in, because its amounts have changed.
+
+    Only the payment requests that contain the item are affected, and
+    reading their totals doesn't have to look at their items again.
+    """
+    for ref in item._requests:
+        paymentRequest = ref()
+        if paymentRequest is not None:
+            paymentRequest._invalidate()
+
+
+def _trackItems(paymentRequest, itemDetails, add):
+    """
+    Adds a compact payment request to, or removes it from, the payment
+    requests that the compact items in some item details are in.
+
+    Items that aren't compact aren't tracked; changing their amounts
+    doesn't invalidate any totals. Compact items keep a tuple of weak
+    references to their payment requests, so they don't keep them alive;
+    references to payment requests that are gone are dropped here.
+    """
+    ref = weakref.ref(paymentRequest)
+    for item, qty in itemDetails:
+        if isinstance(item, CompactItem):
+            requests = tuple(r for r in item._requests
+                             if r() not in (None, paymentRequest))
+            if add:
+                requests += (ref,)
+            item._requests = requests
+
+
+def _slotAmount(slot, quantize=False, onChange=None):
+    """
+    Makes a property for an amount stored in a slot.
+
+    :param quantize: If true, amounts are quantized to two decimal places.
+    :param onChange: Called with the instance when the amount changes.
+    """
+    getAmount = operator.attrgetter(slot)
+
+    def setAmount(self, amount):
+        if quantize:
+            amount = _twoDecimalPlaces(amount)
+        setattr(self, slot, amount)
+        if onChange is not None:
+            onChange(self)
+
+    return property(getAmount, setAmount)
+
+
+
+class CompactItem(object):
+    """
+    An item in a payment request, without a ``__dict__``.
+
+    This behaves like ``Item``, but takes up less memory. Changing its
+    amounts invalidates the cached totals of the compact payment requests
+    it is in.
+    """
+    implements(interface.IItem)
+    __slots__ = ("name", "_amount", "_handlingAmount", "_shippingAmount",
+                 "_taxAmount", "_category", "_requests")
+
+    def __init__(self, name, amount):
+        self.name = name
+        self._amount = _twoDecimalPlaces(amount)
+        self._handlingAmount = self._shippingAmount = self._taxAmount = ZERO
+        self._category = interface.PHYSICAL
+        self._requests = ()
+
+
+    amount = _slotAmount("_amount", True, _itemAmountsChanged)
+    handlingAmount = _slotAmount("_handlingAmount", False, _itemAmountsChanged)
+    shippingAmount = _slotAmount("_shippingAmount", False, _itemAmountsChanged)
+    taxAmount = _slotAmount("_taxAmount", False, _itemAmountsChanged)
+
+    category = Item.category
+
+
+
+@validate.computesTotalAmount
+class CompactPaymentRequest(object):
+    """
+    A payment request without a ``__dict__``, which caches its totals.
+
+    This behaves like ``PaymentRequest``, but takes up less memory, and
+    computes all of its totals in a single pass over its items the first
+    time one of them is needed. The totals are recomputed when the item
+    details or any of the amounts change.
+
+    The item details are stored as a tuple, so they can't be changed in
+    place; assign new item details instead.
+    """
+    __slots__ = ("_itemDetails", "currency", "action", "_handlingAmount",
+                 "_shippingAmount", "_taxAmount", "_totals", "__weakref__")
+
+    def __init__(self, itemDetails, currency="USD", action=interface.SALE):
+        self._handlingAmount = self._shippingAmount = self._taxAmount = ZERO
+        self._itemDetails = ()
+        self.itemDetails = itemDetails
+        self.currency = currency
+        self.action = action
+
+
+    def _invalidate(self):
+        self._totals = None
+
+
+    @property
+    def itemDetails(self):
+        return self._itemDetails
+
+
+    @itemDetails.setter
+    def itemDetails(self, itemDetails):
+        _trackItems(self, self._itemDetails, False)
+        self._itemDetails = tuple(itemDetails)
+        _trackItems(self, self._itemDetails, True)
+        self._invalidate()
+
+
+    @property
+    def items(self):
+        return (item for item, qty in self._itemDetails)
+
+
+    handlingAmount = _slotAmount("_handlingAmount", onChange=_invalidate)
+    shippingAmount = _slotAmount("_shippingAmount", onChange=_invalidate)
+    taxAmount = _slotAmount("_taxAmount", onChange=_invalidate)
+
+
+    def _getTotals(self):
+        """
+        Gets the (item, handling, shipping, tax, total) amounts, computing
+        them if necessary.
+        """
+        if self._totals is None:
+            itemAmount = handling = shipping = tax = ZERO
+            for item, qty in self._itemDetails:
+                itemAmount += qty * item.amount
+                handling += item.handlingAmount
+                shipping += item.shippingAmount
+                tax += item.taxAmount
+
+            handling += self._handlingAmount
+            shipping += self._shippingAmount
+            tax += self._taxAmount
+            total = itemAmount + tax + handling + shipping
+
+            self._totals = itemAmount, handling, shipping, tax, total
+
+        return self._totals
+
+
+    itemAmount = property(lambda self: self._getTotals()[0])
+    totalHandlingAmount = property(lambda self: self._getTotals()[1])
+    totalShippingAmount = property(lambda self: self._getTotals()[2])
+    totalTaxAmount = property(lambda self: self._getTotals()[3])
+    totalAmount = property(lambda self: self._getTotals()[4])
+
+
+
 class Checkout(object):
     """
     A checkout.
@@ -218,12 +614,19 @@ class Checkout(object):
         self.paymentRequests = paymentRequests
 
 
-    def getDetails(self):
-        return self.client.getCheckoutDetails(self.token)
+    def getDetails(self, deadline=None):
+        return self.client.getCheckoutDetails(self.token, deadline)
 
 
-    def complete(self, paymentRequests=interface.UNCHANGED):
+    def complete(self, paymentRequests=interface.UNCHANGED, timeout=None):
         if paymentRequests is interface.UNCHANGED:
             paymentRequests = self.paymentRequests
 
-        # TODO: ACTUALLY COMPLETE THIS CHECKOUT
+        deadline = self.client.deadlineFor(timeout)
+        d = self.getDetails(deadline)
+        @d.addCallback
+        def completeCheckout(details):
+            payerID = details["PAYERID"]
+            return self.client.completeCheckout(self.token, payerID,
+                                                paymentRequests, deadline)
+        return d
@@ -0,0 +1,138 @@
+"""
+Caching of Express Checkout API responses.
+"""
+from collections import OrderedDict
+
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+
+class DetailsCache(object):
+    """
+    A cache of checkout details, keyed by checkout token.
+
+    Entries expire ``ttl`` seconds after they were added. When there are
+    more than ``maxSize`` entries, the least recently used ones are evicted.
+
+    The number of lookups that were (not) answered from the cache is
+    available as ``hits`` (``misses``).
+    """
+    hits = misses = 0
+
+    def __init__(self, maxSize=1000, ttl=60, clock=reactor):
+        """
+        Initializes a details cache.
+
+        :param maxSize: The maximum number of entries.
+        :type maxSize: ``int``
+        :param ttl: The number of seconds an entry stays valid.
+        :param clock: The clock used to expire entries.
+        :type clock: ``IReactorTime``
+        """
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def get(self, token):
+        """
+        Gets the details for a token.
+
+        :return: The cached details, or ``None`` if there aren't any.
+        """
+        entry = self._entries.pop(token, None)
+        if entry is None or entry[0] <= self.clock.seconds():
+            self.misses += 1
+            return None
+
+        self._entries[token] = entry
+        self.hits += 1
+        return entry[1]
+
+
+    def set(self, token, details):
+        """
+        Caches the details for a token.
+        """
+        self._entries.pop(token, None)
+        self._entries[token] = self.clock.seconds() + self.ttl, details
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+
+
+    def invalidate(self, token):
+        """
+        Removes the details for a token from the cache, if there are any.
+        """
+        self._entries.pop(token, None)
+
+
+    @property
+    def statistics(self):
+        """
+        The cache statistics, as a dictionary.
+        """
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries)}
+
+
+
+def _copyFailure(reason):
+    """
+    Copies a failure, so that handling (or cleaning) one copy doesn't
+    affect the others, and each is logged if it isn't handled.
+    """
+    return failure.Failure(reason.value, reason.type,
+                           reason.getTracebackObject())
+
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent identical calls onto a single call in flight.
+
+    This is only appropriate for idempotent calls.
+    """
+    def __init__(self):
+        self._waiting = {}
+
+
+    def __len__(self):
+        return len(self._waiting)
+
+
+    def call(self, key, f, *args, **kwargs):
+        """
+        Calls ``f``, unless a call with the same key is already in flight.
+
+        Returns a new deferred for every caller, which fires with the result
+        of the call in flight. Cancelling that deferred does not cancel the
+        call in flight, since other callers might be waiting for it too.
+        """
+        d = defer.Deferred()
+
+        waiting = self._waiting.get(key)
+        if waiting is not None:
+            waiting.append(d)
+            return d
+
+        self._waiting[key] = [d]
+        callDeferred = defer.maybeDeferred(f, *args, **kwargs)
+        callDeferred.addBoth(self._callDone, key)
+        return d
+
+
+    def _callDone(self, result, key):
+        for d in self._waiting.pop(key):
+            if d.called:
+                continue
+            elif isinstance(result, failure.Failure):
+                d.errback(_copyFailure(result))
+            else:
+                d.callback(result)
@@ -1,79 +1,106 @@
 """
 Support for decoding NVP API to Express Checkout API objects.
 """
-from functools import partial
+import collections
+import re
 
 from txievery.expresscheckout import api
 
 
-baseTemplate = "PAYMENTREQUEST_{requestIndex}_{key}".format
-baseListTemplate = "L_PAYMENTREQUEST_{requestIndex}_{key}{itemIndex}".format
+_requestKey = re.compile(r"PAYMENTREQUEST_(\d+)_(\w+)$")
+_itemKey = re.compile(r"L_PAYMENTREQUEST_(\d+)_([A-Z]+)(\d+)$")
 
 
-def _decodePaymentRequests(details):
-    requests = []
-    firstEmpty = 0
-    idxs = iter(xrange(10))
+def _pairs(details):
+    """
+    Iterates over the (name, value) pairs in some details.
 
-    for idx in idxs:
-        template = partial(baseTemplate, requestIndex=idx)
-        if template(key="AMT") not in details:
-            firstEmpty = idx
-            break
+    The details are either a mapping (such as a dictionary or an
+    ``nvp.LazyResponse``), or an iterable of pairs (such as
+    ``APICallDetails`` in the mock sandbox).
+    """
+    if isinstance(details, collections.Mapping):
+        return details.iteritems()
+    return iter(details)
 
-        itemDetails = _decodeItemDetails(details, idx)
-        request = api.PaymentRequest(itemDetails)
-        requests.append(request)
 
-    verifyTemplate = lambda i: baseTemplate(key="AMT", requestIndex=i)
-    _verifyLastElement(firstEmpty, verifyTemplate, idxs, details)
+def _bucketFields(details):
+    """
+    Sorts the fields in some details by payment request and item, in a
+    single pass over the details.
 
-    return requests
+    Returns a dictionary mapping payment request indices to pairs of that
+    request's fields and a dictionary mapping item indices to that item's
+    fields. Fields are dictionaries of field names (such as ``AMT``) to
+    values.
+    """
+    buckets = {}
+    for key, value in _pairs(details):
+        if key.startswith("PAYMENTREQUEST_"):
+            match = _requestKey.match(key)
+            if match is None:
+                continue
+            requestIndex, field = match.groups()
+            requestFields, _ = _getBucket(buckets, int(requestIndex))
+            requestFields[field] = value
+        elif key.startswith("L_PAYMENTREQUEST_"):
+            match = _itemKey.match(key)
+            if match is None:
+                continue
+            requestIndex, field, itemIndex = match.groups()
+            _, itemBuckets = _getBucket(buckets, int(requestIndex))
+            itemBuckets.setdefault(int(itemIndex), {})[field] = value
+
+    return buckets
+
+
+def _getBucket(buckets, requestIndex):
+    bucket = buckets.get(requestIndex)
+    if bucket is None:
+        bucket = buckets[requestIndex] = {}, {}
+    return bucket
 
 
-def _decodeItemDetails(details, requestIndex):
-    """
-    Gets the item details from payment request details.
+def _decodePaymentRequests(details):
+    buckets = _bucketFields(details)
+    presentIndices = set(i for i, (fields, _) in buckets.iteritems()
+                         if "AMT" in fields)
+    count = _verifyContiguous(presentIndices)
 
-    Since the payment request details may contain multiple payment requests,
-    you must specify the index of the payment request you want to get the
-    items from.
-    """
-    itemDetails = []
-    itemTemplate = partial(baseListTemplate, requestIndex=requestIndex)
-    firstEmpty = 0
-    idxs = iter(xrange(10))
-    
-    for idx in idxs:
-        keyTemplate = partial(itemTemplate, itemIndex=idx)
-        if keyTemplate(key="AMT") not in details:
-            firstEmpty = idx
-            break
+    requests = []
+    for requestIndex in xrange(count):
+        _, itemBuckets = buckets[requestIndex]
+        itemDetails = _decodeItemDetails(itemBuckets)
+        requests.append(api.PaymentRequest(itemDetails))
 
-        item, qty = _decodeItem(details, keyTemplate)
-        itemDetails.append((item, qty))
+    return requests
 
-    verifyTemplate = lambda i: itemTemplate(key="AMT", itemIndex=i)
-    _verifyLastElement(firstEmpty, verifyTemplate, idxs, details)
 
-    return itemDetails
+def _decodeItemDetails(itemBuckets):
+    """
+    Gets the item details from the bucketed fields of a payment request.
+
+    :param itemBuckets: A dictionary mapping item indices to item fields,
+        as found in the result of ``_bucketFields``.
+    """
+    presentIndices = set(i for i, fields in itemBuckets.iteritems()
+                         if "AMT" in fields)
+    count = _verifyContiguous(presentIndices)
+    return [_decodeItem(itemBuckets[idx]) for idx in xrange(count)]
 
 
 ITEM_KEYS = [("ITEMCATEGORY", "category")]
 
 
-def _decodeItem(details, template):
+def _decodeItem(fields):
     """
-    Gets a single item from payment request details.
+    Gets a single item from its fields.
     """
-    def get(key):
-        return details.get(template(key=key))
-
-    quantity, name, amount = [get(k) for k in ("QTY", "NAME", "AMT")]
+    quantity, name, amount = [fields.get(k) for k in ("QTY", "NAME", "AMT")]
     item = api.Item(name, amount)
 
     for key, attr in ITEM_KEYS:
-        value = details.get(key)
+        value = fields.get(key)
         if value is None:
             continue
         setattr(item, attr, value)
@@ -81,8 +108,17 @@ def _decodeItem(details, template):
     return item, int(quantity)
 
 
-def _verifyLastElement(firstEmptyIndex, template, remainingIndices, details):
-    for remaining in remainingIndices:
-        if template(remaining) in details:
-            raise ValueError("Element at index {0} after empty index {1}"
-                             .format(remaining, firstEmptyIndex))
\ No newline at end of file
+def _verifyContiguous(presentIndices):
+    """
+    Verifies that the present indices are 0, 1, ... without any gaps.
+
+    Returns the number of present indices.
+    """
+    count = len(presentIndices)
+    firstEmptyIndex = next(i for i in xrange(count + 1)
+                           if i not in presentIndices)
+    if firstEmptyIndex != count:
+        remaining = min(i for i in presentIndices if i > firstEmptyIndex)
+        raise ValueError("Element at index {0} after empty index {1}"
+                         .format(remaining, firstEmptyIndex))
+    return count
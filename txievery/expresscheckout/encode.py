@@ -1,8 +1,8 @@
 """
 Support for encoding (serializing) Express Checkout API objects to NVP.
 """
-import itertools
-
+MAX_PAYMENT_REQUESTS = 10
+PRECOMPUTED_ITEMS = 10
 
 REQUEST_KEYS = [("PAYMENTACTION", "action"),
                 ("AMT", "totalAmount")]
@@ -11,48 +11,87 @@ ITEM_KEYS = [("AMT", "amount"),
              ("NAME", "name")]
 
 
+def _requestKeys(requestIndex):
+    """
+    Computes the (name, attribute) pairs for a payment request.
+    """
+    template = "PAYMENTREQUEST_{0}_{1}"
+    return [(template.format(requestIndex, key), attr)
+            for key, attr in REQUEST_KEYS]
+
+
+def _itemKeys(requestIndex, itemIndex):
+    """
+    Computes the quantity name and the (name, attribute) pairs for an item.
+    """
+    template = "L_PAYMENTREQUEST_{0}_{1}{2}"
+    quantityKey = template.format(requestIndex, "QTY", itemIndex)
+    return quantityKey, [(template.format(requestIndex, key, itemIndex), attr)
+                         for key, attr in ITEM_KEYS]
+
+
+_requestKeyTable = [_requestKeys(r) for r in xrange(MAX_PAYMENT_REQUESTS)]
+_itemKeyTable = [[_itemKeys(r, i) for i in xrange(PRECOMPUTED_ITEMS)]
+                 for r in xrange(MAX_PAYMENT_REQUESTS)]
+
+
+def _getItemKeys(requestIndex, itemIndex):
+    """
+    Gets the item keys for an item, extending the key table if necessary.
+    """
+    itemKeys = _itemKeyTable[requestIndex]
+    while len(itemKeys) <= itemIndex:
+        itemKeys.append(_itemKeys(requestIndex, len(itemKeys)))
+    return itemKeys[itemIndex]
+
+
 def encodeCheckout(checkout):
     return encodePaymentRequests(*checkout.paymentRequests)
 
 
 def encodePaymentRequests(*requests):
     """
-    Encodes a bunch of payment requests as pairs.
-    """
-    encodedRequests = itertools.starmap(_encodeRequest, enumerate(requests))
-    return itertools.chain.from_iterable(encodedRequests)
+    Encodes a bunch of payment requests as a list of pairs.
 
+    All names are looked up in precomputed tables, so this supports up to
+    ``MAX_PAYMENT_REQUESTS`` payment requests.
 
-def _encodeRequest(requestIndex, request):
-    """
-    Encodes a payment request as (name, value) pairs.
+    :raises ValueError: If there are more payment requests than that.
     """
-    requestTemplate = "PAYMENTREQUEST_{0}_{{0}}".format(requestIndex)
-    requestPairs = _encodeAttributes(request, requestTemplate, REQUEST_KEYS)
+    if len(requests) > MAX_PAYMENT_REQUESTS:
+        raise ValueError("At most {0} payment requests are supported, got {1}"
+                         .format(MAX_PAYMENT_REQUESTS, len(requests)))
+    pairs = []
+    for requestIndex, request in enumerate(requests):
+        _encodeRequest(pairs, requestIndex, request)
+    return pairs
 
-    encodedItems = (_encodeItem(requestTemplate, itemIndex, item, quantity)
-                    for itemIndex, (item, quantity)
-                    in enumerate(request.itemDetails))
-    itemPairs = itertools.chain.from_iterable(encodedItems)
 
-    return itertools.chain(requestPairs, itemPairs)
+def _encodeRequest(pairs, requestIndex, request):
+    """
+    Encodes a payment request as (name, value) pairs, appended to ``pairs``.
+    """
+    _encodeAttributes(pairs, request, _requestKeyTable[requestIndex])
+    for itemIndex, (item, quantity) in enumerate(request.itemDetails):
+        _encodeItem(pairs, requestIndex, itemIndex, item, quantity)
 
 
-def _encodeItem(requestTemplate, index, item, quantity):
+def _encodeItem(pairs, requestIndex, itemIndex, item, quantity):
     """
-    Encodes a single item inside a payment request as (name, value) pairs.
+    Encodes a single item inside a payment request as (name, value) pairs,
+    appended to ``pairs``.
     """
-    itemTemplate = "L_{0}{1}".format(requestTemplate, index)
-    quantityPairs = [(itemTemplate.format("QTY"), quantity)]
-    itemPairs = _encodeAttributes(item, itemTemplate, ITEM_KEYS)
-    return itertools.chain(quantityPairs, itemPairs)
+    quantityKey, itemKeys = _getItemKeys(requestIndex, itemIndex)
+    pairs.append((quantityKey, quantity))
+    _encodeAttributes(pairs, item, itemKeys)
 
 
-def _encodeAttributes(obj, template, keysAndAttributes):
+def _encodeAttributes(pairs, obj, keysAndAttributes):
     """
-    Encodes the attributes of an object as key, value pairs.
+    Encodes the attributes of an object as key, value pairs, appended to
+    ``pairs``.
     """
     for key, attribute in keysAndAttributes:
         value = getattr(obj, attribute, None)
         if value is not None:
-            yield template.format(key), value
\ No newline at end of file
+            pairs.append((key, value))
@@ -13,15 +13,20 @@ class ICheckout(Interface):
         """)
 
 
-    def getDetails():
+    def getDetails(deadline=None):
         """
         Gets the details for this checkout.
+
+        The deadline is the time by which this must be done, if any.
         """
 
 
-    def complete(paymentRequests=UNCHANGED):
+    def complete(paymentRequests=UNCHANGED, timeout=None):
         """
         Completes the checkout.
+
+        If the timeout is not ``None``, getting the details and completing
+        must be done within that many seconds together.
         """
 
 
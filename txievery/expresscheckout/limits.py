@@ -0,0 +1,348 @@
+"""
+Protecting NVP API endpoints (and ourselves) when they degrade.
+"""
+import collections
+
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+from txievery.expresscheckout import scheduler
+
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "halfOpen"
+
+
+
+class CircuitOpenError(Exception):
+    """
+    An API call was not made, because the circuit breaker is open.
+    """
+
+
+
+class _Observable(object):
+    """
+    Something that tells observers about changes.
+    """
+    def __init__(self):
+        self._observers = []
+
+
+    def addObserver(self, observer):
+        """
+        Adds an observer, which is called with the previous and the new
+        value on every change.
+        """
+        self._observers.append(observer)
+
+
+    def removeObserver(self, observer):
+        self._observers.remove(observer)
+
+
+    def _notify(self, previous, current):
+        for observer in list(self._observers):
+            observer(previous, current)
+
+
+
+class AIMDLimit(_Observable):
+    """
+    A concurrency limit that adapts to the latency of API calls, using
+    additive increase and multiplicative decrease.
+
+    The limit grows by one for every call that succeeds within
+    ``latencyThreshold`` seconds while at least half of the allowed calls
+    are in flight. It shrinks by ``decreaseFactor`` when a call fails or is
+    slower than that, at most once per round trip: calls that started
+    before the last decrease were made under the old limit, so they don't
+    shrink it again. It always stays between ``minimum`` and ``maximum``.
+
+    Observers are told about every change of the limit.
+    """
+    def __init__(self, initial=10, minimum=1, maximum=200,
+                 latencyThreshold=2.0, decreaseFactor=0.9):
+        _Observable.__init__(self)
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latencyThreshold = latencyThreshold
+        self.decreaseFactor = decreaseFactor
+        self._decreasedAt = None
+
+
+    def update(self, latency, succeeded, inFlight, startedAt=None):
+        """
+        Updates the limit after an API call is done.
+
+        :param latency: How long the call took, in seconds.
+        :param succeeded: If the call succeeded.
+        :param inFlight: The number of calls that were in flight along
+            with this one, including this one.
+        :param startedAt: When the call started, in seconds. If ``None``,
+            a failed or slow call always shrinks the limit.
+        :return: The new limit.
+        """
+        previous = self.limit
+        if not succeeded or latency > self.latencyThreshold:
+            if self._startedBeforeDecrease(startedAt):
+                return self.limit
+            limit = int(previous * self.decreaseFactor)
+            if startedAt is not None:
+                self._decreasedAt = startedAt + latency
+        elif inFlight * 2 >= previous:
+            limit = previous + 1
+        else:
+            limit = previous
+
+        self.limit = max(self.minimum, min(self.maximum, limit))
+        if self.limit != previous:
+            self._notify(previous, self.limit)
+        return self.limit
+
+
+    def _startedBeforeDecrease(self, startedAt):
+        if startedAt is None or self._decreasedAt is None:
+            return False
+        return startedAt < self._decreasedAt
+
+
+
+class CircuitBreaker(_Observable):
+    """
+    Fails API calls fast while an endpoint keeps failing.
+
+    The breaker starts out closed, letting calls through. After
+    ``failureThreshold`` calls in a row fail, it opens: calls fail
+    immediately with ``CircuitOpenError``, without being made. The first
+    call at least ``resetTimeout`` seconds later half-opens it, and is
+    made as a probe; other calls keep failing until the probe is done. If
+    the probe succeeds, the breaker closes again; otherwise, it opens
+    again.
+
+    Cancelled calls don't count as failures. Observers are told about
+    every state change (``CLOSED``, ``OPEN`` and ``HALF_OPEN``).
+    """
+    state = CLOSED
+
+    def __init__(self, failureThreshold=5, resetTimeout=30.0, clock=reactor):
+        _Observable.__init__(self)
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.clock = clock
+
+        self.failures = 0
+        self.rejected = 0
+        self._openedAt = None
+        self._probing = False
+
+
+    def call(self, f, *args, **kwargs):
+        """
+        Calls ``f``, unless the breaker is open.
+
+        Returns a deferred that fires with the result of the call, or
+        fails with ``CircuitOpenError``.
+        """
+        if not self._allowCall():
+            self.rejected += 1
+            return defer.fail(CircuitOpenError(self.state))
+
+        probe = self.state == HALF_OPEN
+        self._probing = probe
+        d = defer.maybeDeferred(f, *args, **kwargs)
+        d.addBoth(self._callDone, probe)
+        return d
+
+
+    def _allowCall(self):
+        if self.state == OPEN:
+            if self.clock.seconds() - self._openedAt < self.resetTimeout:
+                return False
+            self._setState(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            return not self._probing
+        return True
+
+
+    def _callDone(self, result, probe):
+        if probe:
+            self._probing = False
+
+        if isinstance(result, failure.Failure):
+            if not result.check(defer.CancelledError):
+                self._failed(probe)
+        else:
+            self.failures = 0
+            if probe:
+                self._setState(CLOSED)
+
+        return result
+
+
+    def _failed(self, probe):
+        self.failures += 1
+        if self.state == OPEN:
+            return
+        if probe or self.failures >= self.failureThreshold:
+            self._openedAt = self.clock.seconds()
+            self._setState(OPEN)
+
+
+    def _setState(self, state):
+        previous, self.state = self.state, state
+        self._notify(previous, state)
+
+
+    @property
+    def statistics(self):
+        """
+        The circuit breaker statistics, as a dictionary.
+        """
+        return {"state": self.state,
+                "failures": self.failures,
+                "rejected": self.rejected}
+
+
+
+class BreakingAgent(object):
+    """
+    Makes NVP API calls through a circuit breaker.
+
+    This has the same ``makeRequest`` method as ``nvp.NVPAgent``, so it can
+    be used wherever an agent can.
+    """
+    def __init__(self, agent, breaker):
+        self.agent = agent
+        self.breaker = breaker
+
+
+    def makeRequest(self, pairs, method=None, deadline=None):
+        return self.breaker.call(self.agent.makeRequest, pairs, method,
+                                 deadline=deadline)
+
+
+
+class TokenBucket(object):
+    """
+    A token bucket, allowing ``rate`` calls per second on average, in
+    bursts of up to ``burst`` calls.
+    """
+    def __init__(self, rate, burst=None, clock=reactor):
+        """
+        Initializes a token bucket, which starts out full.
+
+        :param burst: The size of the bucket. If ``None``, this is one
+            second's worth of calls (but at least one).
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self.clock = clock
+        self.tokens = self.burst
+        self._updatedAt = clock.seconds()
+
+
+    def _refill(self):
+        now = self.clock.seconds()
+        elapsed, self._updatedAt = now - self._updatedAt, now
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+
+
+    def take(self):
+        """
+        Takes a token, if there is one.
+
+        :return: ``True`` if a token was taken, ``False`` otherwise.
+        """
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+    def delay(self):
+        """
+        Gets the number of seconds until a token will be available.
+        """
+        self._refill()
+        return max(1 - self.tokens, 0) / float(self.rate)
+
+
+
+class RateLimitedAgent(object):
+    """
+    Makes NVP API calls no faster than a token bucket allows.
+
+    Calls that can't be made right away are queued, and made in the order
+    they were made in as soon as the bucket allows. If a call is still
+    queued at its deadline, it fails with ``nvp.NVPTimeoutError``.
+
+    This has the same ``makeRequest`` method as ``nvp.NVPAgent``, so it can
+    be used wherever an agent can.
+    """
+    def __init__(self, agent, bucket, clock=reactor):
+        self.agent = agent
+        self.bucket = bucket
+        self.clock = clock
+        self.queueDepth = 0
+        self._queue = collections.deque()
+        self._timer = None
+
+
+    def makeRequest(self, pairs, method=None, deadline=None):
+        now = self.clock.seconds()
+        call = scheduler.QueuedCall(pairs, method, now, deadline,
+                                    self._callCancelled)
+        if deadline is not None:
+            call.expiry = self.clock.callLater(max(deadline - now, 0),
+                                               call.expire)
+
+        self._queue.append(call)
+        self.queueDepth += 1
+        if self._timer is None:
+            self._dispatch()
+        return call.deferred
+
+
+    def _callCancelled(self, call):
+        """
+        Forgets a queued call that was cancelled or expired, dropping
+        cancelled calls from the queue once they make up more than half of
+        it. Once the queue is empty, the next dispatch is no longer needed.
+        """
+        self.queueDepth -= 1
+        if len(self._queue) > 2 * self.queueDepth:
+            self._queue = collections.deque(
+                queued for queued in self._queue if not queued.cancelled)
+        if not self._queue and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+    def _dispatch(self):
+        """
+        Makes queued API calls while there are tokens, and schedules the
+        next dispatch if calls remain.
+        """
+        self._timer = None
+        while self._queue:
+            call = self._queue[0]
+            if not call.cancelled and not self.bucket.take():
+                break
+            self._queue.popleft()
+            if not call.cancelled:
+                self.queueDepth -= 1
+                self._makeCall(call)
+
+        if self._queue:
+            self._timer = self.clock.callLater(self.bucket.delay(),
+                                               self._dispatch)
+
+
+    def _makeCall(self, call):
+        call.stopExpiry()
+        call.inFlight = d = defer.maybeDeferred(self.agent.makeRequest,
+                                                call.pairs, call.method,
+                                                deadline=call.deadline)
+        d.chainDeferred(call.deferred)
@@ -0,0 +1,120 @@
+"""
+Amounts of money, stored as an integer number of cents.
+"""
+import decimal
+import re
+
+
+CENT = decimal.Decimal("0.01")
+_plainAmount = re.compile(r"(-?)(\d+)(?:\.(\d\d?))?$")
+
+
+def quantize(amount):
+    """
+    Quantizes an amount to two decimal places.
+
+    The amount can be anything ``Decimal`` accepts.
+    """
+    return decimal.Decimal(amount).quantize(CENT)
+
+
+
+class Money(object):
+    """
+    An amount of money in some currency, as an integer number of cents.
+
+    This can be used instead of ``Decimal`` amounts for items. Adding
+    amounts and multiplying them by quantities only does integer
+    arithmetic; amounts are only formatted as decimal strings when they
+    are encoded.
+
+    Adding an amount in a different currency is an error. Adding zero
+    (``0`` or a zero ``Decimal``), as happens when summing amounts or when
+    there are no handling, shipping or tax amounts, results in the same
+    amount. Money compares equal to numbers with the same value.
+    """
+    __slots__ = ("cents", "currency")
+
+    def __init__(self, cents, currency="USD"):
+        self.cents = cents
+        self.currency = currency
+
+
+    @classmethod
+    def fromAmount(cls, amount, currency="USD"):
+        """
+        Creates money from an amount such as ``"1.99"``.
+
+        The amount is rounded exactly like item amounts are. Integers and
+        strings with at most two decimal places don't need rounding, so they
+        are converted without going through ``Decimal``.
+        """
+        if isinstance(amount, (int, long)):
+            return cls(amount * 100, currency)
+
+        match = isinstance(amount, str) and _plainAmount.match(amount)
+        if match:
+            sign, units, cents = match.groups()
+            cents = int(units) * 100 + int((cents or "0").ljust(2, "0"))
+            return cls(-cents if sign else cents, currency)
+
+        return cls(int(quantize(amount).scaleb(2)), currency)
+
+
+    def toDecimal(self):
+        """
+        Converts to a ``Decimal`` with two decimal places.
+        """
+        return decimal.Decimal(self.cents).scaleb(-2)
+
+
+    def __add__(self, other):
+        if isinstance(other, Money):
+            if other.currency != self.currency:
+                raise ValueError("Can't add {0} to {1}"
+                                 .format(other.currency, self.currency))
+            return Money(self.cents + other.cents, self.currency)
+        elif isinstance(other, (int, long, decimal.Decimal)) and not other:
+            return self
+        return NotImplemented
+
+
+    __radd__ = __add__
+
+
+    def __mul__(self, quantity):
+        if isinstance(quantity, (int, long)):
+            return Money(self.cents * quantity, self.currency)
+        return NotImplemented
+
+
+    __rmul__ = __mul__
+
+
+    def __eq__(self, other):
+        if isinstance(other, Money):
+            return (self.cents, self.currency) == (other.cents, other.currency)
+        elif isinstance(other, (int, long, decimal.Decimal)):
+            return self.toDecimal() == other
+        return NotImplemented
+
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+
+    def __hash__(self):
+        return hash(self.toDecimal())
+
+
+    def __str__(self):
+        units, cents = divmod(abs(self.cents), 100)
+        sign = "-" if self.cents < 0 else ""
+        return "{0}{1}.{2:02d}".format(sign, units, cents)
+
+
+    def __repr__(self):
+        return "Money({0!r}, {1!r})".format(self.cents, self.currency)
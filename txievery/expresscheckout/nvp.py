@@ -1,18 +1,35 @@
 """
 Support for PayPal's NVP API.
 """
+import collections
+import itertools
 import urllib
-import urlparse
 from OpenSSL import SSL
 
-from twisted.internet import reactor, ssl
-from twisted.web import client, http_headers
+from zope.interface import implements
+
+from twisted.internet import defer, endpoints, protocol, reactor, ssl, task
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+from twisted.internet.interfaces import IStreamClientEndpoint
+from twisted.python import failure, log
+from twisted.web import client, http, http_headers, iweb
 
 
 class PaypalContextFactory(ssl.ClientContextFactory):
     """
     An SSL context factory for talking to PayPal.
+
+    The context (and therefore the key file) is only loaded once. TLS
+    sessions are remembered per host and port, so that reconnecting to
+    the same PayPal endpoint can use an abbreviated handshake.
+
+    The number of handshakes is available as ``fullHandshakes`` and
+    ``resumedHandshakes``.
     """
+    implements(iweb.IPolicyForHTTPS)
+    method = SSL.SSLv23_METHOD
+    fullHandshakes = resumedHandshakes = 0
+
     def __init__(self, keyFile):
         """
         Initializes a PayPal context factory.
@@ -25,53 +42,935 @@ class PaypalContextFactory(ssl.ClientContextFactory):
 
         """
         self.keyFile = keyFile
+        self._context = None
+        self._sessions = {}
 
 
     def getContext(self):
-        self.method = SSL.SSLv23_METHOD
-        ctx = ssl.ClientContextFactory.getContext(self)
-        ctx.use_certificate_file(self.keyFile)
-        ctx.use_privatekey_file(self.keyFile)
-        return ctx
+        if self._context is None:
+            ctx = ssl.ClientContextFactory.getContext(self)
+            ctx.use_certificate_file(self.keyFile)
+            ctx.use_privatekey_file(self.keyFile)
+            ctx.set_session_cache_mode(SSL.SESS_CACHE_CLIENT)
+            ctx.set_info_callback(self._infoCallback)
+            self._context = ctx
+        return self._context
+
+
+    def creatorForNetloc(self, hostname, port):
+        return _ResumingConnectionCreator(self, (hostname, port))
+
+
+    def _infoCallback(self, connection, where, ret):
+        if where & (SSL.SSL_CB_HANDSHAKE_DONE | SSL.SSL_CB_EXIT):
+            tracker = connection.get_app_data()
+            if not isinstance(tracker, _SessionTracker):
+                return
+            if where & SSL.SSL_CB_HANDSHAKE_DONE:
+                tracker.handshakeDone(connection)
+            elif tracker.handshakeCounted:
+                tracker.rememberSession(connection)
+
+
+
+class _ResumingConnectionCreator(object):
+    """
+    Creates TLS connections to a single host and port, offering the last
+    session negotiated with that host and port for resumption.
+    """
+    implements(IOpenSSLClientConnectionCreator)
+
+    def __init__(self, contextFactory, netloc):
+        self.contextFactory = contextFactory
+        self.netloc = netloc
+
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        contextFactory = self.contextFactory
+        connection = SSL.Connection(contextFactory.getContext(), None)
+
+        offeredKey = None
+        lastSession = contextFactory._sessions.get(self.netloc)
+        if lastSession is not None:
+            session, offeredKey = lastSession
+            connection.set_session(session)
+
+        tracker = _SessionTracker(contextFactory, self.netloc, offeredKey)
+        connection.set_app_data(tracker)
+        return connection
+
+
+
+def _sessionReused(connection, offeredKey):
+    """
+    Checks if the (completed) handshake on a connection resumed the session
+    offered for it.
+
+    pyOpenSSL has no public way of asking OpenSSL this, so the master key
+    of the connection is compared with that of the offered session: a
+    resumed session keeps its master key, a new one gets a fresh one.
+
+    :param offeredKey: The master key of the offered session, or ``None``
+        if no session was offered.
+    """
+    return offeredKey is not None and _masterKey(connection) == offeredKey
+
+
+
+def _masterKey(connection):
+    """
+    Gets the master key of the session of a connection, or ``None`` if it
+    doesn't have one yet (as with TLS 1.3, until a ticket has arrived).
+    """
+    try:
+        return connection.master_key()
+    except SSL.Error:
+        return None
+
+
+
+class _SessionTracker(object):
+    """
+    Keeps track of the handshake on a single connection.
+
+    If set, ``onHandshake`` is called with whether or not the session was
+    resumed when the first handshake is done.
+    """
+    handshakeCounted = False
+    onHandshake = None
+
+    def __init__(self, contextFactory, netloc, offeredKey=None):
+        self.contextFactory = contextFactory
+        self.netloc = netloc
+        self.offeredKey = offeredKey
+
+
+    def rememberSession(self, connection):
+        """
+        Remembers the session of this connection, and its master key, as
+        the last ones for its host and port.
+
+        With TLS 1.3 the session ticket arrives after the handshake is
+        done, so this is also done whenever OpenSSL has processed more
+        messages after the handshake.
+        """
+        session = connection.get_session()
+        if session is not None:
+            self.contextFactory._sessions[self.netloc] = (
+                session, _masterKey(connection))
+
+
+    def handshakeDone(self, connection):
+        """
+        Remembers the session of this connection, and counts the handshake.
+        Renegotiations are not counted as handshakes.
+        """
+        contextFactory = self.contextFactory
+        self.rememberSession(connection)
+
+        if self.handshakeCounted:
+            return
+        self.handshakeCounted = True
+
+        resumed = _sessionReused(connection, self.offeredKey)
+        if resumed:
+            contextFactory.resumedHandshakes += 1
+        else:
+            contextFactory.fullHandshakes += 1
+
+        if self.onHandshake is not None:
+            self.onHandshake(resumed)
+
+
+
+class NVPConnectionPool(client.HTTPConnectionPool):
+    """
+    A pool of persistent (keep-alive) connections to NVP API endpoints.
+
+    This behaves exactly like a regular ``HTTPConnectionPool``, but keeps
+    some statistics so that it can be sized appropriately:
+
+    hits
+        The number of times a cached connection was reused.
+    misses
+        The number of times a new connection had to be made.
+    evictions
+        The number of cached connections that were closed, either because
+        there were already ``maxPersistentPerHost`` cached connections for
+        that endpoint or because they were idle for longer than
+        ``cachedConnectionTimeout`` seconds.
+    """
+    hits = misses = evictions = 0
+
+    def __init__(self, reactor, maxPersistentPerHost=None,
+                 cachedConnectionTimeout=None):
+        client.HTTPConnectionPool.__init__(self, reactor, persistent=True)
+
+        if maxPersistentPerHost is not None:
+            self.maxPersistentPerHost = maxPersistentPerHost
+        if cachedConnectionTimeout is not None:
+            self.cachedConnectionTimeout = cachedConnectionTimeout
+
+
+    def getConnection(self, key, endpoint):
+        connections = self._connections.get(key, [])
+        if any(c.state == "QUIESCENT" for c in connections):
+            self.hits += 1
+        else:
+            self.misses += 1
+        return client.HTTPConnectionPool.getConnection(self, key, endpoint)
+
+
+    def _putConnection(self, key, connection):
+        connections = self._connections.get(key, [])
+        if (connection.state == "QUIESCENT"
+            and len(connections) == self.maxPersistentPerHost):
+            self.evictions += 1
+        client.HTTPConnectionPool._putConnection(self, key, connection)
+
+
+    def _removeConnection(self, key, connection):
+        self.evictions += 1
+        client.HTTPConnectionPool._removeConnection(self, key, connection)
+
+
+    @property
+    def statistics(self):
+        """
+        The pool statistics, as a dictionary.
+        """
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
+
+
+
+class RequestTiming(object):
+    """
+    The timing of a single NVP API call, as passed to ``NVPAgent``
+    observers.
+
+    Timestamps are in seconds, as given by the agent's clock. They are
+    ``None`` for steps that didn't happen:
+
+    started
+        When the call was made.
+    connected
+        When a new connection was made.
+    handshakeDone
+        When the TLS handshake on a new connection was done.
+    responseStarted
+        When the response headers were received.
+    responseDone
+        When the response body was received and parsed completely.
+    finished
+        When the call was done, successfully or not.
+
+    ``parseTime`` is the time spent parsing the response body as it was
+    received. ``bytesOut`` and ``bytesIn`` are the sizes of the request
+    and response bodies. ``reused`` tells if a cached connection was used,
+    and ``resumedSession`` if the TLS handshake on a new connection resumed
+    a previous session.
+    """
+    connected = handshakeDone = resumedSession = None
+    responseStarted = responseDone = finished = None
+    parseTime = 0.0
+    bytesOut = bytesIn = 0
+    reused = True
+    succeeded = False
+
+    def __init__(self, method, started):
+        self.method = method
+        self.started = started
+
+
+    @property
+    def phases(self):
+        """
+        The time spent in each phase of the call, as a dictionary.
+
+        connect
+            Making a new connection.
+        handshake
+            The TLS handshake on a new connection.
+        wait
+            Sending the request and waiting for the response headers.
+        transfer
+            Receiving the response body, except for parsing it.
+        parse
+            Parsing the response body.
+
+        Phases that didn't happen, such as making a new connection when a
+        cached one was reused, are left out.
+        """
+        phases = {}
+        last = self.started
+        if self.connected is not None:
+            phases["connect"] = self.connected - last
+            last = self.connected
+        if self.handshakeDone is not None:
+            phases["handshake"] = self.handshakeDone - last
+            last = self.handshakeDone
+        if self.responseStarted is not None:
+            phases["wait"] = self.responseStarted - last
+        if self.responseDone is not None:
+            transfer = self.responseDone - self.responseStarted
+            phases["transfer"] = transfer - self.parseTime
+            phases["parse"] = self.parseTime
+        return phases
+
+
+
+PHASES = ["connect", "handshake", "wait", "transfer", "parse"]
+
+
+def logTiming(timing):
+    """
+    An ``NVPAgent`` observer that logs the timing of every API call.
+    """
+    phases = timing.phases
+    phaseTimes = ", ".join("{0} {1:.1f}ms".format(name, phases[name] * 1e3)
+                           for name in PHASES if name in phases)
+    log.msg(format="NVP API call %(method)s %(outcome)s in %(total).1fms "
+                   "(%(phaseTimes)s), %(bytesOut)d bytes out, "
+                   "%(bytesIn)d bytes in, %(connection)s connection",
+            method=timing.method,
+            outcome="succeeded" if timing.succeeded else "failed",
+            total=(timing.finished - timing.started) * 1e3,
+            phaseTimes=phaseTimes, bytesOut=timing.bytesOut,
+            bytesIn=timing.bytesIn,
+            connection="reused" if timing.reused else "new",
+            timing=timing)
+
+
+
+class _NVPEndpointFactory(object):
+    """
+    Makes endpoints for NVP API calls, like ``Agent`` does by default.
+
+    While the agent is making a timed API call, new connections are
+    recorded in its timing.
+    """
+    implements(iweb.IAgentEndpointFactory)
+
+    def __init__(self, agent, policyForHTTPS):
+        self.agent = agent
+        self.policyForHTTPS = policyForHTTPS
+
+
+    def endpointForURI(self, uri):
+        endpoint = endpoints.HostnameEndpoint(reactor, uri.host, uri.port)
+        if uri.scheme == "https":
+            creator = self.policyForHTTPS.creatorForNetloc(uri.host, uri.port)
+            endpoint = endpoints.wrapClientTLS(creator, endpoint)
+        elif uri.scheme != "http":
+            raise client.SchemeNotSupported(uri.scheme)
+
+        timing = self.agent._pendingTiming
+        if timing is not None:
+            endpoint = _TimedEndpoint(endpoint, timing, self.agent.clock)
+        return endpoint
+
+
+
+class _TimedEndpoint(object):
+    """
+    An endpoint that records the connection it makes in a timing.
+    """
+    implements(IStreamClientEndpoint)
+
+    def __init__(self, endpoint, timing, clock):
+        self.endpoint = endpoint
+        self.timing = timing
+        self.clock = clock
+
+
+    def connect(self, protocolFactory):
+        self.timing.reused = False
+        d = self.endpoint.connect(protocolFactory)
+        d.addCallback(self._connected)
+        return d
+
+
+    def _connected(self, proto):
+        self.timing.connected = self.clock.seconds()
+
+        handle = proto.transport.getHandle()
+        if isinstance(handle, SSL.Connection):
+            tracker = handle.get_app_data()
+            if isinstance(tracker, _SessionTracker):
+                tracker.onHandshake = self._handshakeDone
+
+        return proto
+
+
+    def _handshakeDone(self, resumed):
+        self.timing.handshakeDone = self.clock.seconds()
+        self.timing.resumedSession = resumed
+
+
+
+class NVPTimeoutError(Exception):
+    """
+    An NVP API call took too long, and was cancelled.
+    """
+    def __init__(self, method, timeout):
+        Exception.__init__(self, method, timeout)
+        self.method = method
+        self.timeout = timeout
+
+
+    def __str__(self):
+        return "{0} call timed out after {1:.3f}s".format(self.method,
+                                                          self.timeout)
 
 
 
 class NVPAgent(object):
     """
     An agent for talking to an NVP API endpoint.
+
+    If ``observer`` is not ``None``, it is called with a ``RequestTiming``
+    when every API call is done.
+
+    API calls that take longer than their timeout, or that are still in
+    flight at their deadline, are cancelled: the request is aborted, so
+    its connection is closed instead of going back into the pool. They
+    then fail with ``NVPTimeoutError``.
     """
-    def __init__(self, credentials):
+    def __init__(self, credentials, pool=None, prefixPairs=(),
+                 observer=None, timeout=None, methodTimeouts=None,
+                 lazyMethods=()):
+        """
+        Initializes an NVP agent.
+
+        :param credentials: The credentials used to talk to the endpoint.
+        :param pool: The connection pool to use. If ``None``, a new
+            connection is made for each request.
+        :type pool: ``NVPConnectionPool`` or ``None``
+        :param prefixPairs: (name, value) pairs sent with every API call.
+            These are only encoded once.
+        :param observer: The observer for API call timings, such as
+            ``logTiming``, or ``None``.
+        :param timeout: The timeout for API calls, in seconds, or ``None``.
+        :param methodTimeouts: Timeouts for calls to particular methods,
+            as a dictionary mapping method names to timeouts in seconds.
+            These override ``timeout``.
+        :param lazyMethods: The names of the methods whose responses are
+            decoded lazily, as a ``LazyResponse``. Other responses are
+            decoded to dictionaries as they are received.
+        """
         self.credentials = credentials
+        self.pool = pool
+        self.prefix = urllib.urlencode(prefixPairs)
+        self._methodPrefixes = {None: self.prefix}
+        self.observer = observer
+        self.timeout = timeout
+        self.methodTimeouts = methodTimeouts or {}
+        self.lazyMethods = frozenset(lazyMethods)
+        self.clock = reactor
+        self._pendingTiming = None
         ctxFactory = PaypalContextFactory(credentials.keyFile)
-        self._agent = client.Agent(reactor, ctxFactory)
+        endpointFactory = _NVPEndpointFactory(self, ctxFactory)
+        self._agent = client.Agent.usingEndpointFactory(reactor,
+                                                        endpointFactory,
+                                                        pool=pool)
+
+
+    def _getPrefix(self, method):
+        """
+        Gets the encoded prefix for API calls to a method.
+
+        This is the ``METHOD`` pair followed by the prefix pairs. Since there
+        are only a handful of methods, these are all kept.
+        """
+        prefix = self._methodPrefixes.get(method)
+        if prefix is None:
+            methodPair = urllib.urlencode([("METHOD", method)])
+            prefix = _joinEncoded(methodPair, self.prefix)
+            self._methodPrefixes[method] = prefix
+        return prefix
+
+
+    def _getTimeout(self, method, deadline):
+        """
+        Gets the timeout for an API call, taking its deadline into
+        account. Returns ``None`` if the call has no timeout.
+        """
+        timeout = self.methodTimeouts.get(method, self.timeout)
+        if deadline is not None:
+            remaining = deadline - self.clock.seconds()
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        return timeout
+
+
+    def makeRequest(self, pairs, method=None, deadline=None):
+        """
+        Makes an NVP API call.
+
+        :param pairs: The (name, value) pairs to send, besides the prefix
+            pairs.
+        :param method: The name of the NVP API method being called. If not
+            ``None``, this is sent as the ``METHOD`` pair. It is also used
+            for bookkeeping, by anything that wraps this agent.
+        :param deadline: The time (according to this agent's clock) by
+            which the call must be done, or ``None``.
+        :return: A deferred that fires with the response, as a dictionary.
+        """
+        timeout = self._getTimeout(method, deadline)
+        if timeout is not None and timeout <= 0:
+            return defer.fail(NVPTimeoutError(method, 0))
 
+        bodyProducer = NVPProducer(pairs, self._getPrefix(method))
+        if self.observer is not None:
+            d = self._makeTimedRequest(method, bodyProducer)
+        else:
+            d = self._request(bodyProducer)
+            d.addCallback(self._readResponse, method in self.lazyMethods)
 
-    def makeRequest(self, pairs):
+        if timeout is not None:
+            d.addTimeout(timeout, self.clock, self._timedOut(method))
+        return d
+
+
+    def _timedOut(self, method):
+        """
+        Makes a function that turns the cancellation of a call that timed
+        out into an ``NVPTimeoutError``.
+        """
+        def onTimeoutCancel(result, timeout):
+            if isinstance(result, failure.Failure):
+                result.trap(defer.CancelledError)
+                raise NVPTimeoutError(method, timeout)
+            return result
+        return onTimeoutCancel
+
+
+    def _request(self, bodyProducer):
         headers = http_headers.Headers()
-        bodyProducer = NVPProducer(pairs)
         apiURL = self.credentials.apiURL
-        d = self._agent.request("GET", apiURL, headers, bodyProducer)
-        d.addCallback(urlparse.parse_qs)
+        return self._agent.request("POST", apiURL, headers, bodyProducer)
+
+
+    def _makeTimedRequest(self, method, bodyProducer):
+        """
+        Makes an NVP API call, and reports its timing to the observer.
+
+        Endpoints are made while the request is being made, so that is when
+        they can pick up the timing.
+        """
+        timing = RequestTiming(method, self.clock.seconds())
+        self._pendingTiming = timing
+        try:
+            d = self._request(bodyProducer)
+        finally:
+            self._pendingTiming = None
+
+        d.addCallback(self._readTimedResponse, timing,
+                      method in self.lazyMethods)
+        d.addBoth(self._reportTiming, timing, bodyProducer, self.observer)
         return d
 
 
+    def _readResponse(self, response, lazy=False):
+        """
+        Reads and parses the body of an NVP API response.
+        """
+        parser = NVPResponseParser(lazy)
+        response.deliverBody(parser)
+        return parser.finished
+
+
+    def _readTimedResponse(self, response, timing, lazy=False):
+        timing.responseStarted = self.clock.seconds()
+        parser = _TimedResponseParser(timing, self.clock, lazy)
+        response.deliverBody(parser)
+        return parser.finished
+
+
+    def _reportTiming(self, result, timing, bodyProducer, observer):
+        timing.finished = self.clock.seconds()
+        timing.succeeded = not isinstance(result, failure.Failure)
+        timing.bytesOut = bodyProducer.bytesWritten
+        try:
+            observer(timing)
+        except Exception:
+            log.err(None, "NVP API call timing observer failed")
+        return result
+
+
+
+def _decodePair(part):
+    """
+    Decodes a single urlencoded ``name=value`` pair.
+    """
+    name, _, value = part.partition("=")
+    return _unquote(name), _unquote(value)
+
+
+
+def _unquote(value):
+    """
+    Unquotes an urlencoded value, if it needs to be.
+    """
+    if "%" in value or "+" in value:
+        return urllib.unquote_plus(value)
+    return value
+
+
+
+def tokenize(body):
+    """
+    Finds the pairs in an urlencoded NVP body, without copying any of it.
+
+    Pairs are only separated by ``&``; empty pairs are skipped, and a pair
+    without ``=`` has an empty value.
+
+    :param body: The body.
+    :type body: ``str``
+    :return: The ``(start, equals, end)`` offsets of every pair, where
+        ``equals`` is the offset of the ``=`` (or ``end``, if there is
+        none).
+    :rtype: ``list`` of 3-``tuple`` of ``int``
+    """
+    offsets, find = [], body.find
+    start, size = 0, len(body)
+    while start < size:
+        end = find("&", start)
+        if end == -1:
+            end = size
+        if end > start:
+            equals = find("=", start, end)
+            if equals == -1:
+                equals = end
+            offsets.append((start, equals, end))
+        start = end + 1
+    return offsets
+
+
+
+class NVPPairs(collections.Sequence):
+    """
+    The pairs of an urlencoded NVP body.
+
+    The body is tokenized once; a pair's name and value are only sliced
+    out of the body, and decoded, when that pair is accessed. Unlike
+    ``urlparse.parse_qsl``, only names and values with escapes in them
+    are unquoted, and pairs with empty values are kept.
+    """
+    def __init__(self, body):
+        self.body = body
+        self.offsets = tokenize(body)
+
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+    def __getitem__(self, index):
+        start, equals, end = self.offsets[index]
+        body = self.body
+        return _unquote(body[start:equals]), _unquote(body[equals + 1:end])
+
+
+    def __iter__(self):
+        body = self.body
+        for start, equals, end in self.offsets:
+            yield _unquote(body[start:equals]), _unquote(body[equals + 1:end])
+
+
+    def __repr__(self):
+        return "NVPPairs({0!r})".format(self.body)
+
+
+
+class LazyResponse(collections.Mapping):
+    """
+    An NVP response, decoded lazily from its raw body.
+
+    Looking up a name finds its pair in the body, and only decodes that
+    pair's value; values are kept once decoded. Iterating over the
+    response (or getting its length) decodes the whole body once. If a
+    name occurs more than once, its last value is used, just like in the
+    dictionaries made by ``NVPResponseParser``.
+
+    Names are looked up in the body as ``urllib.quote_plus`` encodes them.
+    Names that aren't found that way, such as ones encoded with needless
+    escapes, are looked up in the decoded body instead.
+    """
+    def __init__(self, body):
+        self.body = body
+        self._values = {}
+        self._pairs = None
+
+
+    def __getitem__(self, name):
+        value = self._values.get(name)
+        if value is None:
+            value = self._values[name] = self._find(name)
+        return value
+
+
+    def _find(self, name):
+        """
+        Finds and decodes the value of the last pair with a name.
+        """
+        if self._pairs is not None:
+            return self._pairs[name]
+
+        body, key = self.body, urllib.quote_plus(name) + "="
+        start = body.rfind("&" + key) + 1
+        if not start and not body.startswith(key):
+            return self._decodeAll()[name]
+        valueStart = start + len(key)
+        end = body.find("&", valueStart)
+        if end == -1:
+            end = len(body)
+        return _unquote(body[valueStart:end])
+
+
+    def _decodeAll(self):
+        if self._pairs is None:
+            self._pairs = dict(NVPPairs(self.body))
+        return self._pairs
+
+
+    def __iter__(self):
+        return iter(self._decodeAll())
+
+
+    def __len__(self):
+        return len(self._decodeAll())
+
+
+    def __repr__(self):
+        return "LazyResponse({0!r})".format(self.body)
+
+
+
+class NVPResponseParser(protocol.Protocol):
+    """
+    A protocol that incrementally parses an NVP response body.
+
+    Pairs are decoded as soon as they have been received completely, so
+    only the last, incomplete pair is ever buffered. When the body is done,
+    ``finished`` fires with a dictionary mapping names to values.
+    Cancelling ``finished`` stops receiving the body.
+
+    If ``lazy`` is true, the body is only collected, and ``finished`` fires
+    with a ``LazyResponse`` instead.
+    """
+    def __init__(self, lazy=False):
+        self.finished = defer.Deferred(self._cancel)
+        self.lazy = lazy
+        self.pairs = {}
+        self._buffer = ""
+        self._chunks = []
+
+
+    def _cancel(self, _):
+        """
+        Stops receiving the body, which closes the connection.
+        """
+        if self.transport is not None:
+            self.transport.stopProducing()
+
+
+    def dataReceived(self, data):
+        if self.lazy:
+            self._chunks.append(data)
+            return
+        parts = (self._buffer + data).split("&")
+        self._buffer = parts.pop()
+        self._addParts(parts)
+
+
+    def _addParts(self, parts):
+        for part in parts:
+            if part:
+                name, value = _decodePair(part)
+                self.pairs[name] = value
+
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        if not reason.check(client.ResponseDone, http.PotentialDataLoss):
+            self.finished.errback(reason)
+            return
+        self.finished.callback(self._finishParsing())
+
+
+    def _finishParsing(self):
+        """
+        Parses what is left of the body, and gets the response.
+        """
+        if self.lazy:
+            return LazyResponse("".join(self._chunks))
+        self._addParts([self._buffer])
+        self._buffer = ""
+        return self.pairs
+
+
+
+class _TimedResponseParser(NVPResponseParser):
+    """
+    A response parser that records the time it spends parsing, and the
+    size of the body, in a timing.
+    """
+    def __init__(self, timing, clock, lazy=False):
+        NVPResponseParser.__init__(self, lazy)
+        self.timing = timing
+        self.clock = clock
+
+
+    def dataReceived(self, data):
+        start = self.clock.seconds()
+        NVPResponseParser.dataReceived(self, data)
+        self.timing.parseTime += self.clock.seconds() - start
+        self.timing.bytesIn += len(data)
+
+
+    def connectionLost(self, reason):
+        if not self.finished.called:
+            self.timing.responseDone = self.clock.seconds()
+        NVPResponseParser.connectionLost(self, reason)
+
+
+    def _finishParsing(self):
+        start = self.clock.seconds()
+        response = NVPResponseParser._finishParsing(self)
+        self.timing.parseTime += self.clock.seconds() - start
+        return response
+
+
+
+def _joinEncoded(*parts):
+    """
+    Joins urlencoded strings of pairs, some of which may be empty.
+    """
+    return "&".join(part for part in parts if part)
+
+
+
+def _encodePair(pair):
+    """
+    Urlencodes a single pair, exactly like ``urllib.urlencode`` would.
+    """
+    name, value = pair
+    return urllib.quote_plus(str(name)) + "=" + urllib.quote_plus(str(value))
+
+
 
 class NVPProducer(object):
     """
     A producer for a body consisting of NVP parts.
+
+    If there are only a few pairs, the body is encoded up front, so its
+    length is known. Iterables without a length are only consumed up to
+    the first pair past that limit to find out. Otherwise, pairs are encoded
+    and written ``CHUNK_PAIRS`` at a time as the transport asks for more,
+    and the body is sent with chunked transfer encoding.
+
+    The number of bytes written so far is available as ``bytesWritten``.
     """
-    def __init__(self, pairs):
-        self.content = urllib.urlencode(pairs)
-        self.length = len(self.content)
+    implements(iweb.IBodyProducer)
+    MAX_EAGER_PAIRS = 200
+    CHUNK_PAIRS = 50
+    bytesWritten = 0
+
+    def __init__(self, pairs, prefix="", cooperate=task.cooperate):
+        """
+        Initializes an NVP producer.
+
+        :param pairs: The (name, value) pairs to encode.
+        :param prefix: Already encoded pairs that go before the other pairs.
+        :param cooperate: The function used to schedule writing the body, if
+            it is written lazily.
+        """
+        self.prefix = prefix
+        self._cooperate = cooperate
+        self._task = None
+
+        if not hasattr(pairs, "__len__"):
+            rest = iter(pairs)
+            pairs = list(itertools.islice(rest, self.MAX_EAGER_PAIRS + 1))
+            if len(pairs) > self.MAX_EAGER_PAIRS:
+                pairs = itertools.chain(pairs, rest)
+
+        if hasattr(pairs, "__len__") and len(pairs) <= self.MAX_EAGER_PAIRS:
+            self._pairs = None
+            self.content = _joinEncoded(prefix, urllib.urlencode(pairs))
+            self.length = len(self.content)
+        else:
+            self._pairs = pairs
+            self.content = None
+            self.length = iweb.UNKNOWN_LENGTH
 
 
     def startProducing(self, consumer):
-        consumer.write(self.content)
+        if self.content is not None:
+            consumer.write(self.content)
+            self.bytesWritten = self.length
+            return defer.succeed(None)
+
+        self._task = self._cooperate(self._writeChunks(consumer))
+        d = self._task.whenDone()
+        d.addCallbacks(lambda _: None, self._maybeStopped)
+        return d
+
+
+    def _maybeStopped(self, reason):
+        """
+        Makes sure the deferred from ``startProducing`` never fires when
+        producing is stopped, as ``IBodyProducer`` requires.
+        """
+        reason.trap(task.TaskStopped)
+        return defer.Deferred()
+
+
+    def _writeChunks(self, consumer):
+        """
+        Encodes and writes the body a chunk at a time, yielding after each
+        chunk.
+        """
+        needSeparator = bool(self.prefix)
+        if needSeparator:
+            consumer.write(self.prefix)
+            self.bytesWritten += len(self.prefix)
+            yield None
+
+        chunk = []
+        for pair in self._pairs:
+            chunk.append(_encodePair(pair))
+            if len(chunk) == self.CHUNK_PAIRS:
+                self._writeChunk(consumer, chunk, needSeparator)
+                needSeparator, chunk = True, []
+                yield None
+
+        if chunk:
+            self._writeChunk(consumer, chunk, needSeparator)
+
+
+    def _writeChunk(self, consumer, chunk, needSeparator):
+        data = "&".join(chunk)
+        if needSeparator:
+            data = "&" + data
+        consumer.write(data)
+        self.bytesWritten += len(data)
 
 
     def pauseProducing(self):
-        pass
+        if self._task is not None:
+            self._task.pause()
+
+
+    def resumeProducing(self):
+        if self._task is not None:
+            self._task.resume()
 
 
     def stopProducing(self):
-        pass
+        if self._task is not None:
+            self._task.stop()
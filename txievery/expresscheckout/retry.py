@@ -0,0 +1,306 @@
+"""
+Hedging and retrying of idempotent NVP API calls.
+"""
+import collections
+import math
+import random
+
+from twisted.internet import defer, error, reactor
+from twisted.web import client
+
+from txievery.expresscheckout import nvp
+
+IDEMPOTENT_METHODS = frozenset(["GetExpressCheckoutDetails"])
+
+TRANSIENT_ERRORS = (error.ConnectError,
+                    error.ConnectionLost,
+                    error.TimeoutError,
+                    client.ResponseFailed,
+                    client.RequestTransmissionFailed,
+                    nvp.NVPTimeoutError)
+
+
+
+class RetryPolicy(object):
+    """
+    How idempotent API calls are hedged and retried.
+
+    A call is hedged by making the same call again if it hasn't completed
+    after the ``hedgePercentile`` percentile of the latencies of recent
+    calls to the same method, or after ``initialHedgeDelay`` seconds while
+    fewer than ``minSamples`` latencies are known. Whichever attempt
+    succeeds first is used, and the other one is cancelled.
+
+    Attempts that fail with a transient error (see ``TRANSIENT_ERRORS``)
+    are retried after a random delay between zero and an exponentially
+    growing backoff (``backoff`` seconds, doubled for every retry, but at
+    most ``maxBackoff`` seconds).
+
+    No call is attempted more than ``maxAttempts`` times in total,
+    counting hedges and retries, and no attempts are started after the
+    call's deadline.
+    """
+    def __init__(self, hedgePercentile=95, initialHedgeDelay=1.0,
+                 minSamples=20, window=1000, maxAttempts=3, backoff=0.1,
+                 maxBackoff=5.0, methods=IDEMPOTENT_METHODS):
+        """
+        Initializes a retry policy.
+
+        :param window: The number of recent latencies kept per method.
+        :param methods: The names of the methods that may be hedged and
+            retried. These must be idempotent.
+        """
+        self.hedgePercentile = hedgePercentile
+        self.initialHedgeDelay = initialHedgeDelay
+        self.minSamples = minSamples
+        self.window = window
+        self.maxAttempts = maxAttempts
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.methods = methods
+
+
+
+class _Latencies(object):
+    """
+    The latencies of recent successful calls to a method.
+    """
+    def __init__(self, window):
+        self._samples = collections.deque(maxlen=window)
+        self._sorted = None
+
+
+    def __len__(self):
+        return len(self._samples)
+
+
+    def add(self, latency):
+        self._samples.append(latency)
+        self._sorted = None
+
+
+    def percentile(self, p):
+        """
+        Gets the ``p``th percentile of the recent latencies (nearest rank).
+        """
+        if self._sorted is None:
+            self._sorted = sorted(self._samples)
+        rank = int(math.ceil(p / 100.0 * len(self._sorted)))
+        return self._sorted[max(rank - 1, 0)]
+
+
+
+class _HedgedCall(object):
+    """
+    A single idempotent API call, which may take several attempts.
+    """
+    done = False
+
+    def __init__(self, retryingAgent, pairs, method, deadline):
+        self.retryingAgent = retryingAgent
+        self.pairs = pairs
+        self.method = method
+        self.deadline = deadline
+        self.deferred = defer.Deferred(self._cancel)
+
+        self.attempts = 0
+        self.retries = 0
+        self._inFlight = []
+        self._timer = None
+
+
+    def start(self):
+        self.startedAt = self.retryingAgent.clock.seconds()
+        self._attempt()
+        return self.deferred
+
+
+    def _attempt(self, hedge=False):
+        """
+        Makes an attempt, and schedules a hedge if it's the only one.
+        """
+        self._timer = None
+        self.attempts += 1
+        agent = self.retryingAgent
+        d = defer.maybeDeferred(agent.agent.makeRequest, self.pairs,
+                                self.method, deadline=self.deadline)
+        if not d.called:
+            self._inFlight.append(d)
+        d.addCallbacks(self._succeeded, self._failed,
+                       callbackArgs=(d, hedge), errbackArgs=(d,))
+
+        if self._inFlight == [d] and self.attempts < agent.policy.maxAttempts:
+            delay = agent.hedgeDelay(self.method)
+            if self._beforeDeadline(delay):
+                self._timer = agent.clock.callLater(delay, self._hedge)
+
+
+    def _beforeDeadline(self, delay):
+        """
+        Checks if an attempt started after some delay would start before
+        the deadline.
+        """
+        if self.deadline is None:
+            return True
+        return self.retryingAgent.clock.seconds() + delay < self.deadline
+
+
+    def _hedge(self):
+        self.retryingAgent.hedged += 1
+        self._attempt(hedge=True)
+
+
+    def _succeeded(self, result, attempt, hedge):
+        """
+        Uses the result of the first successful attempt.
+
+        The latency of the call is measured from the start of its first
+        attempt. Measuring it from the start of the winning attempt would
+        make the latencies of hedged calls look short, and the hedge delay
+        would keep dropping.
+        """
+        if self.done:
+            return
+        self._finish(attempt)
+
+        agent = self.retryingAgent
+        latency = agent.clock.seconds() - self.startedAt
+        agent.recordLatency(self.method, latency)
+        if hedge:
+            agent.hedgeWins += 1
+        self.deferred.callback(result)
+
+
+    def _failed(self, reason, attempt):
+        if self.done:
+            return
+        if attempt in self._inFlight:
+            self._inFlight.remove(attempt)
+        if self._inFlight:
+            return
+
+        agent = self.retryingAgent
+        delay = agent.backoff(self.retries + 1)
+        retryable = (reason.check(*TRANSIENT_ERRORS)
+                     and self.attempts < agent.policy.maxAttempts
+                     and self._beforeDeadline(delay))
+        if not retryable:
+            self._finish(None)
+            self.deferred.errback(reason)
+            return
+
+        if self._timer is not None:
+            self._timer.cancel()
+        self.retries += 1
+        agent.retries += 1
+        self._timer = agent.clock.callLater(delay, self._attempt)
+
+
+    def _finish(self, winner):
+        """
+        Marks this call as done, cancelling everything but the winning
+        attempt.
+        """
+        self.done = True
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        losers, self._inFlight = self._inFlight, []
+        for attempt in losers:
+            if attempt is not winner:
+                attempt.cancel()
+
+
+    def _cancel(self, _):
+        self._finish(None)
+
+
+
+class RetryingAgent(object):
+    """
+    Hedges and retries idempotent NVP API calls.
+
+    Only calls to the methods in the policy's ``methods`` are ever hedged
+    or retried; other calls, such as ``SetExpressCheckout``, are passed on
+    to the wrapped agent unchanged.
+
+    This has the same ``makeRequest`` method as ``nvp.NVPAgent``, so it can
+    be used wherever an agent can.
+    """
+    def __init__(self, agent, policy=None, clock=reactor,
+                 random=random.random):
+        """
+        Initializes a retrying agent.
+
+        :param agent: The agent that actually makes the API calls.
+        :param policy: The retry policy. If ``None``, the defaults of
+            ``RetryPolicy`` are used.
+        :param clock: The clock used to measure latencies and schedule
+            hedges and retries.
+        :type clock: ``IReactorTime``
+        :param random: A function returning random floats in [0, 1), used
+            to spread out retries.
+        """
+        self.agent = agent
+        self.policy = policy if policy is not None else RetryPolicy()
+        self.clock = clock
+        self.random = random
+
+        self._latencies = {}
+        self.hedged = self.hedgeWins = self.retries = 0
+
+
+    @property
+    def statistics(self):
+        """
+        The hedging and retrying statistics, as a dictionary.
+
+        hedged
+            The number of hedging attempts made.
+        hedgeWins
+            The number of calls where a hedging attempt succeeded first.
+        retries
+            The number of retries after transient failures.
+        """
+        return {"hedged": self.hedged,
+                "hedgeWins": self.hedgeWins,
+                "retries": self.retries}
+
+
+    def makeRequest(self, pairs, method=None, deadline=None):
+        """
+        Makes an API call, hedging and retrying it if it's idempotent.
+
+        Cancelling the returned deferred cancels all attempts in flight.
+        """
+        if method not in self.policy.methods:
+            return self.agent.makeRequest(pairs, method, deadline=deadline)
+        return _HedgedCall(self, list(pairs), method, deadline).start()
+
+
+    def hedgeDelay(self, method):
+        """
+        Gets the delay after which calls to a method are hedged.
+        """
+        latencies = self._latencies.get(method)
+        if latencies is None or len(latencies) < self.policy.minSamples:
+            return self.policy.initialHedgeDelay
+        return latencies.percentile(self.policy.hedgePercentile)
+
+
+    def recordLatency(self, method, latency):
+        latencies = self._latencies.get(method)
+        if latencies is None:
+            latencies = self._latencies[method] = _Latencies(
+                self.policy.window)
+        latencies.add(latency)
+
+
+    def backoff(self, retries):
+        """
+        Gets a random delay before the given retry (starting at 1).
+        """
+        policy = self.policy
+        ceiling = min(policy.maxBackoff, policy.backoff * 2 ** (retries - 1))
+        return self.random() * ceiling
@@ -0,0 +1,242 @@
+"""
+Scheduling of NVP API calls.
+"""
+import heapq
+import itertools
+
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+from txievery.expresscheckout import nvp
+
+
+PRIORITIES = {"DoExpressCheckoutPayment": 0,
+              "GetExpressCheckoutDetails": 1,
+              "SetExpressCheckout": 2}
+DEFAULT_PRIORITY = max(PRIORITIES.itervalues()) + 1
+
+
+
+class QueuedCall(object):
+    """
+    An API call that is waiting to be made.
+
+    This is used by agents that queue calls, such as ``RequestScheduler``
+    and ``limits.RateLimitedAgent``. The caller of ``makeRequest`` gets
+    ``deferred``; cancelling it cancels the call whether it is still
+    queued or already in flight (as ``inFlight``). If ``expiry`` is set,
+    it is the delayed call that ``expire``s this call at its deadline.
+
+    ``onCancelled``, if not ``None``, is called with the call when it is
+    cancelled or expires while it is still queued, so that the queue can
+    keep count and drop it.
+    """
+    cancelled = False
+    inFlight = None
+    expiry = None
+
+    def __init__(self, pairs, method, enqueuedAt, deadline,
+                 onCancelled=None):
+        self.pairs = pairs
+        self.method = method
+        self.enqueuedAt = enqueuedAt
+        self.deadline = deadline
+        self.onCancelled = onCancelled
+        self.deferred = defer.Deferred(self._cancel)
+
+
+    def _cancel(self, _):
+        if self.inFlight is not None:
+            self.inFlight.cancel()
+        else:
+            self._dequeue()
+            self.stopExpiry()
+
+
+    def _dequeue(self):
+        self.cancelled = True
+        if self.onCancelled is not None:
+            self.onCancelled(self)
+
+
+    def stopExpiry(self):
+        if self.expiry is not None and self.expiry.active():
+            self.expiry.cancel()
+
+
+    def expire(self):
+        """
+        Gives up on this call, because its deadline passed while it was
+        waiting to be made.
+        """
+        self._dequeue()
+        timeout = self.deadline - self.enqueuedAt
+        self.deferred.errback(nvp.NVPTimeoutError(self.method, timeout))
+
+
+
+class RequestScheduler(object):
+    """
+    Limits the number of NVP API calls in flight, queueing the rest.
+
+    Queued calls are made in order of priority: completing payments goes
+    before looking up checkout details, which goes before creating new
+    checkouts (see ``PRIORITIES``). Calls with the same priority are made
+    in the order they were scheduled.
+
+    If the scheduler has an adaptive ``limit`` (such as a
+    ``limits.AIMDLimit``), the maximum number of API calls in flight is
+    updated every time a call is done.
+
+    This has the same ``makeRequest`` method as ``nvp.NVPAgent``, so it can
+    be used wherever an agent can.
+    """
+    def __init__(self, agent, maxInFlight=10, clock=reactor, limit=None):
+        """
+        Initializes a request scheduler.
+
+        :param agent: The agent that actually makes the API calls.
+        :param maxInFlight: The maximum number of API calls in flight. If
+            there is an adaptive limit, this is ignored.
+        :type maxInFlight: ``int``
+        :param clock: The clock used to measure waiting times.
+        :type clock: ``IReactorTime``
+        :param limit: The adaptive limit on API calls in flight, if any.
+        """
+        self.agent = agent
+        self.limit = limit
+        if limit is not None:
+            maxInFlight = limit.limit
+        self.maxInFlight = maxInFlight
+        self.clock = clock
+
+        self.inFlight = 0
+        self.queueDepth = 0
+        self._queue = []
+        self._counter = itertools.count()
+        self._dispatching = False
+
+        self.dispatched = 0
+        self.totalWaitTime = self.maxWaitTime = 0.0
+
+
+    @property
+    def statistics(self):
+        """
+        The scheduler statistics, as a dictionary.
+
+        The wait times are in seconds, and include calls that did not
+        have to wait at all.
+        """
+        if self.dispatched:
+            meanWaitTime = self.totalWaitTime / self.dispatched
+        else:
+            meanWaitTime = 0.0
+
+        return {"inFlight": self.inFlight,
+                "queueDepth": self.queueDepth,
+                "dispatched": self.dispatched,
+                "meanWaitTime": meanWaitTime,
+                "maxWaitTime": self.maxWaitTime}
+
+
+    def makeRequest(self, pairs, method=None, deadline=None):
+        """
+        Schedules an API call.
+
+        Returns a deferred that fires with the result of the call, once it
+        has been made. Cancelling it removes the call from the queue, or
+        cancels it if it is already in flight. If the call is still queued
+        at its deadline, it fails with ``nvp.NVPTimeoutError``.
+        """
+        now = self.clock.seconds()
+        call = QueuedCall(pairs, method, now, deadline, self._callCancelled)
+        if deadline is not None:
+            call.expiry = self.clock.callLater(max(deadline - now, 0),
+                                               call.expire)
+
+        priority = PRIORITIES.get(method, DEFAULT_PRIORITY)
+        heapq.heappush(self._queue, (priority, next(self._counter), call))
+        self.queueDepth += 1
+        self._dispatch()
+        return call.deferred
+
+
+    def _callCancelled(self, call):
+        """
+        Forgets a queued call that was cancelled or expired.
+
+        Cancelled calls are dropped from the queue once they make up more
+        than half of it, so that it doesn't keep growing while calls keep
+        timing out.
+        """
+        self.queueDepth -= 1
+        if len(self._queue) > 2 * self.queueDepth:
+            self._queue = [entry for entry in self._queue
+                           if not entry[2].cancelled]
+            heapq.heapify(self._queue)
+
+
+    def _dispatch(self):
+        """
+        Makes queued API calls, as long as there is room for them.
+
+        Calls that complete synchronously don't cause nested dispatching;
+        the outermost dispatch loop just keeps going.
+        """
+        if self._dispatching:
+            return
+
+        self._dispatching = True
+        try:
+            while self._queue and self.inFlight < self.maxInFlight:
+                _, _, call = heapq.heappop(self._queue)
+                if not call.cancelled:
+                    self.queueDepth -= 1
+                    self._makeCall(call)
+        finally:
+            self._dispatching = False
+
+
+    def _makeCall(self, call):
+        call.stopExpiry()
+        waitTime = self.clock.seconds() - call.enqueuedAt
+        self.dispatched += 1
+        self.totalWaitTime += waitTime
+        self.maxWaitTime = max(self.maxWaitTime, waitTime)
+
+        self.inFlight += 1
+        startedAt = self.clock.seconds()
+        call.inFlight = d = defer.maybeDeferred(self.agent.makeRequest,
+                                                call.pairs, call.method,
+                                                deadline=call.deadline)
+        d.addBoth(self._callDone, startedAt, self.inFlight)
+        d.chainDeferred(call.deferred)
+        d.addCallback(lambda _: self._dispatch())
+
+
+    def _callDone(self, result, startedAt, inFlight):
+        """
+        Frees the slot of a call that is done.
+
+        The next queued call is only made once the caller has the result,
+        so that calls the caller cancels in response, such as hedges that
+        lost, are never made.
+        """
+        self.inFlight -= 1
+        if self.limit is not None:
+            self._updateLimit(result, startedAt, inFlight)
+        return result
+
+
+    def _updateLimit(self, result, startedAt, inFlight):
+        """
+        Updates the maximum number of API calls in flight from the adaptive
+        limit. Cancelled calls are not taken into account.
+        """
+        succeeded = not isinstance(result, failure.Failure)
+        if not succeeded and result.check(defer.CancelledError):
+            return
+        latency = self.clock.seconds() - startedAt
+        self.maxInFlight = self.limit.update(latency, succeeded, inFlight,
+                                             startedAt)
@@ -0,0 +1,195 @@
+"""
+Tests for making API calls with several accounts.
+"""
+import itertools
+
+from twisted.internet import error, task
+from twisted.trial import unittest
+
+from txievery.expresscheckout import accounts, api, limits, nvp
+from txievery.expresscheckout.test.test_scheduler import FakeAgent
+
+
+class AccountTest(unittest.TestCase):
+    def setUp(self):
+        self.credentials = api.Credentials("user", "pwd", None, "http://a")
+
+
+    def test_agent(self):
+        pool = nvp.NVPConnectionPool(task.Clock())
+        account = accounts.Account(self.credentials, pool)
+        agent = account.makeAgent([("VERSION", "74.0")], timeout=5)
+        self.assertIsInstance(agent, nvp.NVPAgent)
+        self.assertIdentical(agent.pool, pool)
+        self.assertEqual(agent.prefix, "USER=user&PWD=pwd&VERSION=74.0")
+        self.assertEqual(agent.timeout, 5)
+
+
+    def test_observer(self):
+        account = accounts.Account(self.credentials)
+        observer = lambda timing: None
+        agent = account.makeAgent(observer=observer)
+        self.assertIdentical(agent.observer, observer)
+
+
+    def test_rateLimited(self):
+        clock = task.Clock()
+        account = accounts.Account(self.credentials, rate=10, burst=20)
+        agent = account.makeAgent(clock=clock)
+        self.assertIsInstance(agent, limits.RateLimitedAgent)
+        self.assertEqual((agent.bucket.rate, agent.bucket.burst), (10, 20))
+        self.assertIsInstance(agent.agent, nvp.NVPAgent)
+
+
+
+class FindTokenTest(unittest.TestCase):
+    def test_lazy(self):
+        """
+        Tests that pairs after the token aren't consumed.
+        """
+        rest = itertools.count()
+        pairs = itertools.chain([("TOKEN", "1"), ("PAYERID", "2")], rest)
+        token, pairs = accounts._findToken(pairs)
+        self.assertEqual(token, "1")
+        self.assertEqual(next(rest), 0)
+        self.assertEqual(list(itertools.islice(pairs, 3)),
+                         [("TOKEN", "1"), ("PAYERID", "2"), 1])
+
+
+    def test_missing(self):
+        self.assertEqual(accounts._findToken(iter([("A", "1")])),
+                         (None, [("A", "1")]))
+
+
+
+class BalancingAgentTest(unittest.TestCase):
+    def setUp(self):
+        self.agents = [FakeAgent(), FakeAgent()]
+        self.balancer = accounts.BalancingAgent(self.agents, maxTokens=2)
+
+
+    def _create(self, token):
+        """
+        Creates a checkout, and returns the index of the agent used.
+        """
+        self.balancer.makeRequest([], "SetExpressCheckout")
+        for index, agent in enumerate(self.agents):
+            if agent.calls and not agent.calls[-1][2].called:
+                agent.calls[-1][2].callback({"TOKEN": token})
+                return index
+
+
+    def test_leastOutstanding(self):
+        for _ in range(3):
+            self.balancer.makeRequest([], "SetExpressCheckout")
+        self.assertEqual([len(a.calls) for a in self.agents], [2, 1])
+        self.assertEqual(self.balancer.outstanding, [2, 1])
+
+        self.agents[0].calls[0][2].callback({})
+        self.agents[0].calls[1][2].callback({})
+        self.balancer.makeRequest([], "SetExpressCheckout")
+        self.assertEqual([len(a.calls) for a in self.agents], [3, 1])
+        self.assertEqual(self.balancer.statistics["calls"], [3, 1])
+
+
+    def test_sticky(self):
+        index = self._create("EC-1")
+        for _ in range(3):
+            self.balancer.makeRequest([("TOKEN", "EC-1")],
+                                      "GetExpressCheckoutDetails", 5)
+        self.assertEqual(len(self.agents[index].calls), 4)
+        self.assertEqual(len(self.agents[1 - index].calls), 0)
+
+        _, pairs, _ = self.agents[index].calls[-1]
+        self.assertEqual(list(pairs), [("TOKEN", "EC-1")])
+        self.assertEqual(self.agents[index].deadlines[-1], 5)
+        self.assertEqual(self.balancer.agentIndexFor("EC-1"), index)
+
+
+    def test_failedCreation(self):
+        d = self.balancer.makeRequest([], "SetExpressCheckout")
+        self.agents[0].calls[0][2].errback(error.ConnectionLost())
+        self.failureResultOf(d, error.ConnectionLost)
+        self.assertEqual(self.balancer.outstanding, [0, 0])
+        self.assertEqual(self.balancer.statistics["tokens"], 0)
+
+
+    def test_completed(self):
+        """
+        Tests that the agent of a checkout is forgotten once the checkout
+        has been completed, but not when completing it fails.
+        """
+        index = self._create("EC-1")
+        pairs = [("TOKEN", "EC-1"), ("PAYERID", "P")]
+        d = self.balancer.makeRequest(pairs, "DoExpressCheckoutPayment")
+        self.agents[index].calls[-1][2].errback(error.ConnectionLost())
+        self.failureResultOf(d, error.ConnectionLost)
+        self.assertEqual(self.balancer.agentIndexFor("EC-1"), index)
+
+        d = self.balancer.makeRequest(pairs, "DoExpressCheckoutPayment")
+        self.agents[index].calls[-1][2].callback({"ACK": "Success"})
+        self.assertEqual(self.successResultOf(d), {"ACK": "Success"})
+        self.assertIdentical(self.balancer.agentIndexFor("EC-1"), None)
+        self.assertEqual(self.balancer.statistics["tokens"], 0)
+
+
+    def test_unknownToken(self):
+        self.balancer.makeRequest([("TOKEN", "EC-1")],
+                                  "GetExpressCheckoutDetails")
+        self.assertEqual(sum(len(a.calls) for a in self.agents), 1)
+
+
+    def test_maxTokens(self):
+        for token in ["1", "2", "3"]:
+            self._create(token)
+        self.assertIdentical(self.balancer.agentIndexFor("1"), None)
+        self.assertNotIdentical(self.balancer.agentIndexFor("3"), None)
+
+
+
+class MultiAccountClientTest(unittest.TestCase):
+    def setUp(self):
+        credentials = [api.Credentials(name, "pwd", None, "http://a")
+                       for name in ["a", "b"]]
+        self.accounts = [accounts.Account(c) for c in credentials]
+
+
+    def test_agents(self):
+        client = api.Client(self.accounts, "http://r", "http://c")
+        self.assertIsInstance(client.agent, accounts.BalancingAgent)
+        prefixes = [agent.prefix for agent in client.agent.agents]
+        self.assertTrue(prefixes[0].startswith("USER=a&PWD=pwd&VERSION="))
+        self.assertTrue(prefixes[1].startswith("USER=b&PWD=pwd&VERSION="))
+
+
+    def test_observer(self):
+        observer = lambda timing: None
+        client = api.Client(self.accounts, "http://r", "http://c",
+                            observer=observer)
+        for agent in client.agent.agents:
+            self.assertIdentical(agent.observer, observer)
+
+
+    def test_pool(self):
+        pool = nvp.NVPConnectionPool(task.Clock())
+        self.assertRaises(ValueError, api.Client, self.accounts, "http://r",
+                          "http://c", pool)
+
+
+    def test_checkoutSticksToAccount(self):
+        client = api.Client(self.accounts, "http://r", "http://c")
+        agents = client.agent.agents = [FakeAgent(), FakeAgent()]
+        client.agent.makeRequest([], "SetExpressCheckout")
+        d = client.createCheckout()
+        agents[1].calls[0][2].callback({"TOKEN": "EC-1"})
+        checkout = self.successResultOf(d)
+
+        checkout.complete([])
+        method, _, details = agents[1].calls[-1]
+        self.assertEqual(method, "GetExpressCheckoutDetails")
+        details.callback({"PAYERID": "2"})
+        method, pairs, _ = agents[1].calls[-1]
+        self.assertEqual(method, "DoExpressCheckoutPayment")
+        self.assertEqual(list(pairs)[:2], [("TOKEN", "EC-1"),
+                                           ("PAYERID", "2")])
+        self.assertEqual(len(agents[0].calls), 1)
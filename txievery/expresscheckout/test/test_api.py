@@ -2,14 +2,20 @@
 Tests for the Express Checkout txievery API.
 """
 import decimal
+import gc
 import mock
 import os
 import tempfile
+import weakref
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.trial import unittest
 
-from txievery.expresscheckout import api, interface
+from txievery.expresscheckout import api, cache, interface, limits, nvp
+from txievery.expresscheckout import retry, scheduler, validate
+from txievery.expresscheckout.encode import encodePaymentRequests
+from txievery.expresscheckout.test.test_nvp import FakeResponse
+from txievery.expresscheckout.test.test_scheduler import FakeAgent
 
 
 emptyPaymentRequest = api.PaymentRequest([])
@@ -82,12 +88,361 @@ class ClientTest(unittest.TestCase):
         return d
 
 
+    def test_prefix(self):
+        client = api.Client(defaultCredentials, "http://r", "http://c")
+        expected = ("USER=lvh&PWD=ewa&VERSION={0}"
+                    "&RETURNURL=http%3A%2F%2Fr&CANCELURL=http%3A%2F%2Fc"
+                    .format(api.Client.API_VERSION))
+        self.assertEqual(client.agent.prefix, expected)
+
+
+    def test_methodPassedToAgent(self):
+        self.client.createCheckout(emptyPaymentRequest)
+        method = self.client.agent.makeRequest.call_args[0][1]
+        self.assertEqual(method, "SetExpressCheckout")
+
+
+    def test_maxInFlight(self):
+        client = api.Client(defaultCredentials, "http://r", "http://c",
+                            maxInFlight=5)
+        self.assertIsInstance(client.agent, scheduler.RequestScheduler)
+        self.assertEqual(client.agent.maxInFlight, 5)
+
+
+    def test_retryPolicy(self):
+        """
+        Tests that every attempt of an API call is scheduled separately.
+        """
+        policy = retry.RetryPolicy()
+        client = api.Client(defaultCredentials, "http://r", "http://c",
+                            maxInFlight=5, retryPolicy=policy)
+        self.assertIsInstance(client.agent, retry.RetryingAgent)
+        self.assertIdentical(client.agent.policy, policy)
+        self.assertIsInstance(client.agent.agent, scheduler.RequestScheduler)
+        self.assertIsInstance(client.agent.agent.agent, nvp.NVPAgent)
+
+
+    def test_hedgesScheduled(self):
+        """
+        Tests that hedges don't make more API calls than ``maxInFlight``.
+        """
+        policy = retry.RetryPolicy(initialHedgeDelay=1.0)
+        client = api.Client(defaultCredentials, "http://r", "http://c",
+                            maxInFlight=1, retryPolicy=policy)
+        client.agent.clock = clock = task.Clock()
+        client.agent.agent.agent = agent = FakeAgent()
+
+        d = client.getCheckoutDetails("1")
+        clock.advance(1)
+        self.assertEqual(len(agent.calls), 1)
+        self.assertEqual(client.agent.statistics["hedged"], 1)
+        self.assertEqual(client.agent.agent.statistics["queueDepth"], 1)
+
+        agent.calls[0][2].callback({"TOKEN": "1"})
+        self.assertEqual(self.successResultOf(d), {"TOKEN": "1"})
+        self.assertEqual(len(agent.calls), 1)
+        self.assertEqual(client.agent.agent.statistics["queueDepth"], 0)
+
+
+    def test_concurrencyLimit(self):
+        limit = limits.AIMDLimit(initial=3)
+        client = api.Client(defaultCredentials, "http://r", "http://c",
+                            concurrencyLimit=limit)
+        self.assertIsInstance(client.agent, scheduler.RequestScheduler)
+        self.assertIdentical(client.agent.limit, limit)
+        self.assertEqual(client.agent.maxInFlight, 3)
+
+
+    def test_circuitBreaker(self):
+        """
+        Tests that every attempt of an API call goes through the circuit
+        breaker.
+        """
+        breaker = limits.CircuitBreaker()
+        client = api.Client(defaultCredentials, "http://r", "http://c",
+                            retryPolicy=retry.RetryPolicy(),
+                            circuitBreaker=breaker)
+        breakingAgent = client.agent.agent
+        self.assertIsInstance(breakingAgent, limits.BreakingAgent)
+        self.assertIdentical(breakingAgent.breaker, breaker)
+        self.assertIsInstance(breakingAgent.agent, nvp.NVPAgent)
+
+
+    def test_observer(self):
+        """
+        Tests that the observer gets the timing of every API call.
+        """
+        timings = []
+        client = api.Client(defaultCredentials, "http://r", "http://c",
+                            observer=timings.append)
+        client.agent._agent = mock.Mock()
+        client.agent._agent.request.side_effect = lambda *args: defer.succeed(
+            FakeResponse("ACK=Success&TOKEN=1"))
+
+        checkout = self.successResultOf(
+            client.createCheckout(emptyPaymentRequest))
+        self.successResultOf(checkout.getDetails())
+        self.assertEqual([timing.method for timing in timings],
+                         ["SetExpressCheckout", "GetExpressCheckoutDetails"])
+        for timing in timings:
+            self.assertIsInstance(timing, nvp.RequestTiming)
+            self.assertTrue(timing.succeeded)
+
+
+    def test_getCheckoutDetails(self):
+        d = self.client.getCheckoutDetails("1")
+        pairs, method = self.client.agent.makeRequest.call_args[0]
+        self.assertEqual(method, "GetExpressCheckoutDetails")
+        self.assertIn(("TOKEN", "1"), list(pairs))
+
+        self.deferred.callback({"TOKEN": "1", "PAYERID": "2"})
+        self.assertEqual(self.successResultOf(d)["PAYERID"], "2")
+
+
+    def test_getCheckoutDetailsCoalesced(self):
+        first = self.client.getCheckoutDetails("1")
+        second = self.client.getCheckoutDetails("1")
+        self.assertEqual(self.client.agent.makeRequest.call_count, 1)
+
+        self.deferred.callback({"TOKEN": "1"})
+        self.assertEqual(self.successResultOf(first), {"TOKEN": "1"})
+        self.assertEqual(self.successResultOf(second), {"TOKEN": "1"})
+
+
+    def test_completeCheckout(self):
+        d = self.client.completeCheckout("1", "2", [emptyPaymentRequest])
+        pairs, method = self.client.agent.makeRequest.call_args[0]
+        self.assertEqual(method, "DoExpressCheckoutPayment")
+        pairs = list(pairs)
+        self.assertIn(("TOKEN", "1"), pairs)
+        self.assertIn(("PAYERID", "2"), pairs)
+        self.assertIn(("PAYMENTREQUEST_0_AMT", decimal.Decimal("0")), pairs)
+
+        self.deferred.callback({"ACK": "Success"})
+        self.assertEqual(self.successResultOf(d), {"ACK": "Success"})
+
+
+    def test_completeCheckoutLength(self):
+        """
+        Tests that the body of a ``DoExpressCheckoutPayment`` call has a
+        known length, so it isn't sent with chunked transfer encoding.
+        """
+        self.client.completeCheckout("1", "2", [emptyPaymentRequest])
+        pairs, method = self.client.agent.makeRequest.call_args[0]
+        producer = nvp.NVPProducer(pairs)
+        self.assertIsInstance(producer.length, int)
+
+
+    def test_deadlines(self):
+        self.client.createCheckout(emptyPaymentRequest, deadline=10)
+        self.client.getCheckoutDetails("1", 20)
+        self.client.completeCheckout("1", "2", [], 30)
+        deadlines = [kwargs["deadline"] for _, kwargs
+                     in self.client.agent.makeRequest.call_args_list]
+        self.assertEqual(deadlines, [10, 20, 30])
+
+
+    def test_deadlineFor(self):
+        self.client.clock = task.Clock()
+        self.client.clock.advance(100)
+        self.assertEqual(self.client.deadlineFor(5), 105)
+        self.assertIdentical(self.client.deadlineFor(None), None)
+
+
+    def test_unexpectedKeywordArgument(self):
+        self.assertRaises(TypeError, self.client.createCheckout,
+                          emptyPaymentRequest, timeout=10)
+
+
+    def test_lazyDetails(self):
+        client = api.Client(defaultCredentials, "http://r", "http://c")
+        self.assertEqual(client.agent.lazyMethods,
+                         frozenset(["GetExpressCheckoutDetails"]))
+
+
+    def test_timeouts(self):
+        client = api.Client(defaultCredentials, "http://r", "http://c",
+                            timeout=10, methodTimeouts={"Method": 5})
+        self.assertEqual(client.agent.timeout, 10)
+        self.assertEqual(client.agent.methodTimeouts, {"Method": 5})
+
+
     def test_tooManyRequests(self):
         numRequests = self.client.MAX_PAYMENT_REQUESTS + 1
         requests = [emptyPaymentRequest] * numRequests
         self.assertRaises(ValueError, self.client.createCheckout, *requests)
 
 
+    def test_invalidCart(self):
+        """
+        Tests that invalid carts fail without making an API call.
+        """
+        requests = [api.PaymentRequest([]),
+                    api.PaymentRequest([], currency="EUR")]
+        self.assertRaises(validate.InvalidCartError,
+                          self.client.createCheckout, *requests)
+        self.assertFalse(self.client.agent.makeRequest.called)
+
+
+    def test_createCheckouts(self):
+        responses = []
+        def makeRequest(pairs, method, deadline=None):
+            d = defer.Deferred()
+            responses.append(d)
+            return d
+        self.client.agent.makeRequest.side_effect = makeRequest
+
+        numRequests = self.client.MAX_PAYMENT_REQUESTS + 1
+        tooMany = [emptyPaymentRequest] * numRequests
+        carts = [[emptyPaymentRequest], tooMany,
+                 [emptyPaymentRequest], [emptyPaymentRequest]]
+        ds = self.client.createCheckouts(iter(carts), concurrency=2)
+        self.assertEqual(len(ds), 4)
+
+        self.failureResultOf(ds[1], ValueError)
+        self.assertEqual(len(responses), 2)
+
+        responses[1].callback({"TOKEN": "3"})
+        self.assertEqual(self.successResultOf(ds[2]).token, "3")
+        self.assertNoResult(ds[0])
+        self.assertEqual(len(responses), 3)
+
+        responses[0].errback(RuntimeError())
+        self.failureResultOf(ds[0], RuntimeError)
+        responses[2].callback({"TOKEN": "4"})
+        self.assertEqual(self.successResultOf(ds[3]).token, "4")
+
+
+    def test_createCheckoutsCancelled(self):
+        """
+        Tests that cancelling one checkout of a batch cancels or skips it,
+        and that the other checkouts are still created.
+        """
+        responses = []
+        def makeRequest(pairs, method, deadline=None):
+            d = defer.Deferred()
+            responses.append(d)
+            return d
+        self.client.agent.makeRequest.side_effect = makeRequest
+
+        ds = self.client.createCheckouts([[emptyPaymentRequest]] * 4,
+                                         concurrency=1)
+        ds[0].cancel()
+        self.failureResultOf(ds[0], defer.CancelledError)
+        self.assertTrue(responses[0].called)
+        self.assertEqual(len(responses), 2)
+
+        ds[2].cancel()
+        self.failureResultOf(ds[2], defer.CancelledError)
+        responses[1].callback({"TOKEN": "2"})
+        self.assertEqual(self.successResultOf(ds[1]).token, "2")
+        self.assertEqual(len(responses), 3)
+
+        responses[2].callback({"TOKEN": "4"})
+        self.assertEqual(self.successResultOf(ds[3]).token, "4")
+
+
+    def test_createCheckoutsFailingFast(self):
+        """
+        Tests that many carts failing before any call is made don't exhaust
+        the stack.
+        """
+        numRequests = self.client.MAX_PAYMENT_REQUESTS + 1
+        tooMany = [emptyPaymentRequest] * numRequests
+        ds = self.client.createCheckouts([tooMany] * 5000, concurrency=1)
+        for d in ds:
+            self.failureResultOf(d, ValueError)
+        self.assertFalse(self.client.agent.makeRequest.called)
+
+
+    def test_createCheckoutsTimeout(self):
+        """
+        Tests that all checkouts in a batch share a deadline.
+        """
+        self.client.clock = task.Clock()
+        self.client.clock.advance(100)
+        self.client.agent.makeRequest.side_effect = \
+            lambda *args, **kwargs: defer.succeed({"TOKEN": "1"})
+        carts = [[emptyPaymentRequest]] * 2
+        self.client.createCheckouts(carts, timeout=5)
+
+        calls = self.client.agent.makeRequest.call_args_list
+        self.assertEqual([kwargs["deadline"] for _, kwargs in calls],
+                         [105, 105])
+
+
+
+class DetailsCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = cache.DetailsCache()
+        self.client = api.Client(defaultCredentials, "http://r", "http://c",
+                                 detailsCache=self.cache)
+        self.client.agent = mock.Mock()
+        self.client.agent.makeRequest.side_effect = self._makeRequest
+        self.responses = []
+
+
+    def _makeRequest(self, pairs, method, deadline=None):
+        d = defer.Deferred()
+        self.responses.append((method, d))
+        return d
+
+
+    def _getDetails(self):
+        d = self.client.getCheckoutDetails("1")
+        if not d.called:
+            self.responses[-1][1].callback({"PAYERID": "2"})
+        return self.successResultOf(d)
+
+
+    def test_cached(self):
+        first, second = self._getDetails(), self._getDetails()
+        self.assertEqual(first, {"PAYERID": "2"})
+        self.assertIdentical(first, second)
+        self.assertEqual(len(self.responses), 1)
+        self.assertEqual(self.cache.hits, 1)
+
+
+    def test_failuresNotCached(self):
+        d = self.client.getCheckoutDetails("1")
+        self.responses[0][1].errback(RuntimeError())
+        self.failureResultOf(d, RuntimeError)
+        self.assertEqual(len(self.cache), 0)
+
+
+    def test_completeInvalidates(self):
+        self._getDetails()
+        d = self.client.completeCheckout("1", "2", [])
+        self.assertEqual(len(self.cache), 0)
+
+        self.cache.set("1", {"PAYERID": "2"})
+        self.responses[-1][1].callback({"ACK": "Success"})
+        self.successResultOf(d)
+        self.assertEqual(len(self.cache), 0)
+
+
+    def test_fetchInterleavedWithComplete(self):
+        """
+        Tests that details fetched before or while completing aren't cached
+        when they arrive after completing.
+        """
+        before = self.client.getCheckoutDetails("1")
+        complete = self.client.completeCheckout("1", "2", [])
+        during = self.client.getCheckoutDetails("2")
+        self.client.completeCheckout("2", "2", [])
+
+        self.responses[1][1].callback({"ACK": "Success"})
+        self.responses[0][1].callback({"PAYERID": "stale"})
+        self.responses[2][1].callback({"PAYERID": "stale"})
+        self.successResultOf(complete)
+        self.assertEqual(self.successResultOf(before), {"PAYERID": "stale"})
+        self.successResultOf(during)
+        self.assertEqual(len(self.cache), 0)
+
+        self._getDetails()
+        self.assertEqual(len(self.cache), 1)
+
+
 
 class CheckoutTest(unittest.TestCase):
     def test_getDetails(self):
@@ -99,6 +454,48 @@ class CheckoutTest(unittest.TestCase):
         self.assertEqual(token, expectedToken)
 
 
+    def test_complete(self):
+        client = mock.Mock()
+        details, response = {"PAYERID": "2"}, {"ACK": "Success"}
+        client.getCheckoutDetails.return_value = defer.succeed(details)
+        client.completeCheckout.return_value = defer.succeed(response)
+        requests = [emptyPaymentRequest]
+        checkout = api.Checkout(client, "1", requests)
+
+        client.deadlineFor.return_value = None
+        d = checkout.complete()
+        self.assertEqual(self.successResultOf(d), {"ACK": "Success"})
+        client.completeCheckout.assert_called_once_with("1", "2", requests,
+                                                        None)
+
+
+    def test_completeTimeout(self):
+        """
+        Tests that getting the details and completing share a deadline.
+        """
+        client = mock.Mock()
+        client.deadlineFor.return_value = 15
+        client.getCheckoutDetails.return_value = defer.succeed({"PAYERID": 2})
+        checkout = api.Checkout(client, "1", [])
+        checkout.complete(timeout=5)
+
+        client.deadlineFor.assert_called_once_with(5)
+        client.getCheckoutDetails.assert_called_once_with("1", 15)
+        client.completeCheckout.assert_called_once_with("1", 2, [], 15)
+
+
+    def test_completeChanged(self):
+        client = mock.Mock()
+        details = {"PAYERID": "2"}
+        client.getCheckoutDetails.return_value = defer.succeed(details)
+        client.deadlineFor.return_value = None
+        checkout = api.Checkout(client, "1", [])
+        newRequests = [emptyPaymentRequest]
+        checkout.complete(newRequests)
+        client.completeCheckout.assert_called_once_with("1", "2", newRequests,
+                                                        None)
+
+
 
 class ItemTest(unittest.TestCase):
     def setUp(self):
@@ -149,42 +546,51 @@ class ItemAmountQuantizationTest(unittest.TestCase):
 
 
 class PaymentRequestItemAmountTest(unittest.TestCase):
+    paymentRequestClass, itemClass = api.PaymentRequest, api.Item
+
     def test_empty(self):
-        paymentRequest = api.PaymentRequest([])
+        paymentRequest = self.paymentRequestClass([])
         self.assertEqual(paymentRequest.itemAmount, decimal.Decimal("0"))
 
 
     def test_oneItem(self):
-        item = api.Item("Cookie", "100.00")
-        paymentRequest = api.PaymentRequest([(item, 1)])
+        item = self.itemClass("Cookie", "100.00")
+        paymentRequest = self.paymentRequestClass([(item, 1)])
         self.assertEqual(paymentRequest.itemAmount, decimal.Decimal("100.00"))
 
 
     def test_twoItems(self):
-        item = api.Item("Cookie", "100.00")
-        paymentRequest = api.PaymentRequest([(item, 2)])
+        item = self.itemClass("Cookie", "100.00")
+        paymentRequest = self.paymentRequestClass([(item, 2)])
         self.assertEqual(paymentRequest.itemAmount, decimal.Decimal("200.00"))
 
 
     def test_combinedItems(self):
-        itemOne = api.Item("Cookie", "100.00")
-        itemTwo = api.Item("Cake", "200.00")
-        paymentRequest = api.PaymentRequest([(itemOne, 1), (itemTwo, 1)])
+        itemOne = self.itemClass("Cookie", "100.00")
+        itemTwo = self.itemClass("Cake", "200.00")
+        paymentRequest = self.paymentRequestClass([(itemOne, 1), (itemTwo, 1)])
         self.assertEqual(paymentRequest.itemAmount, decimal.Decimal("300.00"))
 
 
 
+class CompactPaymentRequestItemAmountTest(PaymentRequestItemAmountTest):
+    paymentRequestClass, itemClass = (api.CompactPaymentRequest,
+                                      api.CompactItem)
+
+
+
 class CombinedAmountTest(object):
     amountName = totalAmountName = None
+    paymentRequestClass, itemClass = api.PaymentRequest, api.Item
 
     def setUp(self):
-        self.paymentRequest = api.PaymentRequest([])
+        self.paymentRequest = self.paymentRequestClass([])
 
-        self.highAmountItem = api.Item("Cookie", "100.00")
+        self.highAmountItem = self.itemClass("Cookie", "100.00")
         self.highAmount = decimal.Decimal("100.0")
         setattr(self.highAmountItem, self.amountName, self.highAmount)
 
-        self.lowAmountItem = api.Item("Cookie", "100.00")
+        self.lowAmountItem = self.itemClass("Cookie", "100.00")
         self.lowAmount = decimal.Decimal("10.0")
         setattr(self.lowAmountItem, self.amountName, self.lowAmount)
 
@@ -253,4 +659,152 @@ class TaxAmountTest(CombinedAmountTest, unittest.TestCase):
     Tests if the shipping amount for a payment request is correctly computed.
     """
     amountName = "taxAmount"
-    totalAmountName = "totalTaxAmount"
\ No newline at end of file
+    totalAmountName = "totalTaxAmount"
+
+
+
+class CompactHandlingAmountTest(HandlingAmountTest):
+    paymentRequestClass, itemClass = (api.CompactPaymentRequest,
+                                      api.CompactItem)
+
+
+
+class CompactShippingAmountTest(ShippingAmountTest):
+    paymentRequestClass, itemClass = (api.CompactPaymentRequest,
+                                      api.CompactItem)
+
+
+
+class CompactTaxAmountTest(TaxAmountTest):
+    paymentRequestClass, itemClass = (api.CompactPaymentRequest,
+                                      api.CompactItem)
+
+
+
+class CompactItemTest(ItemTest):
+    def setUp(self):
+        self.item = api.CompactItem("Cookie", decimal.Decimal("100.00"))
+
+
+    def test_slots(self):
+        self.assertFalse(hasattr(self.item, "__dict__"))
+        self.assertTrue(interface.IItem.providedBy(self.item))
+
+
+    def test_quantization(self):
+        item = api.CompactItem("Cookie", decimal.Decimal("100.129"))
+        self.assertEqual(item.amount, decimal.Decimal("100.13"))
+        item.amount = "1.005"
+        self.assertEqual(item.amount, decimal.Decimal("1.00"))
+
+
+
+class CompactPaymentRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.item = api.CompactItem("Cookie", "10.00")
+        self.paymentRequest = api.CompactPaymentRequest([(self.item, 2)])
+
+
+    def test_slots(self):
+        self.assertFalse(hasattr(self.paymentRequest, "__dict__"))
+
+
+    def test_cached(self):
+        """
+        Tests that the totals are only computed once.
+        """
+        self.assertEqual(self.paymentRequest.totalAmount,
+                         decimal.Decimal("20.00"))
+        totals = self.paymentRequest._totals
+        self.paymentRequest.itemAmount
+        self.paymentRequest.totalTaxAmount
+        self.assertIdentical(self.paymentRequest._totals, totals)
+
+
+    def test_itemDetailsChanged(self):
+        self.paymentRequest.totalAmount
+        other = api.CompactItem("Cake", "1.00")
+        self.paymentRequest.itemDetails = [(self.item, 1), (other, 3)]
+        self.assertEqual(self.paymentRequest.totalAmount,
+                         decimal.Decimal("13.00"))
+
+
+    def test_itemDetailsImmutable(self):
+        itemDetails = [(self.item, 1)]
+        paymentRequest = api.CompactPaymentRequest(itemDetails)
+        itemDetails.append((self.item, 1))
+        self.assertEqual(paymentRequest.itemAmount, decimal.Decimal("10.00"))
+
+
+    def test_itemAmountChanged(self):
+        self.paymentRequest.totalAmount
+        self.item.amount = "5.00"
+        self.assertEqual(self.paymentRequest.totalAmount,
+                         decimal.Decimal("10.00"))
+        self.item.taxAmount = decimal.Decimal("1.00")
+        self.assertEqual(self.paymentRequest.totalAmount,
+                         decimal.Decimal("11.00"))
+
+
+    def test_otherItemAmountChanged(self):
+        """
+        Tests that changing an item only invalidates the totals of the
+        payment requests it is in.
+        """
+        self.paymentRequest.totalAmount
+        totals = self.paymentRequest._totals
+        other = api.CompactItem("Cake", "1.00")
+        otherRequest = api.CompactPaymentRequest([(other, 1), (self.item, 1)])
+        other.amount = "2.00"
+        self.assertIdentical(self.paymentRequest._totals, totals)
+        self.assertEqual(self.paymentRequest.totalAmount,
+                         decimal.Decimal("20.00"))
+        self.assertIdentical(self.paymentRequest._totals, totals)
+        self.assertEqual(otherRequest.totalAmount, decimal.Decimal("12.00"))
+
+
+    def test_removedItemAmountChanged(self):
+        """
+        Tests that changing an item no longer invalidates the totals of a
+        payment request it was removed from.
+        """
+        other = api.CompactItem("Cake", "1.00")
+        self.paymentRequest.itemDetails = [(other, 1)]
+        self.paymentRequest.totalAmount
+        totals = self.paymentRequest._totals
+        self.item.amount = "5.00"
+        self.assertIdentical(self.paymentRequest._totals, totals)
+
+
+    def test_itemsNotVisited(self):
+        """
+        Tests that reading cached totals doesn't look at the items.
+        """
+        self.paymentRequest.totalAmount
+        self.paymentRequest._itemDetails = None
+        self.assertEqual(self.paymentRequest.totalAmount,
+                         decimal.Decimal("20.00"))
+
+
+    def test_requestNotKeptAlive(self):
+        ref = weakref.ref(self.paymentRequest)
+        del self.paymentRequest
+        gc.collect()
+        self.assertIdentical(ref(), None)
+        self.item.amount = "5.00"
+
+
+    def test_requestAmountChanged(self):
+        self.paymentRequest.totalAmount
+        self.paymentRequest.shippingAmount = decimal.Decimal("4.00")
+        self.assertEqual(self.paymentRequest.totalAmount,
+                         decimal.Decimal("24.00"))
+        self.assertEqual(self.paymentRequest.totalShippingAmount,
+                         decimal.Decimal("4.00"))
+
+
+    def test_encoded(self):
+        pairs = encodePaymentRequests(self.paymentRequest)
+        self.assertEqual(pairs[:2],
+                         [("PAYMENTREQUEST_0_PAYMENTACTION", interface.SALE),
+                          ("PAYMENTREQUEST_0_AMT", decimal.Decimal("20.00"))])
@@ -0,0 +1,150 @@
+"""
+Tests for caching Express Checkout API responses.
+"""
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from txievery.expresscheckout import cache
+
+
+class DetailsCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = cache.DetailsCache(maxSize=2, ttl=10, clock=self.clock)
+
+
+    def test_miss(self):
+        self.assertIdentical(self.cache.get("1"), None)
+        self.assertEqual(self.cache.statistics,
+                         {"hits": 0, "misses": 1, "size": 0})
+
+
+    def test_hit(self):
+        details = {"TOKEN": "1"}
+        self.cache.set("1", details)
+        self.assertIdentical(self.cache.get("1"), details)
+        self.assertEqual(self.cache.statistics,
+                         {"hits": 1, "misses": 0, "size": 1})
+
+
+    def test_expiry(self):
+        self.cache.set("1", {})
+        self.clock.advance(9)
+        self.assertEqual(self.cache.get("1"), {})
+        self.clock.advance(1)
+        self.assertIdentical(self.cache.get("1"), None)
+        self.assertEqual(len(self.cache), 0)
+
+
+    def test_setResetsExpiry(self):
+        self.cache.set("1", {})
+        self.clock.advance(9)
+        self.cache.set("1", {"A": "B"})
+        self.clock.advance(9)
+        self.assertEqual(self.cache.get("1"), {"A": "B"})
+
+
+    def test_leastRecentlyUsedEvicted(self):
+        self.cache.set("1", {})
+        self.cache.set("2", {})
+        self.cache.get("1")
+        self.cache.set("3", {})
+        self.assertEqual(len(self.cache), 2)
+        self.assertIdentical(self.cache.get("2"), None)
+        self.assertEqual(self.cache.get("1"), {})
+        self.assertEqual(self.cache.get("3"), {})
+
+
+    def test_invalidate(self):
+        self.cache.set("1", {})
+        self.cache.invalidate("1")
+        self.cache.invalidate("2")
+        self.assertIdentical(self.cache.get("1"), None)
+
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.singleFlight = cache.SingleFlight()
+        self.calls = []
+
+
+    def _call(self, key):
+        d = defer.Deferred()
+        self.calls.append((key, d))
+        return d
+
+
+    def test_coalesced(self):
+        first = self.singleFlight.call("1", self._call, "1")
+        second = self.singleFlight.call("1", self._call, "1")
+        self.assertEqual(len(self.calls), 1)
+        self.assertNotIdentical(first, second)
+
+        self.calls[0][1].callback("result")
+        self.assertEqual(self.successResultOf(first), "result")
+        self.assertEqual(self.successResultOf(second), "result")
+        self.assertEqual(len(self.singleFlight), 0)
+
+
+    def test_differentKeys(self):
+        self.singleFlight.call("1", self._call, "1")
+        self.singleFlight.call("2", self._call, "2")
+        self.assertEqual([key for key, _ in self.calls], ["1", "2"])
+
+
+    def test_notCoalescedAfterwards(self):
+        self.singleFlight.call("1", self._call, "1")
+        self.calls[0][1].callback("result")
+        self.singleFlight.call("1", self._call, "1")
+        self.assertEqual(len(self.calls), 2)
+
+
+    def test_failure(self):
+        first = self.singleFlight.call("1", self._call, "1")
+        second = self.singleFlight.call("1", self._call, "1")
+        self.calls[0][1].errback(RuntimeError())
+        self.failureResultOf(first, RuntimeError)
+        self.failureResultOf(second, RuntimeError)
+
+
+    def test_failureCopies(self):
+        """
+        Tests that every caller gets its own failure, which it can handle
+        without affecting the others.
+        """
+        first = self.singleFlight.call("1", self._call, "1")
+        second = self.singleFlight.call("1", self._call, "1")
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            self.calls[0][1].errback()
+
+        @first.addErrback
+        def annotate(reason):
+            reason.frames = []
+            return reason
+
+        firstReason = self.failureResultOf(first, ZeroDivisionError)
+        reason = self.failureResultOf(second, ZeroDivisionError)
+        self.assertNotIdentical(reason, firstReason)
+        self.assertNotEqual(reason.frames, [])
+
+
+    def test_synchronous(self):
+        d = self.singleFlight.call("1", lambda: 1 / 0)
+        self.failureResultOf(d, ZeroDivisionError)
+        d = self.singleFlight.call("1", lambda: "result")
+        self.assertEqual(self.successResultOf(d), "result")
+        self.assertEqual(len(self.singleFlight), 0)
+
+
+    def test_cancelOne(self):
+        first = self.singleFlight.call("1", self._call, "1")
+        second = self.singleFlight.call("1", self._call, "1")
+        first.cancel()
+        self.failureResultOf(first, defer.CancelledError)
+        self.assertFalse(self.calls[0][1].called)
+
+        self.calls[0][1].callback("result")
+        self.assertEqual(self.successResultOf(second), "result")
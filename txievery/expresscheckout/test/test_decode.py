@@ -2,10 +2,11 @@
 Tests for decoding NVP data to objects.
 """
 import decimal
+import urllib
 
 from twisted.trial import unittest
 
-from txievery.expresscheckout import decode
+from txievery.expresscheckout import decode, nvp
 
 
 exampleDetails = {'PAYMENTREQUEST_0_AMT': "100.00",
@@ -25,28 +26,94 @@ skippedItemDetails = {'L_PAYMENTREQUEST_0_AMT5': "100.00"}
 
 
 
+def decodeItemDetails(details, requestIndex):
+    _, itemBuckets = decode._bucketFields(details)[requestIndex]
+    return decode._decodeItemDetails(itemBuckets)
+
+
+
+class BucketFieldsTest(unittest.TestCase):
+    """
+    Tests for sorting fields by payment request and item.
+    """
+    def test_buckets(self):
+        buckets = decode._bucketFields(exampleDetails)
+        self.assertEqual(sorted(buckets), [0, 1])
+
+        requestFields, itemBuckets = buckets[1]
+        self.assertEqual(requestFields, {"AMT": "300200.00"})
+        self.assertEqual(itemBuckets[1], {"QTY": "3",
+                                          "AMT": "100000.00",
+                                          "ITEMCATEGORY": "Physical"})
+
+
+    def test_pairs(self):
+        """
+        Tests that details can also be an iterable of pairs.
+        """
+        pairs = exampleDetails.items()
+        self.assertEqual(decode._bucketFields(pairs),
+                         decode._bucketFields(exampleDetails))
+
+
+    def test_otherFields(self):
+        details = {"TOKEN": "1",
+                   "PAYMENTREQUEST_0_SHIPTOSTREET2": "Main St",
+                   "L_PAYMENTREQUEST_X_AMT0": "1.00"}
+        requestFields, itemBuckets = decode._bucketFields(details)[0]
+        self.assertEqual(requestFields, {"SHIPTOSTREET2": "Main St"})
+        self.assertEqual(itemBuckets, {})
+
+
+    def test_manyItems(self):
+        details = {"L_PAYMENTREQUEST_0_AMT12": "1.00"}
+        _, itemBuckets = decode._bucketFields(details)[0]
+        self.assertEqual(itemBuckets, {12: {"AMT": "1.00"}})
+
+
+
 class DecodeItemDetailsTest(unittest.TestCase):
     """
     Tests for decoding all the item details from payment request details.
     """
     def test_single(self):
-        details = decode._decodeItemDetails(exampleDetails, 0)
+        details = decodeItemDetails(exampleDetails, 0)
         self.assertEqual(len(details), 1)
 
 
     def test_multiple(self):
-        details = decode._decodeItemDetails(exampleDetails, 1)
+        details = decodeItemDetails(exampleDetails, 1)
         self.assertEqual(len(details), 2)
 
 
 
+class DecodePaymentRequestsTest(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual(decode._decodePaymentRequests({}), [])
+
+
+    def test_requests(self):
+        requests = decode._decodePaymentRequests(exampleDetails)
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(requests[1].totalAmount,
+                         decimal.Decimal("300200.00"))
+
+
+    def test_lazyResponse(self):
+        response = nvp.LazyResponse(urllib.urlencode(exampleDetails))
+        requests = decode._decodePaymentRequests(response)
+        self.assertEqual(requests[1].totalAmount,
+                         decimal.Decimal("300200.00"))
+
+
+
 class DecodeItemTest(unittest.TestCase):
     """
     Tests for decoding a single item from payment request details.
     """
     def _decode(self, requestIdx, itemIdx):
-        template = "L_PAYMENTREQUEST_%s_{key}%s" % (requestIdx, itemIdx)
-        return decode._decodeItem(exampleDetails, template.format)
+        _, itemBuckets = decode._bucketFields(exampleDetails)[requestIdx]
+        return decode._decodeItem(itemBuckets[itemIdx])
 
 
     def test_single(self):
@@ -68,13 +135,19 @@ class DecodeItemTest(unittest.TestCase):
         self.assertEqual(item.category, "Physical")
 
 
+    def test_category(self):
+        item, _ = decode._decodeItem({"QTY": "1", "AMT": "1.00",
+                                      "ITEMCATEGORY": "Digital"})
+        self.assertEqual(item.category, "Digital")
+
+
 
 class LastElementTest(unittest.TestCase):
     def test_skippedItem(self):
         def skippedItem():
             details = exampleDetails.copy()
             details.update(skippedItemDetails)
-            return decode._decodeItemDetails(details, 0)
+            return decodeItemDetails(details, 0)
         self.assertRaises(ValueError, skippedItem)
 
 
@@ -83,4 +156,11 @@ class LastElementTest(unittest.TestCase):
             details = exampleDetails.copy()
             details.update(skippedRequestDetails)
             return decode._decodePaymentRequests(details)
-        self.assertRaises(ValueError, skippedRequest)
\ No newline at end of file
+        self.assertRaises(ValueError, skippedRequest)
+
+
+    def test_skippedFirst(self):
+        details = {"PAYMENTREQUEST_1_AMT": "1.00"}
+        e = self.assertRaises(ValueError,
+                              decode._decodePaymentRequests, details)
+        self.assertEqual(str(e), "Element at index 1 after empty index 0")
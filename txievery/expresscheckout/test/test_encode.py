@@ -5,7 +5,7 @@ import decimal
 
 from twisted.trial import unittest
 
-from txievery.expresscheckout import api
+from txievery.expresscheckout import api, encode
 from txievery.expresscheckout.encode import encodePaymentRequests, _encodeItem
 
 
@@ -93,13 +93,36 @@ class RequestEncodingTest(unittest.TestCase):
         self.assertEqual(list(encoded), expected)
 
 
+    def test_lastRequest(self):
+        """
+        Tests encoding the maximum number of payment requests.
+        """
+        requests = [self.singleItemRequest] * encode.MAX_PAYMENT_REQUESTS
+        encoded = encodePaymentRequests(*requests)
+        category = self.items[0].category
+        expected = [('PAYMENTREQUEST_9_PAYMENTACTION', 'Sale'),
+                    ('PAYMENTREQUEST_9_AMT', decimal.Decimal('100.00')),
+                    ('L_PAYMENTREQUEST_9_QTY0', 1),
+                    ('L_PAYMENTREQUEST_9_AMT0', decimal.Decimal('100.00')),
+                    ('L_PAYMENTREQUEST_9_ITEMCATEGORY0', category),
+                    ('L_PAYMENTREQUEST_9_NAME0', 'Cake')]
+        self.assertEqual(encoded[-6:], expected)
+
+
+    def test_tooManyRequests(self):
+        requests = [self.singleItemRequest] * (encode.MAX_PAYMENT_REQUESTS + 1)
+        e = self.assertRaises(ValueError, encodePaymentRequests, *requests)
+        self.assertIn(str(encode.MAX_PAYMENT_REQUESTS), str(e))
+
+
         
 class ItemEncodingTest(unittest.TestCase):
     items = [CHEAP_ITEM, EXPENSIVE_ITEM]
 
     def _testEncode(self, index, item, qty, expected):
-        encoded = _encodeItem("PAYMENTREQUEST_0_{0}", index, item, qty)
-        self.assertEqual(list(encoded), expected)
+        encoded = []
+        _encodeItem(encoded, 0, index, item, qty)
+        self.assertEqual(encoded, expected)
 
         
     def test_one(self):
@@ -123,4 +146,17 @@ class ItemEncodingTest(unittest.TestCase):
                     ('L_PAYMENTREQUEST_0_AMT0', decimal.Decimal('100.00')),
                     ('L_PAYMENTREQUEST_0_ITEMCATEGORY0', expectedCategory),
                     ('L_PAYMENTREQUEST_0_NAME0', 'Cake')]
-        self._testEncode(0, self.items[0], 10, expected)
\ No newline at end of file
+        self._testEncode(0, self.items[0], 10, expected)
+
+
+    def test_beyondPrecomputed(self):
+        """
+        Tests encoding an item with an index beyond the precomputed ones.
+        """
+        index = encode.PRECOMPUTED_ITEMS + 5
+        expectedCategory = self.items[1].category
+        expected = [('L_PAYMENTREQUEST_0_QTY15', 1),
+                    ('L_PAYMENTREQUEST_0_AMT15', decimal.Decimal('100000.00')),
+                    ('L_PAYMENTREQUEST_0_ITEMCATEGORY15', expectedCategory),
+                    ('L_PAYMENTREQUEST_0_NAME15', 'Diamond')]
+        self._testEncode(index, self.items[1], 1, expected)
\ No newline at end of file
@@ -0,0 +1,321 @@
+"""
+Tests for adaptive concurrency limits and circuit breakers.
+"""
+from twisted.internet import defer, error, task
+from twisted.trial import unittest
+
+from txievery.expresscheckout import limits, nvp
+from txievery.expresscheckout.test.test_scheduler import FakeAgent
+
+
+class AIMDLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.limit = limits.AIMDLimit(initial=10, minimum=2, maximum=12,
+                                      latencyThreshold=1.0,
+                                      decreaseFactor=0.5)
+        self.changes = []
+        self.limit.addObserver(lambda *change: self.changes.append(change))
+
+
+    def test_increase(self):
+        self.assertEqual(self.limit.update(0.5, True, 5), 11)
+        self.assertEqual(self.changes, [(10, 11)])
+
+
+    def test_notIncreasedWhenUnderused(self):
+        self.assertEqual(self.limit.update(0.5, True, 4), 10)
+        self.assertEqual(self.changes, [])
+
+
+    def test_maximum(self):
+        for _ in range(5):
+            self.limit.update(0.5, True, 10)
+        self.assertEqual(self.limit.limit, 12)
+
+
+    def test_slow(self):
+        self.assertEqual(self.limit.update(1.5, True, 10), 5)
+        self.assertEqual(self.changes, [(10, 5)])
+
+
+    def test_failed(self):
+        self.assertEqual(self.limit.update(0.1, False, 10), 5)
+
+
+    def test_minimum(self):
+        for _ in range(5):
+            self.limit.update(0.1, False, 10)
+        self.assertEqual(self.limit.limit, 2)
+
+
+    def test_burstOfSlowCalls(self):
+        """
+        Tests that many slow calls made under the same limit only shrink it
+        once, and that calls made after that can shrink it again.
+        """
+        for _ in range(10):
+            self.limit.update(1.5, True, 10, startedAt=100)
+        self.assertEqual(self.limit.limit, 5)
+        self.limit.update(0.5, False, 5, startedAt=101)
+        self.assertEqual(self.limit.limit, 5)
+
+        self.limit.update(1.5, True, 5, startedAt=101.5)
+        self.assertEqual(self.changes, [(10, 5), (5, 2)])
+
+
+    def test_removeObserver(self):
+        observer = lambda *change: self.fail("Observer called")
+        self.limit.addObserver(observer)
+        self.limit.removeObserver(observer)
+        self.limit.update(0.5, True, 10)
+        self.assertEqual(self.changes, [(10, 11)])
+
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.breaker = limits.CircuitBreaker(failureThreshold=2,
+                                             resetTimeout=10,
+                                             clock=self.clock)
+        self.transitions = []
+        self.breaker.addObserver(
+            lambda *transition: self.transitions.append(transition))
+        self.agent = FakeAgent()
+        self.breakingAgent = limits.BreakingAgent(self.agent, self.breaker)
+
+
+    def _call(self):
+        return self.breakingAgent.makeRequest([("TOKEN", "1")], "Method")
+
+
+    def _cancel(self):
+        d = self._call()
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+
+
+    def _fail(self):
+        d = self._call()
+        self.agent.calls[-1][2].errback(error.ConnectionLost())
+        self.failureResultOf(d, error.ConnectionLost)
+
+
+    def _succeed(self):
+        d = self._call()
+        self.agent.calls[-1][2].callback({"ACK": "Success"})
+        self.assertEqual(self.successResultOf(d), {"ACK": "Success"})
+
+
+    def _open(self):
+        self._fail()
+        self._fail()
+        self.assertEqual(self.breaker.state, limits.OPEN)
+
+
+    def test_closed(self):
+        self._fail()
+        self._succeed()
+        self._fail()
+        self.assertEqual(self.breaker.state, limits.CLOSED)
+        self.assertEqual(self.transitions, [])
+        self.assertEqual(self.agent.calls[0][:2], ("Method", [("TOKEN", "1")]))
+
+
+    def test_open(self):
+        self._open()
+        self.assertEqual(self.transitions, [(limits.CLOSED, limits.OPEN)])
+
+        d = self._call()
+        self.failureResultOf(d, limits.CircuitOpenError)
+        self.assertEqual(len(self.agent.calls), 2)
+        self.assertEqual(self.breaker.statistics,
+                         {"state": limits.OPEN, "failures": 2,
+                          "rejected": 1})
+
+
+    def test_halfOpen(self):
+        self._open()
+        self.clock.advance(10)
+        probe = self._call()
+        self.assertEqual(self.breaker.state, limits.HALF_OPEN)
+        self.assertEqual(len(self.agent.calls), 3)
+
+        self.failureResultOf(self._call(), limits.CircuitOpenError)
+        self.assertEqual(len(self.agent.calls), 3)
+
+        self.agent.calls[-1][2].callback({})
+        self.successResultOf(probe)
+        self.assertEqual(self.breaker.state, limits.CLOSED)
+        self.assertEqual(self.transitions,
+                         [(limits.CLOSED, limits.OPEN),
+                          (limits.OPEN, limits.HALF_OPEN),
+                          (limits.HALF_OPEN, limits.CLOSED)])
+
+
+    def test_failedProbe(self):
+        self._open()
+        self.clock.advance(10)
+        self._fail()
+        self.assertEqual(self.breaker.state, limits.OPEN)
+
+        self.clock.advance(9)
+        self.failureResultOf(self._call(), limits.CircuitOpenError)
+        self.clock.advance(1)
+        self._succeed()
+        self.assertEqual(self.breaker.state, limits.CLOSED)
+
+
+    def test_cancelled(self):
+        """
+        Tests that cancelled calls don't count as failures.
+        """
+        for _ in range(2):
+            self._cancel()
+        self.assertEqual(self.breaker.state, limits.CLOSED)
+        self.assertEqual(self.breaker.failures, 0)
+
+
+    def test_cancelledProbe(self):
+        self._open()
+        self.clock.advance(10)
+        self._cancel()
+        self.assertEqual(self.breaker.state, limits.HALF_OPEN)
+        self._succeed()
+        self.assertEqual(self.breaker.state, limits.CLOSED)
+
+
+    def test_lateFailureWhileOpen(self):
+        """
+        Tests that calls made before the breaker opened that fail later
+        don't postpone probing.
+        """
+        late = self._call()
+        self._open()
+        self.clock.advance(5)
+        self.agent.calls[0][2].errback(error.ConnectionLost())
+        self.failureResultOf(late)
+
+        self.clock.advance(5)
+        self._succeed()
+        self.assertEqual(self.breaker.state, limits.CLOSED)
+
+
+    def test_deadlinePassedOn(self):
+        self.breakingAgent.makeRequest([], "Method", deadline=10)
+        self.assertEqual(self.agent.deadlines, [10])
+
+
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.bucket = limits.TokenBucket(2, 3, self.clock)
+
+
+    def test_burst(self):
+        for _ in range(3):
+            self.assertTrue(self.bucket.take())
+        self.assertFalse(self.bucket.take())
+        self.assertEqual(self.bucket.delay(), 0.5)
+
+
+    def test_refill(self):
+        for _ in range(3):
+            self.bucket.take()
+        self.clock.advance(0.5)
+        self.assertEqual(self.bucket.delay(), 0)
+        self.assertTrue(self.bucket.take())
+        self.assertFalse(self.bucket.take())
+
+        self.clock.advance(100)
+        self.assertEqual(self.bucket.tokens, 0)
+        self.bucket.take()
+        self.assertEqual(self.bucket.tokens, 2)
+
+
+    def test_defaultBurst(self):
+        self.assertEqual(limits.TokenBucket(5).burst, 5)
+        self.assertEqual(limits.TokenBucket(0.5).burst, 1)
+
+
+
+class RateLimitedAgentTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.agent = FakeAgent()
+        bucket = limits.TokenBucket(2, 2, self.clock)
+        self.limitedAgent = limits.RateLimitedAgent(self.agent, bucket,
+                                                    self.clock)
+
+
+    def _call(self, deadline=None):
+        return self.limitedAgent.makeRequest([("TOKEN", "1")], "Method",
+                                             deadline)
+
+
+    def test_immediate(self):
+        d = self._call(10)
+        self.assertEqual(self.agent.calls[0][:2], ("Method", [("TOKEN", "1")]))
+        self.assertEqual(self.agent.deadlines, [10])
+        self.agent.calls[0][2].callback({"ACK": "Success"})
+        self.assertEqual(self.successResultOf(d), {"ACK": "Success"})
+
+
+    def test_limited(self):
+        for _ in range(5):
+            self._call()
+        self.assertEqual(len(self.agent.calls), 2)
+        self.assertEqual(self.limitedAgent.queueDepth, 3)
+
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.agent.calls), 3)
+        self.clock.advance(1)
+        self.assertEqual(len(self.agent.calls), 5)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_cancelQueued(self):
+        for _ in range(2):
+            self._call()
+        d = self._call()
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.limitedAgent.queueDepth, 0)
+
+        self._call()
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.agent.calls), 3)
+
+
+    def test_cancelledDropped(self):
+        """
+        Tests that cancelled and expired calls are dropped from the queue,
+        without waiting for a token.
+        """
+        for _ in range(2):
+            self._call()
+        ds = [self._call(deadline=0.25) for _ in range(100)]
+        for d in ds[:50]:
+            d.cancel()
+        self.clock.advance(0.25)
+        for d in ds:
+            self.failureResultOf(d)
+        self.assertEqual(self.limitedAgent.queueDepth, 0)
+        self.assertEqual(len(self.limitedAgent._queue), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        self._call()
+        self.assertEqual(self.limitedAgent.queueDepth, 1)
+        self.clock.advance(0.25)
+        self.assertEqual(len(self.agent.calls), 3)
+
+
+    def test_deadline(self):
+        for _ in range(2):
+            self._call()
+        d = self._call(deadline=0.25)
+        self.clock.advance(0.25)
+        self.failureResultOf(d, nvp.NVPTimeoutError)
+        self.clock.advance(1)
+        self.assertEqual(len(self.agent.calls), 2)
@@ -0,0 +1,105 @@
+"""
+Tests for integer-cents amounts of money.
+"""
+import decimal
+import urllib
+
+from twisted.trial import unittest
+
+from txievery.expresscheckout import api, money
+from txievery.expresscheckout.encode import encodePaymentRequests
+
+
+class MoneyTest(unittest.TestCase):
+    def test_fromAmount(self):
+        self.assertEqual(money.Money.fromAmount("1.99").cents, 199)
+        self.assertEqual(money.Money.fromAmount(3).cents, 300)
+        self.assertEqual(money.Money.fromAmount("-0.5").cents, -50)
+
+
+    def test_rounding(self):
+        """
+        Tests that amounts are rounded exactly like ``Decimal`` amounts.
+        """
+        for amount in ["100.129", "100.12345", "1.005", "1.015", "0.004",
+                       "-2.675", decimal.Decimal("12345678901234.565"),
+                       "1", "1.5", "-1.5", "-0.05", "007.10", 12, -3, 1.1,
+                       "1e2", " 1.50", u"2.50"]:
+            expected = api._twoDecimalPlaces(amount)
+            cents = money.Money.fromAmount(amount)
+            self.assertEqual(cents.toDecimal(), expected)
+            self.assertEqual(str(cents), str(expected))
+
+
+    def test_str(self):
+        self.assertEqual(str(money.Money(0)), "0.00")
+        self.assertEqual(str(money.Money(5)), "0.05")
+        self.assertEqual(str(money.Money(123456)), "1234.56")
+        self.assertEqual(str(money.Money(-5)), "-0.05")
+        self.assertEqual(str(money.Money(-105)), "-1.05")
+
+
+    def test_arithmetic(self):
+        a, b = money.Money(199), money.Money(1)
+        self.assertEqual(a + b, money.Money(200))
+        self.assertEqual(a * 3, money.Money(597))
+        self.assertEqual(3 * a, money.Money(597))
+        self.assertEqual(sum([a, b, b]), money.Money(201))
+        self.assertEqual(api.ZERO + a, a)
+        self.assertIsInstance((api.ZERO + a).cents, int)
+
+
+    def test_mixedCurrencies(self):
+        usd, eur = money.Money(1, "USD"), money.Money(1, "EUR")
+        self.assertRaises(ValueError, lambda: usd + eur)
+
+
+    def test_mixedDecimals(self):
+        one = decimal.Decimal(1)
+        self.assertRaises(TypeError, lambda: money.Money(1) + one)
+        self.assertRaises(TypeError, lambda: money.Money(1) * one)
+
+
+    def test_equality(self):
+        self.assertEqual(money.Money(150), decimal.Decimal("1.50"))
+        self.assertNotEqual(money.Money(150), money.Money(150, "EUR"))
+        self.assertNotEqual(money.Money(150), money.Money(151))
+        self.assertEqual(hash(money.Money(150)), hash(decimal.Decimal("1.5")))
+
+
+
+class MoneyItemTest(unittest.TestCase):
+    """
+    Tests for items and payment requests with ``Money`` amounts.
+    """
+    def _request(self, paymentRequestClass, itemClass, makeAmount):
+        cheap = itemClass("Cake", makeAmount("1.99"))
+        expensive = itemClass("Diamond", makeAmount("1000.00"))
+        expensive.taxAmount = makeAmount("0.10")
+        request = paymentRequestClass([(cheap, 3), (expensive, 1)])
+        request.shippingAmount = makeAmount("5.00")
+        return request
+
+
+    def _testRoundTrip(self, paymentRequestClass, itemClass):
+        decimalRequest = self._request(paymentRequestClass, itemClass,
+                                       decimal.Decimal)
+        moneyRequest = self._request(paymentRequestClass, itemClass,
+                                     money.Money.fromAmount)
+
+        total = moneyRequest.totalAmount
+        self.assertIsInstance(total, money.Money)
+        self.assertEqual(total.cents, 101107)
+        self.assertEqual(total, decimalRequest.totalAmount)
+
+        encoded = urllib.urlencode(encodePaymentRequests(moneyRequest))
+        expected = urllib.urlencode(encodePaymentRequests(decimalRequest))
+        self.assertEqual(encoded, expected)
+
+
+    def test_regular(self):
+        self._testRoundTrip(api.PaymentRequest, api.Item)
+
+
+    def test_compact(self):
+        self._testRoundTrip(api.CompactPaymentRequest, api.CompactItem)
@@ -1,12 +1,164 @@
 """
 Tests for NVP support.
 """
+import decimal
 import mock
 import StringIO
+import urllib
+import urlparse
 
+from OpenSSL import SSL
+
+from twisted.internet import defer, endpoints, error, task
+from twisted.python import failure, log
 from twisted.trial import unittest
+from twisted.web import client, http, iweb
 
 from txievery.expresscheckout import nvp
+from txievery.test import mocksandbox
+
+
+class PaypalContextFactoryTest(unittest.TestCase):
+    def setUp(self):
+        self.factory = nvp.PaypalContextFactory("keyfile.pem")
+        self.context = mock.Mock()
+        patcher = mock.patch.object(nvp.ssl.ClientContextFactory,
+                                    "getContext", return_value=self.context)
+        self.baseGetContext = patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def test_policy(self):
+        self.assertTrue(iweb.IPolicyForHTTPS.providedBy(self.factory))
+
+
+    def test_contextCached(self):
+        """
+        Tests that the key file is only loaded once.
+        """
+        first, second = self.factory.getContext(), self.factory.getContext()
+        self.assertIdentical(first, self.context)
+        self.assertIdentical(second, self.context)
+        self.assertEqual(self.baseGetContext.call_count, 1)
+        context = self.context
+        context.use_certificate_file.assert_called_once_with("keyfile.pem")
+        context.use_privatekey_file.assert_called_once_with("keyfile.pem")
+        self.context.set_session_cache_mode.assert_called_once_with(
+            SSL.SESS_CACHE_CLIENT)
+
+
+    def _handshakeDone(self, connection):
+        self.factory._infoCallback(connection, SSL.SSL_CB_HANDSHAKE_DONE, 1)
+
+
+    def _connect(self, reused):
+        """
+        Makes a connection to PayPal and completes its handshake.
+        """
+        creator = self.factory.creatorForNetloc("api.paypal.com", 443)
+        with mock.patch.object(nvp.SSL, "Connection") as Connection:
+            connection = creator.clientConnectionForTLS(None)
+
+        Connection.assert_called_once_with(self.context, None)
+        tracker = connection.set_app_data.call_args[0][0]
+        connection.get_app_data.return_value = tracker
+
+        with mock.patch.object(nvp, "_sessionReused", return_value=reused):
+            self._handshakeDone(connection)
+        return connection
+
+
+    def test_fullHandshake(self):
+        connection = self._connect(reused=False)
+        self.assertFalse(connection.set_session.called)
+        self.assertEqual(self.factory.fullHandshakes, 1)
+        self.assertEqual(self.factory.resumedHandshakes, 0)
+
+
+    def test_resumedHandshake(self):
+        first = self._connect(reused=False)
+        second = self._connect(reused=True)
+        session = first.get_session.return_value
+        second.set_session.assert_called_once_with(session)
+        self.assertEqual(self.factory.fullHandshakes, 1)
+        self.assertEqual(self.factory.resumedHandshakes, 1)
+
+
+    def test_sessionRemembered(self):
+        """
+        Tests that the session and master key of the last handshake are
+        remembered, and not the connection itself.
+        """
+        first = self._connect(reused=False)
+        session, key = first.get_session.return_value, "key"
+        first.master_key.return_value = key
+        self._handshakeDone(first)
+        sessions = self.factory._sessions.values()
+        self.assertEqual(sessions, [(session, key)])
+
+        second = self._connect(reused=True)
+        self.assertEqual(second.get_app_data().offeredKey, key)
+
+
+    def test_sessionTicket(self):
+        """
+        Tests that a session received after the handshake (a TLS 1.3
+        session ticket) replaces the remembered one.
+        """
+        connection = self._connect(reused=False)
+        ticketSession = mock.Mock()
+        connection.get_session.return_value = ticketSession
+        self.factory._infoCallback(connection, SSL.SSL_CB_CONNECT_EXIT, 1)
+        [(session, _)] = self.factory._sessions.values()
+        self.assertIdentical(session, ticketSession)
+        self.assertEqual(self.factory.fullHandshakes, 1)
+
+
+    def test_sessionsPerNetloc(self):
+        self._connect(reused=False)
+        creator = self.factory.creatorForNetloc("api.paypal.com", 8443)
+        with mock.patch.object(nvp.SSL, "Connection"):
+            connection = creator.clientConnectionForTLS(None)
+        self.assertFalse(connection.set_session.called)
+
+
+    def test_handshakeCountedOnce(self):
+        """
+        Tests that renegotiations don't count as handshakes.
+        """
+        connection = self._connect(reused=False)
+        self._handshakeDone(connection)
+        self.assertEqual(self.factory.fullHandshakes, 1)
+
+
+    def test_otherConnections(self):
+        """
+        Tests that connections not made by this factory are ignored.
+        """
+        connection = mock.Mock()
+        connection.get_app_data.return_value = None
+        self._handshakeDone(connection)
+        self.assertEqual(self.factory.fullHandshakes, 0)
+
+
+
+class SessionReusedTest(unittest.TestCase):
+    def setUp(self):
+        self.connection = mock.Mock(spec=SSL.Connection)
+        self.connection.master_key.return_value = "key"
+
+
+    def test_reused(self):
+        self.assertTrue(nvp._sessionReused(self.connection, "key"))
+
+
+    def test_newSession(self):
+        self.assertFalse(nvp._sessionReused(self.connection, "other"))
+
+
+    def test_noSessionOffered(self):
+        self.assertFalse(nvp._sessionReused(self.connection, None))
+
 
 
 class NVPAgentTest(unittest.TestCase):
@@ -21,12 +173,653 @@ class NVPAgentTest(unittest.TestCase):
         agent.makeRequest(pairs)
 
         method, apiURL, headers, producer = agent._agent.request.call_args[0]
-        self.assertEqual(method, "GET")
+        self.assertEqual(method, "POST")
         self.assertEqual(apiURL, expectedURL)
         self.assertEqual(list(headers.getAllRawHeaders()), [])
         self.assertEqual(producer.content, "a=b")
 
 
+    def test_postedToSandbox(self):
+        """
+        Tests that API calls are made with the method the mock sandbox
+        serves, which only renders ``POST`` requests.
+        """
+        credentials = mock.Mock()
+        agent = nvp.NVPAgent(credentials)
+        agent._agent = mock.Mock()
+        agent.makeRequest([("METHOD", "SetExpressCheckout")])
+
+        method = agent._agent.request.call_args[0][0]
+        endpoint = mocksandbox.Endpoint()
+        self.assertTrue(hasattr(endpoint, "render_" + method))
+
+
+    def test_prefix(self):
+        credentials = mock.Mock()
+        prefixPairs = [("VERSION", "74.0"), ("RETURNURL", "http://r/?a=b")]
+        agent = nvp.NVPAgent(credentials, prefixPairs=prefixPairs)
+        agent._agent = mock.Mock()
+        self.assertEqual(agent.prefix, "VERSION=74.0&RETURNURL=http%3A%2F%2Fr"
+                                       "%2F%3Fa%3Db")
+
+        agent.makeRequest([("TOKEN", "1")], "GetExpressCheckoutDetails")
+        producer = agent._agent.request.call_args[0][3]
+        self.assertEqual(producer.content,
+                         "METHOD=GetExpressCheckoutDetails&" + agent.prefix
+                         + "&TOKEN=1")
+
+        agent.makeRequest([], "GetExpressCheckoutDetails")
+        producer = agent._agent.request.call_args[0][3]
+        self.assertEqual(producer.content,
+                         "METHOD=GetExpressCheckoutDetails&" + agent.prefix)
+
+
+    def test_methodPrefixesReused(self):
+        agent = nvp.NVPAgent(mock.Mock(), prefixPairs=[("VERSION", "74.0")])
+        first = agent._getPrefix("SetExpressCheckout")
+        second = agent._getPrefix("SetExpressCheckout")
+        self.assertIdentical(first, second)
+
+
+    def test_readResponse(self):
+        agent = nvp.NVPAgent(mock.Mock())
+        agent._agent = mock.Mock()
+        agent._agent.request.return_value = defer.succeed(FakeResponse())
+
+        d = agent.makeRequest([("a", "b")])
+        self.assertEqual(self.successResultOf(d), {"ACK": "Success"})
+
+
+    def test_lazyMethods(self):
+        agent = nvp.NVPAgent(mock.Mock(), lazyMethods=["Lazy"])
+        agent._agent = mock.Mock()
+        agent._agent.request.side_effect = \
+            lambda *args: defer.succeed(FakeResponse())
+
+        response = self.successResultOf(agent.makeRequest([], "Lazy"))
+        self.assertIsInstance(response, nvp.LazyResponse)
+        self.assertEqual(response["ACK"], "Success")
+        response = self.successResultOf(agent.makeRequest([], "Other"))
+        self.assertEqual(type(response), dict)
+
+
+    def test_pool(self):
+        credentials = mock.Mock()
+        pool = nvp.NVPConnectionPool(task.Clock())
+        agent = nvp.NVPAgent(credentials, pool)
+        self.assertIdentical(agent.pool, pool)
+        self.assertIdentical(agent._agent._pool, pool)
+
+
+
+class NVPAgentTimeoutTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.agent = nvp.NVPAgent(mock.Mock(), timeout=10,
+                                  methodTimeouts={"Slow": 30})
+        self.agent.clock = self.clock
+        self.agent._agent = mock.Mock()
+        self.cancelled = []
+        self.agent._agent.request.side_effect = self._request
+
+
+    def _request(self, *args):
+        return defer.Deferred(self.cancelled.append)
+
+
+    def test_timeout(self):
+        d = self.agent.makeRequest([], "Method")
+        self.clock.advance(9.9)
+        self.assertNoResult(d)
+        self.clock.advance(0.1)
+        reason = self.failureResultOf(d, nvp.NVPTimeoutError)
+        self.assertEqual(str(reason.value),
+                         "Method call timed out after 10.000s")
+        self.assertEqual(len(self.cancelled), 1)
+
+
+    def test_methodTimeout(self):
+        d = self.agent.makeRequest([], "Slow")
+        self.clock.advance(10)
+        self.assertNoResult(d)
+        self.clock.advance(20)
+        self.failureResultOf(d, nvp.NVPTimeoutError)
+
+
+    def test_deadline(self):
+        """
+        Tests that calls time out at their deadline, if that comes first.
+        """
+        d = self.agent.makeRequest([], "Method", deadline=5)
+        self.clock.advance(5)
+        self.failureResultOf(d, nvp.NVPTimeoutError)
+
+
+    def test_deadlinePassed(self):
+        self.clock.advance(5)
+        d = self.agent.makeRequest([], "Method", deadline=5)
+        self.failureResultOf(d, nvp.NVPTimeoutError)
+        self.assertFalse(self.agent._agent.request.called)
+
+
+    def test_noTimeout(self):
+        self.agent.timeout = None
+        d = self.agent.makeRequest([], "Method")
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+
+
+    def test_doneInTime(self):
+        self.agent._agent.request.side_effect = None
+        self.agent._agent.request.return_value = defer.succeed(FakeResponse())
+        d = self.agent.makeRequest([], "Method")
+        self.assertEqual(self.successResultOf(d), {"ACK": "Success"})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+
+class TimedNVPAgentTest(unittest.TestCase):
+    def setUp(self):
+        self.timings = []
+        self.agent = nvp.NVPAgent(mock.Mock(), observer=self.timings.append)
+        self.agent.clock = self.clock = task.Clock()
+        self.agent._agent = mock.Mock()
+        self.requestDeferred = defer.Deferred()
+        self.agent._agent.request.side_effect = self._request
+
+
+    def _request(self, method, url, headers, producer):
+        producer.startProducing(StringIO.StringIO())
+        return self.requestDeferred
+
+
+    def test_timing(self):
+        d = self.agent.makeRequest([("a", "b")], "SetExpressCheckout")
+        self.assertEqual(self.timings, [])
+
+        self.clock.advance(2)
+        self.requestDeferred.callback(FakeResponse("ACK=Success&TOKEN=1"))
+        self.assertEqual(self.successResultOf(d),
+                         {"ACK": "Success", "TOKEN": "1"})
+
+        timing, = self.timings
+        self.assertEqual(timing.method, "SetExpressCheckout")
+        self.assertTrue(timing.succeeded)
+        self.assertTrue(timing.reused)
+        self.assertEqual(timing.bytesOut, len("METHOD=SetExpressCheckout&a=b"))
+        self.assertEqual(timing.bytesIn, len("ACK=Success&TOKEN=1"))
+        self.assertEqual(timing.finished - timing.started, 2)
+        self.assertEqual(timing.phases,
+                         {"wait": 2, "transfer": 0, "parse": 0})
+
+
+    def test_lazyTiming(self):
+        self.agent.lazyMethods = frozenset(["GetExpressCheckoutDetails"])
+        d = self.agent.makeRequest([], "GetExpressCheckoutDetails")
+        self.requestDeferred.callback(FakeResponse("ACK=Success&TOKEN=1"))
+        response = self.successResultOf(d)
+        self.assertIsInstance(response, nvp.LazyResponse)
+        self.assertEqual(response["TOKEN"], "1")
+        timing, = self.timings
+        self.assertEqual(timing.bytesIn, len("ACK=Success&TOKEN=1"))
+
+
+    def test_failedTiming(self):
+        d = self.agent.makeRequest([])
+        self.requestDeferred.errback(error.ConnectionRefusedError())
+        self.failureResultOf(d, error.ConnectionRefusedError)
+
+        timing, = self.timings
+        self.assertFalse(timing.succeeded)
+        self.assertEqual(timing.phases, {})
+
+
+    def test_pendingTiming(self):
+        """
+        Tests that the timing is available to endpoints only while the
+        request is being made.
+        """
+        pending = []
+        self.agent._agent.request.side_effect = lambda *a: (
+            pending.append(self.agent._pendingTiming) or defer.Deferred())
+        self.agent.makeRequest([], "SetExpressCheckout")
+        self.assertEqual(pending[0].method, "SetExpressCheckout")
+        self.assertIdentical(self.agent._pendingTiming, None)
+
+
+    def test_noObserver(self):
+        self.agent.observer = None
+        self.agent._agent.request.side_effect = lambda *a: (
+            self.assertIdentical(self.agent._pendingTiming, None)
+            or defer.succeed(FakeResponse()))
+        d = self.agent.makeRequest([])
+        self.assertEqual(self.successResultOf(d), {"ACK": "Success"})
+        self.assertEqual(self.timings, [])
+
+
+    def test_brokenObserver(self):
+        """
+        Tests that failing observers are logged, but don't break API calls.
+        """
+        self.agent.observer = lambda timing: 1 / 0
+        d = self.agent.makeRequest([])
+        self.requestDeferred.callback(FakeResponse())
+        self.assertEqual(self.successResultOf(d), {"ACK": "Success"})
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+
+
+    def test_logTiming(self):
+        events = []
+        log.addObserver(events.append)
+        self.addCleanup(log.removeObserver, events.append)
+
+        self.agent.observer = nvp.logTiming
+        self.agent.makeRequest([], "GetExpressCheckoutDetails")
+        self.clock.advance(0.25)
+        self.requestDeferred.callback(FakeResponse())
+
+        message = log.textFromEventDict(events[-1])
+        self.assertEqual(message, "NVP API call GetExpressCheckoutDetails "
+                                  "succeeded in 250.0ms (wait 250.0ms, "
+                                  "transfer 0.0ms, parse 0.0ms), "
+                                  "32 bytes out, 11 bytes in, "
+                                  "reused connection")
+
+
+
+class RequestTimingTest(unittest.TestCase):
+    def test_newConnection(self):
+        timing = nvp.RequestTiming("SetExpressCheckout", 10.0)
+        timing.connected = 11.0
+        timing.handshakeDone = 11.5
+        timing.responseStarted = 13.0
+        timing.responseDone = 14.0
+        timing.parseTime = 0.25
+        self.assertEqual(timing.phases, {"connect": 1.0,
+                                         "handshake": 0.5,
+                                         "wait": 1.5,
+                                         "transfer": 0.75,
+                                         "parse": 0.25})
+
+
+    def test_plainConnection(self):
+        timing = nvp.RequestTiming("SetExpressCheckout", 10.0)
+        timing.connected = 11.0
+        timing.responseStarted = 13.0
+        self.assertEqual(timing.phases, {"connect": 1.0, "wait": 2.0})
+
+
+
+class NVPEndpointFactoryTest(unittest.TestCase):
+    def setUp(self):
+        self.agent = nvp.NVPAgent(mock.Mock())
+        self.agent.clock = self.clock = task.Clock()
+        self.factory = self.agent._agent._endpointFactory
+
+
+    def _endpointFor(self, url):
+        return self.factory.endpointForURI(client.URI.fromBytes(url))
+
+
+    def test_http(self):
+        endpoint = self._endpointFor("http://example.com/")
+        self.assertIsInstance(endpoint, endpoints.HostnameEndpoint)
+
+
+    def test_https(self):
+        endpoint = self._endpointFor("https://example.com/")
+        self.assertIsInstance(endpoint, endpoints._WrapperEndpoint)
+
+
+    def test_unsupportedScheme(self):
+        self.assertRaises(client.SchemeNotSupported,
+                          self._endpointFor, "ftp://example.com/")
+
+
+    def test_timed(self):
+        timing = self.agent._pendingTiming = nvp.RequestTiming(None, 0)
+        endpoint = self._endpointFor("https://example.com/")
+        self.assertIsInstance(endpoint, nvp._TimedEndpoint)
+        self.assertIdentical(endpoint.timing, timing)
+        self.assertIdentical(endpoint.clock, self.clock)
+
+
+
+class TimedEndpointTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.timing = nvp.RequestTiming(None, 0)
+        self.proto = mock.Mock()
+        self.inner = mock.Mock()
+        self.inner.connect.return_value = defer.succeed(self.proto)
+        self.endpoint = nvp._TimedEndpoint(self.inner, self.timing,
+                                           self.clock)
+
+
+    def _connect(self):
+        self.clock.advance(1)
+        d = self.endpoint.connect(mock.sentinel.factory)
+        self.inner.connect.assert_called_once_with(mock.sentinel.factory)
+        self.assertIdentical(self.successResultOf(d), self.proto)
+        self.assertFalse(self.timing.reused)
+        self.assertEqual(self.timing.connected, 1)
+
+
+    def test_plainConnection(self):
+        self._connect()
+        self.assertIdentical(self.timing.handshakeDone, None)
+
+
+    def test_tlsConnection(self):
+        contextFactory = nvp.PaypalContextFactory("keyfile.pem")
+        tracker = nvp._SessionTracker(contextFactory, ("example.com", 443))
+        connection = mock.Mock(spec=SSL.Connection)
+        connection.get_app_data.return_value = tracker
+        self.proto.transport.getHandle.return_value = connection
+        self._connect()
+
+        self.clock.advance(1)
+        with mock.patch.object(nvp, "_sessionReused", return_value=True):
+            tracker.handshakeDone(connection)
+        self.assertEqual(self.timing.handshakeDone, 2)
+        self.assertTrue(self.timing.resumedSession)
+
+
+
+class NVPConnectionPoolTest(unittest.TestCase):
+    key = ("https", "api.paypal.com", 443)
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pool = nvp.NVPConnectionPool(self.clock, maxPersistentPerHost=1,
+                                          cachedConnectionTimeout=10)
+        self.endpoint = mock.Mock()
+        self.endpoint.connect.side_effect = lambda f: defer.succeed(None)
+
+
+    def _connection(self):
+        connection = mock.Mock()
+        connection.state = "QUIESCENT"
+        return connection
+
+
+    def test_configuration(self):
+        self.assertEqual(self.pool.maxPersistentPerHost, 1)
+        self.assertEqual(self.pool.cachedConnectionTimeout, 10)
+        self.assertTrue(self.pool.persistent)
+
+
+    def test_defaults(self):
+        pool = nvp.NVPConnectionPool(self.clock)
+        self.assertEqual(pool.maxPersistentPerHost, 2)
+        self.assertEqual(pool.cachedConnectionTimeout, 240)
+
+
+    def test_miss(self):
+        self.pool.getConnection(self.key, self.endpoint)
+        self.assertEqual(self.pool.statistics,
+                         {"hits": 0, "misses": 1, "evictions": 0})
+        self.assertEqual(self.endpoint.connect.call_count, 1)
+
+
+    def test_hit(self):
+        connection = self._connection()
+        self.pool._putConnection(self.key, connection)
+        d = self.pool.getConnection(self.key, self.endpoint)
+        self.assertEqual(self.pool.statistics,
+                         {"hits": 1, "misses": 0, "evictions": 0})
+        self.assertEqual(self.endpoint.connect.call_count, 0)
+        self.assertIdentical(self.successResultOf(d)._clientProtocol,
+                             connection)
+
+
+    def test_overflowEviction(self):
+        first, second = self._connection(), self._connection()
+        self.pool._putConnection(self.key, first)
+        self.pool._putConnection(self.key, second)
+        self.assertEqual(self.pool.evictions, 1)
+        first.transport.loseConnection.assert_called_once_with()
+        self.assertEqual(self.pool._connections[self.key], [second])
+
+
+    def test_idleEviction(self):
+        connection = self._connection()
+        self.pool._putConnection(self.key, connection)
+        self.clock.advance(10)
+        self.assertEqual(self.pool.evictions, 1)
+        connection.transport.loseConnection.assert_called_once_with()
+        self.assertEqual(self.pool._connections[self.key], [])
+
+
+
+class FakeResponse(object):
+    """
+    A response with a body that gets delivered in one go.
+    """
+    def __init__(self, body="ACK=Success"):
+        self.body = body
+
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(failure.Failure(client.ResponseDone()))
+
+
+
+class NVPResponseParserTest(unittest.TestCase):
+    def setUp(self):
+        self.parser = nvp.NVPResponseParser()
+
+
+    def _finish(self, reason=client.ResponseDone()):
+        self.parser.connectionLost(failure.Failure(reason))
+        return self.parser.finished
+
+
+    def test_single(self):
+        self.parser.dataReceived("TOKEN=EC-1&ACK=Success")
+        d = self._finish()
+        expected = {"TOKEN": "EC-1", "ACK": "Success"}
+        self.assertEqual(self.successResultOf(d), expected)
+
+
+    def test_incremental(self):
+        """
+        Tests that pairs split across several chunks are parsed correctly.
+        """
+        for chunk in ["TOK", "EN=EC", "-1&", "AC", "K=Succ", "ess&L_", "X=1"]:
+            self.parser.dataReceived(chunk)
+        expected = {"TOKEN": "EC-1", "ACK": "Success"}
+        self.assertEqual(self.parser.pairs, expected)
+
+        d = self._finish()
+        expected["L_X"] = "1"
+        self.assertEqual(self.successResultOf(d), expected)
+
+
+    def test_unquoting(self):
+        self.parser.dataReceived("L_NAME0=Cup+of+tea%26cake&TIME%3D=1%2B1")
+        d = self._finish()
+        expected = {"L_NAME0": "Cup of tea&cake", "TIME=": "1+1"}
+        self.assertEqual(self.successResultOf(d), expected)
+
+
+    def test_blankValues(self):
+        self.parser.dataReceived("A=&B=1&&")
+        d = self._finish()
+        self.assertEqual(self.successResultOf(d), {"A": "", "B": "1"})
+
+
+    def test_empty(self):
+        d = self._finish()
+        self.assertEqual(self.successResultOf(d), {})
+
+
+    def test_potentialDataLoss(self):
+        """
+        Tests that responses without a content length are parsed.
+        """
+        self.parser.dataReceived("ACK=Success")
+        d = self._finish(http.PotentialDataLoss())
+        self.assertEqual(self.successResultOf(d), {"ACK": "Success"})
+
+
+    def test_connectionLost(self):
+        self.parser.dataReceived("ACK=Succ")
+        d = self._finish(error.ConnectionLost())
+        self.failureResultOf(d, error.ConnectionLost)
+
+
+    def test_cancel(self):
+        """
+        Tests that cancelling reading a response stops the transport, and
+        that losing the connection afterwards is ignored.
+        """
+        self.parser.transport = mock.Mock()
+        self.parser.finished.cancel()
+        self.parser.transport.stopProducing.assert_called_once_with()
+        self.failureResultOf(self._finish(error.ConnectionAborted()),
+                             defer.CancelledError)
+
+
+
+class LazyNVPResponseParserTest(unittest.TestCase):
+    def test_lazy(self):
+        parser = nvp.NVPResponseParser(lazy=True)
+        for chunk in ["TOK", "EN=EC-1&AC", "K=Success"]:
+            parser.dataReceived(chunk)
+        self.assertEqual(parser.pairs, {})
+        parser.connectionLost(failure.Failure(client.ResponseDone()))
+
+        response = self.successResultOf(parser.finished)
+        self.assertIsInstance(response, nvp.LazyResponse)
+        self.assertEqual(response.body, "TOKEN=EC-1&ACK=Success")
+
+
+
+class TokenizeTest(unittest.TestCase):
+    def test_offsets(self):
+        body = "A=1&BB=&&C&D=x=y&"
+        offsets = nvp.tokenize(body)
+        self.assertEqual(offsets, [(0, 1, 3), (4, 6, 7), (9, 10, 10),
+                                   (11, 12, 16)])
+        self.assertEqual([body[start:end] for start, _, end in offsets],
+                         ["A=1", "BB=", "C", "D=x=y"])
+
+
+    def test_empty(self):
+        self.assertEqual(nvp.tokenize(""), [])
+        self.assertEqual(nvp.tokenize("&&"), [])
+
+
+
+class NVPPairsTest(unittest.TestCase):
+    def test_pairs(self):
+        pairs = nvp.NVPPairs("A=1&L_NAME0=Cup+of+tea%26cake&BLANK=&C")
+        self.assertEqual(len(pairs), 4)
+        self.assertEqual(list(pairs), [("A", "1"),
+                                       ("L_NAME0", "Cup of tea&cake"),
+                                       ("BLANK", ""), ("C", "")])
+        self.assertEqual(pairs[1], ("L_NAME0", "Cup of tea&cake"))
+        self.assertEqual(pairs[-1], ("C", ""))
+
+
+    def test_sameAsParseQsl(self):
+        """
+        Tests that bodies without empty values are decoded just like
+        ``urlparse.parse_qsl`` decodes them.
+        """
+        body = urllib.urlencode([("TIME=", "1+1 %"), ("A", "b&c"),
+                                 ("NAME", "Th\xc3\xa9")])
+        self.assertEqual(list(nvp.NVPPairs(body)), urlparse.parse_qsl(body))
+
+
+    def test_unquotedValuesNotCopied(self):
+        """
+        Tests that values without escapes aren't unquoted.
+        """
+        with mock.patch("urllib.unquote_plus") as unquote:
+            self.assertEqual(nvp.NVPPairs("ACK=Success")[0],
+                             ("ACK", "Success"))
+        self.assertFalse(unquote.called)
+
+
+
+class LazyResponseTest(unittest.TestCase):
+    def setUp(self):
+        self.response = nvp.LazyResponse(
+            "ACK=Success&PAYMENTREQUEST_0_AMT=10.00&AMT=5.00"
+            "&L_NAME0=Cup+of+tea%26cake&TIME%3D=1%2B1&BLANK=&&TOKEN=EC-1")
+
+
+    def test_lookup(self):
+        self.assertEqual(self.response["ACK"], "Success")
+        self.assertEqual(self.response["TOKEN"], "EC-1")
+        self.assertEqual(self.response["BLANK"], "")
+
+
+    def test_similarNames(self):
+        """
+        Tests that names are only found as whole names.
+        """
+        self.assertEqual(self.response["AMT"], "5.00")
+        self.assertEqual(self.response["PAYMENTREQUEST_0_AMT"], "10.00")
+        self.assertRaises(KeyError, lambda: self.response["CK"])
+        self.assertNotIn("_AMT", self.response)
+
+
+    def test_unquoting(self):
+        self.assertEqual(self.response["L_NAME0"], "Cup of tea&cake")
+        self.assertEqual(self.response["TIME="], "1+1")
+
+
+    def test_missing(self):
+        self.assertRaises(KeyError, lambda: self.response["PAYERID"])
+        self.assertIdentical(self.response.get("PAYERID"), None)
+        self.assertNotIn("PAYERID", self.response)
+
+
+    def test_firstPair(self):
+        response = nvp.LazyResponse("TOKEN=EC-1&ACK=Success")
+        self.assertEqual(response["TOKEN"], "EC-1")
+
+
+    def test_escapedNames(self):
+        """
+        Tests that names are found even if they are escaped differently
+        than ``urllib.quote_plus`` would.
+        """
+        response = nvp.LazyResponse("L%5FNAME0=Tea&ACK=Success&%41MT=1.00")
+        self.assertEqual(response["L_NAME0"], "Tea")
+        self.assertEqual(response["AMT"], "1.00")
+        self.assertEqual(response["ACK"], "Success")
+        self.assertRaises(KeyError, lambda: response["PAYERID"])
+
+
+    def test_lastValueWins(self):
+        response = nvp.LazyResponse("A=1&B=2&A=3")
+        self.assertEqual(response["A"], "3")
+        self.assertEqual(dict(response), {"A": "3", "B": "2"})
+
+
+    def test_mapping(self):
+        parser = nvp.NVPResponseParser()
+        parser.dataReceived(self.response.body)
+        parser.connectionLost(failure.Failure(client.ResponseDone()))
+        pairs = self.successResultOf(parser.finished)
+
+        self.assertEqual(self.response, pairs)
+        self.assertEqual(len(self.response), len(pairs))
+        self.assertEqual(sorted(self.response), sorted(pairs))
+
+
+    def test_empty(self):
+        response = nvp.LazyResponse("")
+        self.assertEqual(len(response), 0)
+        self.assertNotIn("A", response)
+
+
 
 class NVPProducerTest(unittest.TestCase):
     def test_producer(self):
@@ -36,12 +829,154 @@ class NVPProducerTest(unittest.TestCase):
         consumer = StringIO.StringIO()
         producer.startProducing(consumer)
         self.assertEqual(consumer.getvalue(), "a=b")
+        self.assertEqual(producer.bytesWritten, 3)
+
+
+    def test_prefix(self):
+        producer = nvp.NVPProducer([("a", "b")], "c=d")
+        self.assertEqual(producer.content, "c=d&a=b")
+        producer = nvp.NVPProducer([], "c=d")
+        self.assertEqual(producer.content, "c=d")
+
+
+    def test_startProducingFires(self):
+        producer = nvp.NVPProducer([("a", "b")])
+        d = producer.startProducing(StringIO.StringIO())
+        self.assertIdentical(self.successResultOf(d), None)
 
 
     def test_pauseOrStopProducing(self):
         """
-        Tests that ``pauseProducing`` and ``stopProducing`` are no-ops.
+        Tests that ``pauseProducing`` and ``stopProducing`` do nothing for
+        an eagerly encoded body, which isn't written a chunk at a time.
         """
         producer = nvp.NVPProducer([])
         producer.pauseProducing()
         producer.stopProducing()
+
+
+
+class StreamingNVPProducerTest(unittest.TestCase):
+    """
+    Tests for producing bodies that are encoded lazily.
+    """
+    def setUp(self):
+        self.scheduled = []
+        cooperator = task.Cooperator(
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=self.scheduled.append)
+        self.cooperate = cooperator.cooperate
+        self.consumer = StringIO.StringIO()
+
+
+    def _producer(self, pairs, prefix=""):
+        return nvp.NVPProducer(pairs, prefix, cooperate=self.cooperate)
+
+
+    def _runScheduled(self):
+        while self.scheduled:
+            self.scheduled.pop(0)()
+
+
+    def _pairs(self, count):
+        return [("L_NAME{0}".format(i), "Item {0}".format(i))
+                for i in xrange(count)]
+
+
+    def _streamedPairs(self):
+        """
+        Makes just enough pairs for them to be encoded lazily.
+        """
+        return self._pairs(nvp.NVPProducer.MAX_EAGER_PAIRS + 1)
+
+
+    def test_eagerSequences(self):
+        pairs = self._pairs(nvp.NVPProducer.MAX_EAGER_PAIRS)
+        producer = self._producer(pairs, "a=b")
+        self.assertEqual(producer.content, "a=b&" + urllib.urlencode(pairs))
+        self.assertEqual(producer.length, len(producer.content))
+
+
+    def test_largeSequence(self):
+        pairs = self._pairs(nvp.NVPProducer.MAX_EAGER_PAIRS + 1)
+        producer = self._producer(pairs, "METHOD=X")
+        self.assertIdentical(producer.length, iweb.UNKNOWN_LENGTH)
+
+        d = producer.startProducing(self.consumer)
+        self._runScheduled()
+        self.assertIdentical(self.successResultOf(d), None)
+        self.assertEqual(self.consumer.getvalue(),
+                         "METHOD=X&" + urllib.urlencode(pairs))
+        self.assertEqual(producer.bytesWritten, len(self.consumer.getvalue()))
+
+
+    def test_smallIterator(self):
+        """
+        Tests that a few pairs from an iterable without a length are still
+        encoded up front.
+        """
+        pairs = self._pairs(nvp.NVPProducer.MAX_EAGER_PAIRS)
+        producer = self._producer(iter(pairs))
+        self.assertEqual(producer.content, urllib.urlencode(pairs))
+        self.assertEqual(producer.length, len(producer.content))
+
+
+    def test_iterator(self):
+        pairs = self._pairs(nvp.NVPProducer.MAX_EAGER_PAIRS + 1)
+        producer = self._producer(iter(pairs))
+        self.assertIdentical(producer.length, iweb.UNKNOWN_LENGTH)
+
+        d = producer.startProducing(self.consumer)
+        self._runScheduled()
+        self.successResultOf(d)
+        self.assertEqual(self.consumer.getvalue(), urllib.urlencode(pairs))
+
+
+    def test_quoting(self):
+        pairs = [("A B", "c&d=e"), ("AMT", decimal.Decimal("1.50"))]
+        producer = self._producer(iter(pairs))
+        producer.startProducing(self.consumer)
+        self._runScheduled()
+        self.assertEqual(self.consumer.getvalue(), urllib.urlencode(pairs))
+
+
+    def test_chunks(self):
+        """
+        Tests that the body is written a chunk at a time.
+        """
+        chunkPairs = nvp.NVPProducer.CHUNK_PAIRS
+        producer = self._producer(iter(self._streamedPairs()))
+        producer.startProducing(self.consumer)
+        self.scheduled.pop(0)()
+        first = self.consumer.getvalue()
+        self.assertEqual(first, urllib.urlencode(self._pairs(chunkPairs)))
+
+
+    def test_pauseAndResume(self):
+        chunkPairs = nvp.NVPProducer.CHUNK_PAIRS
+        pairs = self._streamedPairs()
+        producer = self._producer(iter(pairs))
+        d = producer.startProducing(self.consumer)
+        self.scheduled.pop(0)()
+
+        producer.pauseProducing()
+        self._runScheduled()
+        written = self.consumer.getvalue()
+        self.assertEqual(written, urllib.urlencode(pairs[:chunkPairs]))
+        self.assertNoResult(d)
+
+        producer.resumeProducing()
+        self._runScheduled()
+        self.successResultOf(d)
+        self.assertEqual(self.consumer.getvalue(), urllib.urlencode(pairs))
+
+
+    def test_stop(self):
+        producer = self._producer(iter(self._streamedPairs()))
+        d = producer.startProducing(self.consumer)
+        self.scheduled.pop(0)()
+        producer.stopProducing()
+        self._runScheduled()
+        self.assertNoResult(d)
+        written = self.consumer.getvalue()
+        self.assertEqual(written, urllib.urlencode(self._pairs(50)))
@@ -0,0 +1,242 @@
+"""
+Tests for hedging and retrying NVP API calls.
+"""
+import random
+
+from twisted.internet import defer, error, task
+from twisted.trial import unittest
+from twisted.web import client
+
+from txievery.expresscheckout import retry
+from txievery.expresscheckout.test.test_scheduler import FakeAgent
+
+
+DETAILS = "GetExpressCheckoutDetails"
+
+
+
+class LatenciesTest(unittest.TestCase):
+    def test_percentile(self):
+        latencies = retry._Latencies(100)
+        for latency in range(1, 101):
+            latencies.add(latency)
+        self.assertEqual(len(latencies), 100)
+        self.assertEqual(latencies.percentile(50), 50)
+        self.assertEqual(latencies.percentile(95), 95)
+        self.assertEqual(latencies.percentile(100), 100)
+        self.assertEqual(latencies.percentile(0), 1)
+
+
+    def test_window(self):
+        latencies = retry._Latencies(2)
+        for latency in [10, 1, 2]:
+            latencies.add(latency)
+        self.assertEqual(len(latencies), 2)
+        self.assertEqual(latencies.percentile(100), 2)
+
+
+
+class RetryingAgentTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.agent = FakeAgent()
+        self.policy = retry.RetryPolicy(initialHedgeDelay=1.0, minSamples=2,
+                                        backoff=1.0, maxBackoff=3.0)
+        self.retryingAgent = retry.RetryingAgent(self.agent, self.policy,
+                                                 self.clock, lambda: 0.5)
+
+
+    def _deferreds(self):
+        return [d for _, _, d in self.agent.calls]
+
+
+    def _assertCancelled(self, attempt):
+        """
+        Asserts that an attempt was cancelled, and that the cancellation
+        was handled.
+        """
+        self.assertTrue(attempt.called)
+        self.assertIdentical(self.successResultOf(attempt), None)
+
+
+    def test_notIdempotent(self):
+        """
+        Tests that calls to other methods are never hedged or retried.
+        """
+        d = self.retryingAgent.makeRequest([], "SetExpressCheckout")
+        self.clock.advance(10)
+        self.assertEqual(self.agent.methods, ["SetExpressCheckout"])
+
+        self.agent.calls[0][2].errback(error.ConnectionLost())
+        self.clock.advance(10)
+        self.assertEqual(len(self.agent.calls), 1)
+        self.failureResultOf(d, error.ConnectionLost)
+
+
+    def test_fast(self):
+        pairs = iter([("TOKEN", "1")])
+        d = self.retryingAgent.makeRequest(pairs, DETAILS)
+        method, sentPairs, attempt = self.agent.calls[0]
+        self.assertEqual((method, sentPairs), (DETAILS, [("TOKEN", "1")]))
+
+        attempt.callback({"ACK": "Success"})
+        self.assertEqual(self.successResultOf(d), {"ACK": "Success"})
+        self.clock.advance(10)
+        self.assertEqual(len(self.agent.calls), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_hedge(self):
+        d = self.retryingAgent.makeRequest([], DETAILS)
+        self.clock.advance(0.9)
+        self.assertEqual(len(self.agent.calls), 1)
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.agent.calls), 2)
+
+        first, hedge = self._deferreds()
+        hedge.callback({"ACK": "Success"})
+        self.assertEqual(self.successResultOf(d), {"ACK": "Success"})
+        self._assertCancelled(first)
+        self.assertEqual(self.retryingAgent.statistics,
+                         {"hedged": 1, "hedgeWins": 1, "retries": 0})
+
+
+    def test_hedgeLoses(self):
+        d = self.retryingAgent.makeRequest([], DETAILS)
+        self.clock.advance(1)
+        first, hedge = self._deferreds()
+        first.callback({"ACK": "Success"})
+        self.successResultOf(d)
+        self._assertCancelled(hedge)
+        self.assertEqual(self.retryingAgent.hedgeWins, 0)
+
+
+    def test_onlyOneHedge(self):
+        self.retryingAgent.makeRequest([], DETAILS)
+        self.clock.advance(100)
+        self.assertEqual(len(self.agent.calls), 2)
+
+
+    def test_hedgeDelayFromLatencies(self):
+        """
+        Tests that hedges are made after a percentile of recent latencies,
+        once enough of them are known.
+        """
+        for latency in [0.25, 0.5]:
+            self.retryingAgent.makeRequest([], DETAILS)
+            self.clock.advance(latency)
+            self.agent.calls[-1][2].callback({})
+
+        self.assertEqual(self.retryingAgent.hedgeDelay(DETAILS), 0.5)
+        self.retryingAgent.makeRequest([], DETAILS)
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.agent.calls), 4)
+
+
+    def test_hedgedLatencies(self):
+        """
+        Tests that the latencies of hedged calls are measured from the start
+        of their first attempt, so the hedge delay stays at the configured
+        percentile of a steady latency distribution.
+        """
+        latencies = random.Random(0)
+
+        def makeRequest(pairs, method=None, deadline=None):
+            reply = self.clock.callLater(latencies.uniform(0, 10),
+                                         lambda: d.callback({}))
+            d = defer.Deferred(lambda _: reply.cancel())
+            return d
+
+        self.agent.makeRequest = makeRequest
+        self.policy.hedgePercentile = 50
+        self.policy.minSamples, self.policy.window = 100, 1000
+        for _ in xrange(3000):
+            d = self.retryingAgent.makeRequest([], DETAILS)
+            while not d.called:
+                nextCall = min(c.getTime() for c in self.clock.calls)
+                self.clock.advance(nextCall - self.clock.seconds())
+
+        self.assertTrue(self.retryingAgent.hedgeWins > 100)
+        self.assertApproximates(self.retryingAgent.hedgeDelay(DETAILS), 5,
+                                0.5)
+
+
+    def test_retry(self):
+        d = self.retryingAgent.makeRequest([], DETAILS)
+        self.agent.calls[0][2].errback(error.ConnectionRefusedError())
+        self.assertNoResult(d)
+
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.agent.calls), 2)
+        self.agent.calls[1][2].errback(client.ResponseFailed([]))
+
+        self.clock.advance(0.9)
+        self.assertEqual(len(self.agent.calls), 2)
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.agent.calls), 3)
+
+        self.agent.calls[2][2].callback({"ACK": "Success"})
+        self.assertEqual(self.successResultOf(d), {"ACK": "Success"})
+        self.assertEqual(self.retryingAgent.retries, 2)
+
+
+    def test_retriesExhausted(self):
+        d = self.retryingAgent.makeRequest([], DETAILS)
+        for _ in range(self.policy.maxAttempts):
+            self.agent.calls[-1][2].errback(error.ConnectionLost())
+            self.clock.advance(10)
+        self.assertEqual(len(self.agent.calls), self.policy.maxAttempts)
+        self.failureResultOf(d, error.ConnectionLost)
+
+
+    def test_permanentFailure(self):
+        d = self.retryingAgent.makeRequest([], DETAILS)
+        self.agent.calls[0][2].errback(ValueError())
+        self.failureResultOf(d, ValueError)
+        self.clock.advance(10)
+        self.assertEqual(len(self.agent.calls), 1)
+
+
+    def test_hedgeFailureWaitsForOther(self):
+        """
+        Tests that when one of two attempts in flight fails, the other one
+        is waited for.
+        """
+        d = self.retryingAgent.makeRequest([], DETAILS)
+        self.clock.advance(1)
+        first, hedge = self._deferreds()
+        first.errback(ValueError())
+        self.assertNoResult(d)
+
+        hedge.callback({"ACK": "Success"})
+        self.assertEqual(self.successResultOf(d), {"ACK": "Success"})
+
+
+    def test_backoff(self):
+        self.assertEqual(self.retryingAgent.backoff(1), 0.5)
+        self.assertEqual(self.retryingAgent.backoff(2), 1.0)
+        self.assertEqual(self.retryingAgent.backoff(10), 1.5)
+
+
+    def test_cancel(self):
+        d = self.retryingAgent.makeRequest([], DETAILS)
+        self.clock.advance(1)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        for attempt in self._deferreds():
+            self._assertCancelled(attempt)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_deadline(self):
+        """
+        Tests that no hedges or retries are made after the deadline, and
+        that the deadline is passed on to every attempt.
+        """
+        d = self.retryingAgent.makeRequest([], DETAILS, deadline=1)
+        self.clock.advance(1)
+        self.assertEqual(len(self.agent.calls), 1)
+
+        self.agent.calls[0][2].errback(error.ConnectionLost())
+        self.failureResultOf(d, error.ConnectionLost)
+        self.assertEqual(self.agent.deadlines, [1])
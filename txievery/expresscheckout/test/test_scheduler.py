@@ -0,0 +1,260 @@
+"""
+Tests for scheduling NVP API calls.
+"""
+import mock
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from txievery.expresscheckout import limits, nvp, scheduler
+
+
+class FakeAgent(object):
+    """
+    An agent that makes API calls that only complete when told to.
+    """
+    def __init__(self):
+        self.calls = []
+        self.deadlines = []
+
+
+    def makeRequest(self, pairs, method=None, deadline=None):
+        d = defer.Deferred()
+        self.calls.append((method, pairs, d))
+        self.deadlines.append(deadline)
+        return d
+
+
+    @property
+    def methods(self):
+        return [method for method, _, _ in self.calls]
+
+
+
+class RequestSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.agent = FakeAgent()
+        self.scheduler = scheduler.RequestScheduler(self.agent, 2, self.clock)
+
+
+    def test_immediate(self):
+        d = self.scheduler.makeRequest([("a", "b")], "SetExpressCheckout")
+        self.assertEqual(self.agent.calls[0][:2],
+                         ("SetExpressCheckout", [("a", "b")]))
+        self.assertEqual(self.scheduler.inFlight, 1)
+
+        self.agent.calls[0][2].callback({"ACK": "Success"})
+        self.assertEqual(self.successResultOf(d), {"ACK": "Success"})
+        self.assertEqual(self.scheduler.inFlight, 0)
+
+
+    def test_bounded(self):
+        for _ in range(5):
+            self.scheduler.makeRequest([], "SetExpressCheckout")
+        self.assertEqual(len(self.agent.calls), 2)
+        self.assertEqual(self.scheduler.inFlight, 2)
+        self.assertEqual(self.scheduler.queueDepth, 3)
+
+        self.agent.calls[0][2].callback({})
+        self.assertEqual(len(self.agent.calls), 3)
+        self.assertEqual(self.scheduler.queueDepth, 2)
+
+
+    def test_failureFreesSlot(self):
+        ds = [self.scheduler.makeRequest([], "SetExpressCheckout")
+              for _ in range(3)]
+        self.agent.calls[0][2].errback(RuntimeError())
+        self.failureResultOf(ds[0], RuntimeError)
+        self.assertEqual(len(self.agent.calls), 3)
+        self.assertEqual(self.scheduler.inFlight, 2)
+        self.assertNoResult(ds[2])
+
+
+    def test_synchronousFailure(self):
+        agent = mock.Mock()
+        agent.makeRequest.side_effect = RuntimeError()
+        s = scheduler.RequestScheduler(agent, 1, self.clock)
+        d = s.makeRequest([], "SetExpressCheckout")
+        self.failureResultOf(d, RuntimeError)
+        self.assertEqual(s.inFlight, 0)
+
+
+    def test_synchronousCalls(self):
+        """
+        Tests that many synchronously completing calls don't recurse.
+        """
+        agent = mock.Mock()
+        agent.makeRequest.side_effect = lambda *a, **kw: defer.succeed({})
+        s = scheduler.RequestScheduler(agent, 1, self.clock)
+        ds = [s.makeRequest([], "SetExpressCheckout") for _ in range(5000)]
+        self.assertEqual(agent.makeRequest.call_count, 5000)
+        self.assertEqual(self.successResultOf(ds[-1]), {})
+
+
+    def test_priorities(self):
+        for _ in range(2):
+            self.scheduler.makeRequest([], "SetExpressCheckout")
+        for method in ["SetExpressCheckout", "GetExpressCheckoutDetails",
+                       "Unknown", "DoExpressCheckoutPayment",
+                       "GetExpressCheckoutDetails"]:
+            self.scheduler.makeRequest([], method)
+
+        while len(self.agent.calls) < 7:
+            inFlight = [d for _, _, d in self.agent.calls if not d.called]
+            inFlight[0].callback({})
+
+        self.assertEqual(self.agent.methods[2:],
+                         ["DoExpressCheckoutPayment",
+                          "GetExpressCheckoutDetails",
+                          "GetExpressCheckoutDetails",
+                          "SetExpressCheckout",
+                          "Unknown"])
+
+
+    def test_cancelQueued(self):
+        for _ in range(2):
+            self.scheduler.makeRequest([], "SetExpressCheckout")
+        d = self.scheduler.makeRequest([], "SetExpressCheckout")
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.scheduler.queueDepth, 0)
+
+        self.agent.calls[0][2].callback({})
+        self.assertEqual(len(self.agent.calls), 2)
+
+
+    def test_cancelInFlight(self):
+        d = self.scheduler.makeRequest([], "SetExpressCheckout")
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertTrue(self.agent.calls[0][2].called)
+        self.assertEqual(self.scheduler.inFlight, 0)
+
+
+    def test_waitTimes(self):
+        for _ in range(3):
+            self.scheduler.makeRequest([], "SetExpressCheckout")
+        self.clock.advance(4)
+        self.agent.calls[0][2].callback({})
+
+        statistics = self.scheduler.statistics
+        self.assertEqual(statistics["dispatched"], 3)
+        self.assertEqual(statistics["maxWaitTime"], 4)
+        self.assertAlmostEqual(statistics["meanWaitTime"], 4 / 3.0)
+        self.assertEqual(statistics["inFlight"], 2)
+        self.assertEqual(statistics["queueDepth"], 0)
+
+
+    def test_deadlinePassedOn(self):
+        self.scheduler.makeRequest([], "SetExpressCheckout", deadline=10)
+        self.assertEqual(self.agent.deadlines, [10])
+
+
+    def test_expireQueued(self):
+        """
+        Tests that calls still queued at their deadline fail, and are
+        never made.
+        """
+        for _ in range(2):
+            self.scheduler.makeRequest([], "SetExpressCheckout")
+        d = self.scheduler.makeRequest([], "SetExpressCheckout", deadline=5)
+        self.clock.advance(5)
+        self.failureResultOf(d, nvp.NVPTimeoutError)
+        self.assertEqual(self.scheduler.queueDepth, 0)
+
+        self.agent.calls[0][2].callback({})
+        self.assertEqual(len(self.agent.calls), 2)
+
+
+    def test_cancelledDropped(self):
+        """
+        Tests that cancelled and expired calls are dropped from the queue,
+        without waiting for a slot to free up.
+        """
+        for _ in range(2):
+            self.scheduler.makeRequest([], "SetExpressCheckout")
+        ds = [self.scheduler.makeRequest([], "SetExpressCheckout", 5)
+              for _ in range(100)]
+        for d in ds[:50]:
+            d.cancel()
+        self.clock.advance(5)
+        for d in ds:
+            self.failureResultOf(d)
+        self.assertEqual(self.scheduler.queueDepth, 0)
+        self.assertEqual(len(self.scheduler._queue), 0)
+
+        d = self.scheduler.makeRequest([], "GetExpressCheckoutDetails")
+        self.assertEqual(self.scheduler.queueDepth, 1)
+        self.agent.calls[0][2].callback({})
+        self.assertEqual(self.agent.methods[-1], "GetExpressCheckoutDetails")
+        self.assertEqual(self.scheduler.queueDepth, 0)
+
+
+    def test_deadlineStoppedWhenMade(self):
+        for _ in range(2):
+            self.scheduler.makeRequest([], "SetExpressCheckout")
+        self.scheduler.makeRequest([], "SetExpressCheckout", deadline=5)
+        self.agent.calls[0][2].callback({})
+        self.assertEqual(self.agent.deadlines, [None, None, 5])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_emptyStatistics(self):
+        statistics = self.scheduler.statistics
+        self.assertEqual(statistics["meanWaitTime"], 0)
+        self.assertEqual(statistics["dispatched"], 0)
+
+
+
+class AdaptiveRequestSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.agent = FakeAgent()
+        self.limit = limits.AIMDLimit(initial=2, latencyThreshold=1.0,
+                                      decreaseFactor=0.5)
+        self.scheduler = scheduler.RequestScheduler(self.agent, 100,
+                                                    self.clock, self.limit)
+
+
+    def test_initialLimit(self):
+        self.assertEqual(self.scheduler.maxInFlight, 2)
+
+
+    def test_shrink(self):
+        for _ in range(4):
+            self.scheduler.makeRequest([], "SetExpressCheckout")
+        self.clock.advance(2)
+        self.agent.calls[0][2].callback({})
+        self.assertEqual(self.scheduler.maxInFlight, 1)
+        self.assertEqual(len(self.agent.calls), 2)
+
+
+    def test_shrinkOncePerRoundTrip(self):
+        """
+        Tests that slow calls that were in flight together only shrink the
+        limit once.
+        """
+        self.limit.limit = self.scheduler.maxInFlight = 8
+        for _ in range(8):
+            self.scheduler.makeRequest([], "SetExpressCheckout")
+        self.clock.advance(2)
+        for _, _, d in self.agent.calls:
+            d.callback({})
+        self.assertEqual(self.scheduler.maxInFlight, 4)
+
+
+    def test_grow(self):
+        for _ in range(4):
+            self.scheduler.makeRequest([], "SetExpressCheckout")
+        self.agent.calls[0][2].callback({})
+        self.assertEqual(self.scheduler.maxInFlight, 3)
+        self.assertEqual(len(self.agent.calls), 4)
+
+
+    def test_cancelledNotCounted(self):
+        d = self.scheduler.makeRequest([], "SetExpressCheckout")
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.scheduler.maxInFlight, 2)
+        self.assertEqual(self.limit.limit, 2)
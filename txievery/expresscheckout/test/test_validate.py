@@ -0,0 +1,174 @@
+"""
+Tests for checking payment requests before they are sent.
+"""
+import decimal
+
+from twisted.trial import unittest
+
+from txievery.expresscheckout import api, money, validate
+
+
+def makeRequest(*itemDetails, **kwargs):
+    return api.PaymentRequest(list(itemDetails), **kwargs)
+
+
+
+class FindProblemsTest(unittest.TestCase):
+    def setUp(self):
+        self.cup = api.Item("Cup of tea", "1.50")
+        self.cup.taxAmount = money.quantize("0.10")
+
+
+    def test_valid(self):
+        request = makeRequest((self.cup, 2))
+        request.shippingAmount = money.quantize("5.00")
+        self.assertEqual(validate.findProblems([request, request]), [])
+        self.assertEqual(validate.findProblems([]), [])
+
+
+    def test_tooManyRequests(self):
+        requests = [makeRequest((self.cup, 1))] * 3
+        self.assertEqual(validate.findProblems(requests, 2),
+                         ["3 payment requests, at most 2 are supported"])
+
+
+    def test_mixedCurrencies(self):
+        requests = [makeRequest((self.cup, 1)),
+                    makeRequest((self.cup, 1), currency="EUR")]
+        self.assertEqual(validate.findProblems(requests), [
+            "payment requests are in different currencies: EUR, USD"])
+
+
+    def test_moneyInOtherCurrency(self):
+        item = api.Item("Croissant", "0")
+        item.amount = money.Money(150, "EUR")
+        problems = validate.findProblems([makeRequest((item, 1))])
+        self.assertEqual(problems[0],
+                         "item 0 of payment request 0 amount is in EUR, "
+                         "not USD")
+
+
+    def test_invalidCategory(self):
+        self.cup._category = "Liquid"
+        self.assertEqual(validate.findProblems([makeRequest((self.cup, 1))]),
+                         ["item 0 of payment request 0 has invalid category "
+                          "'Liquid'"])
+
+
+    def test_invalidAction(self):
+        request = makeRequest((self.cup, 1), action="Steal")
+        self.assertEqual(validate.findProblems([request]),
+                         ["payment request 0 has invalid action 'Steal'"])
+
+
+    def test_missingAttributes(self):
+        self.cup.name = None
+        self.assertEqual(validate.findProblems([makeRequest((self.cup, 1))]),
+                         ["item 0 of payment request 0 has no name"])
+
+
+    def test_invalidQuantity(self):
+        """
+        Tests that invalid quantities are reported, and that the totals of
+        their payment requests aren't checked.
+        """
+        requests = [makeRequest((self.cup, 0)), makeRequest((self.cup, 1.5))]
+        self.assertEqual(validate.findProblems(requests), [
+            "item 0 of payment request 0 has invalid quantity 0",
+            "item 0 of payment request 1 has invalid quantity 1.5"])
+
+
+    def test_wrongTotal(self):
+        class RoundedPaymentRequest(api.PaymentRequest):
+            totalAmount = money.quantize("3.00")
+
+        request = RoundedPaymentRequest([(self.cup, 2)])
+        self.assertEqual(validate.findProblems([request]),
+                         ["payment request 0 total amount is 3.00, but its "
+                          "amounts add up to 3.10"])
+
+
+    def test_roundedTotal(self):
+        """
+        Tests that a total amount that isn't computed only has to match its
+        amounts to the cent.
+        """
+        class RoundedPaymentRequest(api.PaymentRequest):
+            totalAmount = money.quantize("3.10")
+
+        self.cup.taxAmount = decimal.Decimal("0.1")
+        request = RoundedPaymentRequest([(self.cup, 2)])
+        self.assertEqual(validate.findProblems([request]), [])
+
+
+    def test_computedTotal(self):
+        """
+        Tests that the total amounts of registered payment request classes
+        aren't checked against their other amounts.
+        """
+        @validate.computesTotalAmount
+        class ComputedPaymentRequest(api.PaymentRequest):
+            totalAmount = property(lambda self: money.quantize("3.00"))
+
+        request = ComputedPaymentRequest([(self.cup, 2)])
+        self.assertEqual(validate.findProblems([request]), [])
+
+
+    def test_fractionalCents(self):
+        """
+        Tests that amounts with more than two decimal places are reported.
+        """
+        pot = api.Item("Pot of tea", "1.00")
+        pot.taxAmount = decimal.Decimal("0.333")
+        request = makeRequest((pot, 3))
+        self.assertEqual(validate.findProblems([request]),
+                         ["payment request 0 totalAmount has more than two "
+                          "decimal places: 3.333"])
+
+        pot.amount = decimal.Decimal("1.005")
+        self.assertEqual(validate.findProblems([request]), [
+            "item 0 of payment request 0 amount has more than two decimal "
+            "places: 1.005",
+            "payment request 0 totalAmount has more than two decimal "
+            "places: 3.348"])
+
+
+    def test_notAnAmount(self):
+        self.cup.amount = "lots"
+        problems = validate.findProblems([makeRequest((self.cup, 1))])
+        self.assertEqual(problems[0], "item 0 of payment request 0 amount is "
+                                      "not an amount: 'lots'")
+
+
+    def test_amountsNotAdded(self):
+        croissant = api.Item("Croissant", "0")
+        croissant.amount = money.Money(150)
+        request = makeRequest((self.cup, 1), (croissant, 1))
+        [problem] = validate.findProblems([request])
+        self.assertTrue(problem.startswith("payment request 0 amounts can't "
+                                           "be added"), problem)
+
+
+    def test_allProblems(self):
+        """
+        Tests that every problem is found, not just the first one.
+        """
+        self.cup._category = "Liquid"
+        requests = [makeRequest((self.cup, 1), currency="EUR")] * 2
+        requests.append(makeRequest((self.cup, -1)))
+        self.assertEqual(len(validate.findProblems(requests, 2)), 6)
+
+
+
+class CheckPaymentRequestsTest(unittest.TestCase):
+    def test_valid(self):
+        validate.checkPaymentRequests([makeRequest()])
+
+
+    def test_invalid(self):
+        request = makeRequest((api.Item("Cup of tea", "1.50"), 0))
+        e = self.assertRaises(validate.InvalidCartError,
+                              validate.checkPaymentRequests, [request] * 2, 1)
+        self.assertEqual(len(e.problems), 3)
+        self.assertEqual(str(e), "; ".join(e.problems))
+        self.assertIsInstance(e, ValueError)
@@ -0,0 +1,248 @@
+"""
+Checking payment requests before they are sent to PayPal.
+
+PayPal rejects a malformed cart only after a complete API call. The checks
+here find the same problems locally, without any I/O, so they can be made
+before every ``SetExpressCheckout`` call.
+"""
+import decimal
+
+from txievery.expresscheckout import encode, interface, money
+
+
+AMOUNT_ATTRIBUTES = ["handlingAmount", "shippingAmount", "taxAmount"]
+
+
+
+_computedTotals = set()
+
+
+def computesTotalAmount(cls):
+    """
+    Registers a payment request class whose ``totalAmount`` is always the
+    sum of its other amounts, so that it doesn't have to be checked.
+
+    Subclasses that override ``totalAmount`` aren't affected.
+
+    :return: The class, so this can be used as a class decorator.
+    """
+    _computedTotals.add(cls.totalAmount)
+    return cls
+
+
+
+class InvalidCartError(ValueError):
+    """
+    Raised when payment requests can't be checked out.
+
+    All problems with the payment requests are found at once; they are
+    available as ``problems``, a list of descriptions.
+    """
+    def __init__(self, problems):
+        ValueError.__init__(self, "; ".join(problems))
+        self.problems = problems
+
+
+
+def checkPaymentRequests(paymentRequests,
+                         maxPaymentRequests=encode.MAX_PAYMENT_REQUESTS):
+    """
+    Checks that payment requests can be checked out.
+
+    :raises InvalidCartError: If there are any problems.
+    """
+    problems = findProblems(paymentRequests, maxPaymentRequests)
+    if problems:
+        raise InvalidCartError(problems)
+
+
+
+def findProblems(paymentRequests,
+                 maxPaymentRequests=encode.MAX_PAYMENT_REQUESTS):
+    """
+    Finds every problem with some payment requests.
+
+    This checks that:
+
+    - there are at most ``maxPaymentRequests`` payment requests,
+    - all payment requests are in the same currency, and so are all of
+      their ``Money`` amounts,
+    - every attribute ``encode`` sends is set, and the actions and item
+      categories are valid,
+    - item quantities are positive integers,
+    - every item amount and total amount has at most two decimal places,
+    - total amounts that aren't computed by the payment request classes
+      registered with ``computesTotalAmount`` are, to the cent, the sum of
+      the item amounts and the handling, shipping and tax amounts.
+
+    :return: Descriptions of the problems; empty if there are none.
+    :rtype: ``list`` of ``str``
+    """
+    problems = []
+    if len(paymentRequests) > maxPaymentRequests:
+        problems.append("{0} payment requests, at most {1} are supported"
+                        .format(len(paymentRequests), maxPaymentRequests))
+
+    currencies = sorted(set(getattr(request, "currency", None)
+                            for request in paymentRequests))
+    if len(currencies) > 1:
+        problems.append("payment requests are in different currencies: {0}"
+                        .format(", ".join(map(str, currencies))))
+
+    for index, request in enumerate(paymentRequests):
+        _checkRequest(problems, index, request)
+    return problems
+
+
+
+def _describe(requestIndex, itemIndex=None, attribute=None):
+    """
+    Describes where a problem is. This is only done once a problem has been
+    found, so that valid payment requests are checked quickly.
+    """
+    where = "payment request {0}".format(requestIndex)
+    if itemIndex is not None:
+        where = "item {0} of {1}".format(itemIndex, where)
+    if attribute is not None:
+        where = "{0} {1}".format(where, attribute)
+    return where
+
+
+
+def _checkAttributes(problems, obj, keysAndAttributes, *where):
+    """
+    Checks that an object has every attribute that is encoded for it.
+    """
+    for key, attribute in keysAndAttributes:
+        if getattr(obj, attribute, None) is None:
+            problems.append("{0} has no {1}"
+                            .format(_describe(*where), attribute))
+
+
+
+def _addAmounts(problems, amounts, obj, currency, *where):
+    """
+    Adds the non-zero handling, shipping and tax amounts of an object to
+    ``amounts``, unless it is ``None``, checking that they are in the right
+    currency.
+    """
+    for attribute in AMOUNT_ATTRIBUTES:
+        amount = getattr(obj, attribute, 0)
+        if amount:
+            _checkCurrency(problems, amount, currency, *(where + (attribute,)))
+            if amounts is not None:
+                amounts.append(amount)
+
+
+
+def _checkCurrency(problems, amount, currency, *where):
+    """
+    Checks that an amount is in the currency of its payment request.
+    """
+    if isinstance(amount, money.Money) and amount.currency != currency:
+        problems.append("{0} is in {1}, not {2}"
+                        .format(_describe(*where), amount.currency, currency))
+
+
+
+def _cents(amount):
+    """
+    Rounds an amount to whole cents, for comparing it with another one.
+    """
+    if isinstance(amount, money.Money):
+        return amount.toDecimal()
+    return money.quantize(amount)
+
+
+
+def _checkCents(problems, amount, *where):
+    """
+    Checks that an amount is encoded with at most two decimal places.
+    """
+    if isinstance(amount, money.Money):
+        return
+    if not isinstance(amount, decimal.Decimal):
+        try:
+            amount = decimal.Decimal(str(amount))
+        except decimal.InvalidOperation:
+            problems.append("{0} is not an amount: {1!r}"
+                            .format(_describe(*where), amount))
+            return
+    if amount.as_tuple().exponent < -2:
+        problems.append("{0} has more than two decimal places: {1}"
+                        .format(_describe(*where), amount))
+
+
+
+_REQUEST_KEYS = [(key, attribute) for key, attribute in encode.REQUEST_KEYS
+                 if attribute != "totalAmount"]
+
+
+def _checkRequest(problems, index, request):
+    """
+    Finds the problems with a single payment request.
+    """
+    _checkAttributes(problems, request, _REQUEST_KEYS, index)
+    action = getattr(request, "action", None)
+    if action is not None and action not in interface.ACTIONS:
+        problems.append("{0} has invalid action {1!r}"
+                        .format(_describe(index), action))
+
+    currency = getattr(request, "currency", None)
+    computed = getattr(type(request), "totalAmount", None) in _computedTotals
+    amounts = None if computed else []
+    _addAmounts(problems, amounts, request, currency, index, None)
+
+    complete = True
+    for itemIndex, (item, quantity) in enumerate(request.itemDetails):
+        complete &= _checkItem(problems, amounts, item, quantity, currency,
+                               index, itemIndex)
+    if not complete:
+        return
+
+    try:
+        total = request.totalAmount
+        expected = None if computed else sum(amounts)
+    except (TypeError, ValueError) as e:
+        problems.append("{0} amounts can't be added: {1}"
+                        .format(_describe(index), e))
+        return
+
+    if total is None:
+        problems.append("{0} has no totalAmount".format(_describe(index)))
+        return
+    _checkCents(problems, total, index, None, "totalAmount")
+    if expected is not None and _cents(total) != _cents(expected):
+        problems.append("{0} total amount is {1}, but its amounts add up to "
+                        "{2}".format(_describe(index), total, expected))
+
+
+
+def _checkItem(problems, amounts, item, quantity, currency, *where):
+    """
+    Finds the problems with a single item in a payment request, and adds
+    the amounts it adds to the total of its payment request to
+    ``amounts``, unless it is ``None``.
+
+    :return: ``True`` if all of those amounts are known.
+    """
+    _checkAttributes(problems, item, encode.ITEM_KEYS, *where)
+    category = getattr(item, "category", None)
+    if category is not None and category not in interface.CATEGORIES:
+        problems.append("{0} has invalid category {1!r}"
+                        .format(_describe(*where), category))
+
+    if not isinstance(quantity, (int, long)) or quantity < 1:
+        problems.append("{0} has invalid quantity {1!r}"
+                        .format(_describe(*where), quantity))
+        return False
+
+    amount = getattr(item, "amount", None)
+    if amount is None:
+        return False
+    _checkCurrency(problems, amount, currency, *(where + ("amount",)))
+    _checkCents(problems, amount, *(where + ("amount",)))
+    if amounts is not None:
+        amounts.append(quantity * amount)
+    _addAmounts(problems, amounts, item, currency, *where)
+    return True
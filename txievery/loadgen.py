@@ -0,0 +1,505 @@
+"""
+Load generator for the Express Checkout flow.
+
+This drives a weighted mix of ``Client.createCheckout``,
+``Client.getCheckoutDetails`` and ``Checkout.complete`` calls against an
+NVP endpoint, either at a fixed arrival rate or with a fixed number of
+calls in flight, and reports throughput, errors and latency histograms::
+
+    python -m txievery.loadgen --sandbox --rate 500 --duration 30
+    python -m txievery.loadgen --url http://127.0.0.1:8080/ --concurrency 64
+
+With ``--sandbox``, a ``mocksandbox.Endpoint`` is served on loopback in
+the same process. Otherwise, credentials are taken from the environment
+(see ``Credentials.fromEnvironment``) if they are set there.
+
+Latencies are reported twice. Service times are measured from when a
+call was actually made. Corrected latencies account for coordinated
+omission: at a fixed rate, they are measured from when a call was meant
+to be made, so a stalled generator or client doesn't hide the calls it
+failed to make on time. With a fixed concurrency, there is no schedule to
+measure against, so long calls are backfilled HdrHistogram-style if
+``--expected-interval`` is given.
+"""
+import argparse
+import collections
+import json
+import math
+import random
+import sys
+
+from twisted.internet import defer, reactor, task
+from twisted.python import failure
+from twisted.web import server
+
+from txievery.expresscheckout import api, nvp
+
+
+OPERATIONS = CREATE, DETAILS, COMPLETE = "create", "details", "complete"
+
+SUCCESS_ACKS = frozenset(["Success", "SuccessWithWarning"])
+
+PERCENTILES = [50, 90, 99, 99.9, 99.99]
+
+
+
+class Histogram(object):
+    """
+    A histogram of integer values, in the style of HdrHistogram.
+
+    Values between 0 and ``highest`` are recorded with at least
+    ``significantDigits`` decimal digits of precision, in a fixed number of
+    buckets that grows logarithmically with ``highest``. Larger values are
+    recorded as ``highest``; negative values as 0.
+    """
+    def __init__(self, highest=3600 * 10 ** 6, significantDigits=2):
+        subBucketCount = 2 ** int(math.ceil(
+            math.log(2 * 10 ** significantDigits, 2)))
+        self._subBucketBits = subBucketCount.bit_length() - 1
+        self._subBucketHalf = subBucketCount // 2
+        self.highest = highest
+        self._counts = [0] * (self._index(highest) + 1)
+
+        self.count = self.total = self.max = 0
+        self.min = None
+
+
+    def _index(self, value):
+        bucket = max(value.bit_length() - self._subBucketBits, 0)
+        return bucket * self._subBucketHalf + (value >> bucket)
+
+
+    def _highestEquivalent(self, index):
+        """
+        Gets the highest value that would be recorded at an index.
+        """
+        bucket = max(index // self._subBucketHalf - 1, 0)
+        subBucket = index - bucket * self._subBucketHalf
+        return ((subBucket + 1) << bucket) - 1
+
+
+    def record(self, value, count=1):
+        value = min(max(int(value), 0), self.highest)
+        self._counts[self._index(value)] += count
+        self.count += count
+        self.total += value * count
+        self.max = max(self.max, value)
+        self.min = value if self.min is None else min(self.min, value)
+
+
+    def recordCorrected(self, value, expectedInterval):
+        """
+        Records a value, and backfills the values that would have been
+        recorded if nothing had stalled while it was being measured.
+
+        Every ``expectedInterval``, a value was expected; for a value of
+        ``n`` intervals, values of ``n - 1``, ``n - 2``... intervals down to
+        one interval are recorded as well.
+        """
+        self.record(value)
+        if expectedInterval <= 0:
+            return
+        missing = value - expectedInterval
+        while missing >= expectedInterval:
+            self.record(missing)
+            missing -= expectedInterval
+
+
+    def percentile(self, p):
+        """
+        Gets the ``p``th percentile, or 0 if nothing was recorded.
+        """
+        if not self.count:
+            return 0
+        rank = max(int(math.ceil(p / 100.0 * self.count)), 1)
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank:
+                return min(self._highestEquivalent(index), self.max)
+
+
+    @property
+    def mean(self):
+        return self.total / float(self.count) if self.count else 0.0
+
+
+    def summary(self, scale=1e-3):
+        """
+        Summarizes this histogram as a dictionary, with all values
+        multiplied by ``scale`` (by default, from microseconds to
+        milliseconds).
+        """
+        summary = {"count": self.count,
+                   "mean": self.mean * scale,
+                   "min": (self.min or 0) * scale,
+                   "max": self.max * scale}
+        for p in PERCENTILES:
+            summary["p{0}".format(p)] = self.percentile(p) * scale
+        return summary
+
+
+
+class OperationStatistics(object):
+    """
+    What happened to the calls of one operation.
+    """
+    def __init__(self):
+        self.successes = 0
+        self.errors = collections.Counter()
+        self.serviceTimes = Histogram()
+        self.latencies = Histogram()
+
+
+    def summary(self, elapsed):
+        return {"successes": self.successes,
+                "errors": dict(self.errors),
+                "throughput": self.successes / elapsed if elapsed else 0.0,
+                "serviceTime": self.serviceTimes.summary(),
+                "latency": self.latencies.summary()}
+
+
+
+class CheckoutFailed(Exception):
+    """
+    An API call was answered, but didn't succeed.
+    """
+
+
+
+def _checkAck(response):
+    """
+    Fails API calls that Paypal didn't acknowledge as successful.
+    """
+    ack = response.get("ACK")
+    if ack not in SUCCESS_ACKS:
+        raise CheckoutFailed(ack)
+    return response
+
+
+
+class LoadGenerator(object):
+    """
+    Drives a mix of checkout operations through a client.
+
+    Details and completion calls need a checkout that was created before
+    (and, for completion, wasn't completed yet). When there is none, a
+    checkout is created instead.
+    """
+    def __init__(self, client, cart, mix, clock=reactor,
+                 random=random.random):
+        """
+        Initializes a load generator.
+
+        :param cart: The payment requests of every created checkout.
+        :param mix: The relative weights of the operations, as a dictionary
+            keyed by ``CREATE``, ``DETAILS`` and ``COMPLETE``.
+        """
+        self.client = client
+        self.cart = cart
+        self.clock = clock
+        self.random = random
+
+        total = float(sum(mix.values()))
+        self._thresholds, cumulative = [], 0
+        for operation in OPERATIONS:
+            cumulative += mix.get(operation, 0)
+            self._thresholds.append((cumulative / total, operation))
+
+        self.statistics = dict((op, OperationStatistics())
+                               for op in OPERATIONS)
+        self.inFlight = 0
+        self._checkouts = []
+
+
+    def chooseOperation(self):
+        roll = self.random()
+        for threshold, operation in self._thresholds:
+            if roll < threshold:
+                break
+        if operation != CREATE and not self._checkouts:
+            return CREATE
+        return operation
+
+
+    def run(self, intendedStart=None, expectedInterval=0):
+        """
+        Runs one operation, and records how it went.
+
+        :param intendedStart: When the operation was meant to start. If not
+            ``None``, its corrected latency is measured from then.
+        :param expectedInterval: The expected interval between operations,
+            in seconds, used to correct latencies if there's no intended
+            start.
+        :return: A deferred that fires when the operation is done.
+        """
+        operation = self.chooseOperation()
+        startedAt = self.clock.seconds()
+        self.inFlight += 1
+        d = defer.maybeDeferred(getattr(self, "_" + operation))
+        d.addBoth(self._recordResult, operation, startedAt, intendedStart,
+                  expectedInterval)
+        return d
+
+
+    def _create(self):
+        d = self.client.createCheckout(*self.cart)
+        d.addCallback(self._checkouts.append)
+        return d
+
+
+    def _details(self):
+        index = int(self.random() * len(self._checkouts))
+        token = self._checkouts[index].token
+        return self.client.getCheckoutDetails(token).addCallback(_checkAck)
+
+
+    def _complete(self):
+        index = int(self.random() * len(self._checkouts))
+        checkout = self._checkouts.pop(index)
+        return checkout.complete().addCallback(_checkAck)
+
+
+    def _recordResult(self, result, operation, startedAt, intendedStart,
+                      expectedInterval):
+        self.inFlight -= 1
+        statistics = self.statistics[operation]
+        if isinstance(result, failure.Failure):
+            statistics.errors[result.type.__name__] += 1
+        else:
+            statistics.successes += 1
+
+        now = self.clock.seconds()
+        serviceTime = int((now - startedAt) * 1e6)
+        statistics.serviceTimes.record(serviceTime)
+        if intendedStart is not None:
+            statistics.latencies.record(int((now - intendedStart) * 1e6))
+        else:
+            statistics.latencies.recordCorrected(
+                serviceTime, int(expectedInterval * 1e6))
+
+
+    def runAtRate(self, rate, duration):
+        """
+        Starts operations at a fixed rate (per second) for some time,
+        whether or not earlier ones are done.
+
+        :return: A deferred that fires when all operations are done.
+        """
+        done = defer.Deferred()
+        startedAt = self.clock.seconds()
+        rate = float(rate)
+        total = int(math.ceil(duration * rate))
+        state = {"started": 0}
+
+        def tick():
+            now = self.clock.seconds()
+            while state["started"] < total:
+                intendedStart = startedAt + state["started"] / rate
+                if intendedStart > now:
+                    self.clock.callLater(intendedStart - now, tick)
+                    return
+                state["started"] += 1
+                self.run(intendedStart=intendedStart).addBoth(finished)
+            finished(None)
+
+        def finished(_):
+            if state["started"] == total and not self.inFlight \
+                    and not done.called:
+                done.callback(None)
+
+        tick()
+        return done
+
+
+    def runWithConcurrency(self, concurrency, duration, expectedInterval=0):
+        """
+        Keeps a fixed number of operations in flight for some time.
+
+        :return: A deferred that fires when all operations are done.
+        """
+        end = self.clock.seconds() + duration
+
+        def worker():
+            done = defer.Deferred()
+            def loop(_=None):
+                if self.clock.seconds() >= end:
+                    done.callback(None)
+                    return
+                d = self.run(expectedInterval=expectedInterval)
+                d.addCallback(lambda _: self.clock.callLater(0, loop))
+            loop()
+            return done
+
+        return defer.gatherResults([worker() for _ in xrange(concurrency)])
+
+
+    def report(self, elapsed):
+        """
+        Reports the statistics of every operation, as a dictionary.
+        """
+        return dict((operation, statistics.summary(elapsed))
+                    for operation, statistics in self.statistics.iteritems())
+
+
+
+def formatReport(report, elapsed):
+    """
+    Formats a report as a human-readable table.
+    """
+    columns = ["p{0}".format(p) for p in PERCENTILES] + ["max"]
+    row = "  {0:<13}" + "".join(" {%d:>9}" % (i + 1)
+                                for i in xrange(len(columns))) + "\n"
+    lines = []
+    for operation in OPERATIONS:
+        summary = report[operation]
+        calls = summary["successes"] + sum(summary["errors"].values())
+        if not calls:
+            continue
+        lines.append("{0}: {1} calls, {2} errors, {3:.1f} ok/s\n".format(
+            operation, calls, calls - summary["successes"],
+            summary["throughput"]))
+        for error, count in sorted(summary["errors"].items()):
+            lines.append("  {0}: {1}\n".format(error, count))
+        lines.append(row.format("(ms)", *columns))
+        for name in ["serviceTime", "latency"]:
+            values = ["{0:.2f}".format(summary[name][c]) for c in columns]
+            lines.append(row.format(name, *values))
+    lines.append("elapsed: {0:.1f}s\n".format(elapsed))
+    return "".join(lines)
+
+
+
+def makeCart(numRequests, numItems):
+    """
+    Makes a cart with the given number of payment requests and items.
+    """
+    items = [(api.Item("Item {0}".format(i), "1.{0:02d}".format(i % 100)),
+              1) for i in xrange(numItems)]
+    return [api.PaymentRequest(items) for _ in xrange(numRequests)]
+
+
+def parseMix(value):
+    """
+    Parses an operation mix, such as ``create=1,details=2,complete=1``.
+    """
+    mix = {}
+    for part in value.split(","):
+        operation, _, weight = part.partition("=")
+        try:
+            weight = float(weight)
+        except ValueError:
+            weight = -1
+        if operation not in OPERATIONS or weight < 0:
+            raise argparse.ArgumentTypeError("Bad mix entry: %r" % part)
+        mix[operation] = weight
+    if not sum(mix.values()):
+        raise argparse.ArgumentTypeError("Empty mix: %r" % value)
+    return mix
+
+
+def parseCart(value):
+    """
+    Parses a cart size, such as ``2x10`` (payment requests x items).
+    """
+    try:
+        numRequests, numItems = [int(n) for n in value.split("x")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected REQUESTSxITEMS: %r"
+                                         % value)
+    return numRequests, numItems
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m txievery.loadgen",
+        description="Drives checkout calls against an NVP endpoint.")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="NVP API endpoint to call")
+    target.add_argument("--sandbox", action="store_true",
+                        help="call an in-process mock sandbox")
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument("--rate", type=float,
+                      help="operations started per second")
+    load.add_argument("--concurrency", type=int, default=10,
+                      help="operations in flight (default: 10)")
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="seconds to generate load for (default: 10)")
+    parser.add_argument("--mix", type=parseMix,
+                        default={CREATE: 1, DETAILS: 1, COMPLETE: 1},
+                        help="operation weights (default: "
+                        "create=1,details=1,complete=1)")
+    parser.add_argument("--cart", type=parseCart, default=(1, 1),
+                        help="payment requests x items (default: 1x1)")
+    parser.add_argument("--pool-size", type=int, dest="poolSize",
+                        help="persistent connections (default: the "
+                        "concurrency, or 10 at a fixed rate)")
+    parser.add_argument("--timeout", type=float,
+                        help="timeout for every API call, in seconds")
+    parser.add_argument("--expected-interval", type=float, default=0.0,
+                        dest="expectedInterval",
+                        help="expected seconds between operations per "
+                        "worker, for latency correction at a fixed "
+                        "concurrency")
+    parser.add_argument("--output", help="file to write a JSON report to")
+    return parser.parse_args(argv)
+
+
+def getCredentials(url):
+    """
+    Gets credentials for an API endpoint, from the environment if they
+    are set there.
+    """
+    try:
+        credentials = api.Credentials.fromEnvironment()
+    except KeyError:
+        credentials = api.Credentials("loadgen", "loadgen", None, url)
+    credentials.apiURL = url
+    return credentials
+
+
+@defer.inlineCallbacks
+def main(reactor, *argv):
+    args = parseArgs(argv)
+
+    port = None
+    url = args.url
+    if args.sandbox:
+        from txievery.test import mocksandbox
+        site = server.Site(mocksandbox.Endpoint())
+        port = reactor.listenTCP(0, site, interface="127.0.0.1")
+        url = "http://127.0.0.1:{0}/".format(port.getHost().port)
+
+    poolSize = args.poolSize
+    if poolSize is None:
+        poolSize = args.concurrency if args.rate is None else 10
+    pool = nvp.NVPConnectionPool(reactor, maxPersistentPerHost=poolSize)
+    client = api.Client(getCredentials(url), "http://return",
+                        "http://cancel", pool, timeout=args.timeout)
+    generator = LoadGenerator(client, makeCart(*args.cart), args.mix,
+                              reactor)
+
+    startedAt = reactor.seconds()
+    try:
+        if args.rate is not None:
+            yield generator.runAtRate(args.rate, args.duration)
+        else:
+            yield generator.runWithConcurrency(args.concurrency,
+                                               args.duration,
+                                               args.expectedInterval)
+    finally:
+        yield pool.closeCachedConnections()
+        if port is not None:
+            yield port.stopListening()
+    elapsed = reactor.seconds() - startedAt
+
+    report = generator.report(elapsed)
+    sys.stdout.write(formatReport(report, elapsed))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"elapsed": elapsed, "operations": report}, f,
+                      indent=2, sort_keys=True, separators=(",", ": "))
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
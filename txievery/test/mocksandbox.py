@@ -1,13 +1,29 @@
 """
 A mock Paypal sandbox.
+
+Besides being used in-process by unit tests, the sandbox can be run as a
+standalone server for load tests, with injected latency and errors::
+
+    python -m txievery.test.mocksandbox --port 8080 --workers 4 \\
+        --latency lognormal:0.05,0.5 --error-rate 0.01 \\
+        --response-size GetExpressCheckoutDetails=4096
+
+Run it with ``--help`` for all options.
 """
-import urllib
-import urlparse
+import argparse
 import itertools
+import math
+import os
+import random
+import socket
+import sys
+import urllib
 
-from twisted.web import resource
+from twisted.internet import defer, error, protocol, reactor, task
+from twisted.web import resource, server
 
-from txievery.expresscheckout import api, encode, decode
+from txievery.expresscheckout import api, encode, decode, nvp
+from txievery.test import sandboxstore
 
 
 class APICallDetails(object):
@@ -32,14 +48,102 @@ class APICallDetails(object):
 
 
 
+LATENCY_DISTRIBUTIONS = {
+    "constant": lambda rng, seconds: seconds,
+    "uniform": lambda rng, low, high: rng.uniform(low, high),
+    "exponential": lambda rng, mean: rng.expovariate(1.0 / mean),
+    "lognormal": lambda rng, median, sigma: rng.lognormvariate(
+        math.log(median), sigma),
+}
+
+
+
+def parseLatency(spec, rng=random):
+    """
+    Parses a latency distribution, such as ``constant:0.05``,
+    ``uniform:0.01,0.1`` (lowest, highest), ``exponential:0.05`` (mean) or
+    ``lognormal:0.05,0.5`` (median, shape). All times are in seconds.
+
+    :return: A function returning random latencies from the distribution.
+    """
+    name, _, params = spec.partition(":")
+    try:
+        distribution = LATENCY_DISTRIBUTIONS[name]
+        args = [float(param) for param in params.split(",") if param]
+        distribution(rng, *args)
+    except KeyError:
+        raise ValueError("Unknown latency distribution: %r" % (name,))
+    except (TypeError, ValueError):
+        raise ValueError("Bad parameters for %s latency: %r" % (name, params))
+    return lambda: distribution(rng, *args)
+
+
+
+class LoadProfile(object):
+    """
+    How an endpoint misbehaves, to make load tests more realistic.
+
+    Every response is delayed by a latency taken from ``latency``, a
+    function returning seconds (see ``parseLatency``). A fraction
+    ``errorRate`` of the calls fail with an NVP ``Failure`` response, and a
+    fraction ``serverErrorRate`` fail with an empty HTTP 500 response; in
+    both cases the sandbox isn't called. Responses to the methods in
+    ``responseSizes`` are padded to at least that many bytes.
+    """
+    def __init__(self, latency=None, errorRate=0.0, serverErrorRate=0.0,
+                 responseSizes=None, random=random.random):
+        self.latency = latency
+        self.errorRate = errorRate
+        self.serverErrorRate = serverErrorRate
+        self.responseSizes = responseSizes or {}
+        self.random = random
+
+
+    def pad(self, method, body):
+        """
+        Pads a response body to the configured size for a method.
+        """
+        missing = self.responseSizes.get(method, 0) - len(body)
+        if missing <= 0:
+            return body
+        padding = "&PADDING="
+        return body + padding + "x" * max(missing - len(padding), 0)
+
+
+
+FAILURE_PAIRS = [("ACK", "Failure"),
+                 ("L_ERRORCODE0", "10001"),
+                 ("L_SHORTMESSAGE0", "Internal Error"),
+                 ("L_LONGMESSAGE0", "Injected by the mock sandbox"),
+                 ("L_SEVERITYCODE0", "Error")]
+
+
+
 class Endpoint(resource.Resource):
-    def __init__(self):
-        self.sandbox = Sandbox()
+    """
+    An NVP API endpoint backed by a sandbox.
+
+    If a load profile is given, responses are delayed and errors injected
+    as it says.
+    """
+    isLeaf = True
+
+    def __init__(self, sandbox=None, profile=None, clock=reactor):
+        resource.Resource.__init__(self)
+        self.sandbox = sandbox if sandbox is not None else Sandbox()
+        self.profile = profile
+        self.clock = clock
 
 
     def render_POST(self, request):
-        requestPairs = urlparse.parse_qsl(request.content.read())
+        requestPairs = list(nvp.NVPPairs(request.content.read()))
         callDetails = APICallDetails(requestPairs)
+        if self.profile is None:
+            return self._dispatch(callDetails)
+        return self._renderProfiled(request, callDetails)
+
+
+    def _dispatch(self, callDetails):
         try:
             method = getattr(self.sandbox, "do_" + callDetails["METHOD"])
         except KeyError:
@@ -50,33 +154,179 @@ class Endpoint(resource.Resource):
         return urllib.urlencode(responsePairs)
 
 
-       
+    def _renderProfiled(self, request, callDetails):
+        profile = self.profile
+        roll = profile.random()
+        if roll < profile.serverErrorRate:
+            request.setResponseCode(500)
+            body = ""
+        elif roll < profile.serverErrorRate + profile.errorRate:
+            body = urllib.urlencode(FAILURE_PAIRS)
+        else:
+            body = self._dispatch(callDetails)
+            body = profile.pad(callDetails["METHOD"], body)
+
+        delay = profile.latency() if profile.latency is not None else 0
+        if delay <= 0:
+            return body
+
+        call = self.clock.callLater(delay, self._respond, request, body)
+        request.notifyFinish().addErrback(lambda _: call.cancel())
+        return server.NOT_DONE_YET
+
+
+    def _respond(self, request, body):
+        request.write(body)
+        request.finish()
+
+
+
 class Sandbox(object):
     VERSION, BUILD = "74.0", "0"
 
-    def __init__(self):
-        self._checkouts = {}
-        self._tokens = (str(i) for i in itertools.count())
+    def __init__(self, tokenPrefix="", store=None):
+        """
+        Initializes a sandbox.
+
+        :param tokenPrefix: A prefix for all checkout tokens, to tell them
+            apart from those of other sandboxes.
+        :param store: Where checkouts are stored. If ``None``, they are
+            stored in a ``sandboxstore.MemoryStore``.
+        :type store: ``sandboxstore.ICheckoutStore``
+        """
+        if store is None:
+            store = sandboxstore.MemoryStore()
+        self.store = store
+        self._tokens = (tokenPrefix + str(i) for i in itertools.count())
 
 
     def _buildResponse(self, **kw):
         kw.update(ACK="Success", VERSION=self.VERSION, BUILD=self.BUILD)
-        return kw.iteritems()
+        return kw.items()
 
 
     def do_SetExpressCheckout(self, details):
         requests = decode._decodePaymentRequests(details)
         token = self._tokens.next()
-        checkout = api.Checkout(None, token, requests)
-        self._checkouts[token] = checkout
+        self.store.add(api.Checkout(None, token, requests))
         return self._buildResponse(TOKEN=token)
 
 
     def do_GetExpressCheckoutDetails(self, details):
-        checkout = self._checkouts[details["TOKEN"]]
-        return encode.encodeCheckout(checkout)
+        checkout = self.store.get(details["TOKEN"])
+        # The buyer is assumed to have approved the checkout already.
+        response = self._buildResponse(TOKEN=checkout.token, PAYERID="PAYER")
+        return encode.encodeCheckout(checkout) + response
+
+
+    def do_DoExpressCheckoutPayment(self, details):
+        checkout = self.store.complete(details["TOKEN"])
+        return self._buildResponse(TOKEN=checkout.token)
+
+
+
+def parseResponseSize(value):
+    """
+    Parses a ``METHOD=BYTES`` response size option.
+    """
+    method, _, size = value.partition("=")
+    try:
+        return method, int(size)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected METHOD=BYTES: %r" % value)
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m txievery.test.mocksandbox",
+        description="Runs a mock Paypal sandbox NVP API endpoint.")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--interface", default="127.0.0.1")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes sharing the port; unless "
+                        "they share an SQLite store, each keeps its own "
+                        "checkouts (default: 1)")
+    parser.add_argument("--store", metavar="PATH",
+                        help="SQLite database to store checkouts in "
+                        "(default: in memory)")
+    parser.add_argument("--ttl", type=float, default=sandboxstore.TOKEN_TTL,
+                        help="seconds before tokens expire (default: 3h)")
+    parser.add_argument("--max-checkouts", type=int, default=100000,
+                        dest="maxCheckouts",
+                        help="checkouts kept by the in-memory store")
+    parser.add_argument("--latency", type=parseLatency,
+                        help="latency distribution, e.g. constant:0.05, "
+                        "uniform:0.01,0.1, exponential:0.05 or "
+                        "lognormal:0.05,0.5 (seconds)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        dest="errorRate",
+                        help="fraction of calls failing with ACK=Failure")
+    parser.add_argument("--server-error-rate", type=float, default=0.0,
+                        dest="serverErrorRate",
+                        help="fraction of calls failing with HTTP 500")
+    parser.add_argument("--response-size", type=parseResponseSize,
+                        action="append", default=[], dest="responseSizes",
+                        metavar="METHOD=BYTES",
+                        help="pad responses to a method (repeatable)")
+    parser.add_argument("--fd", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--worker", type=int, default=0,
+                        help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def makeSite(args):
+    """
+    Makes the site served by a sandbox process.
+    """
+    profile = LoadProfile(args.latency, args.errorRate, args.serverErrorRate,
+                          dict(args.responseSizes))
+    if args.store is None:
+        store = sandboxstore.MemoryStore(args.maxCheckouts, args.ttl)
+    else:
+        store = sandboxstore.SQLiteStore(args.store, args.ttl)
+    tokenPrefix = "{0}-".format(args.worker) if args.workers > 1 else ""
+    site = server.Site(Endpoint(Sandbox(tokenPrefix, store), profile))
+    site.displayTracebacks = False
+    return site
+
+
+def spawnWorkers(reactor, port, argv, workers):
+    """
+    Spawns worker processes that accept connections on the same listening
+    port as this process.
+    """
+    fd = port.fileno()
+    processes = []
+    for worker in xrange(1, workers):
+        args = [sys.executable, "-m", "txievery.test.mocksandbox",
+                "--fd", str(fd), "--worker", str(worker)] + list(argv)
+        processes.append(reactor.spawnProcess(
+            protocol.ProcessProtocol(), sys.executable, args, env=os.environ,
+            childFDs={0: 0, 1: 1, 2: 2, fd: fd}))
+
+    def stopWorkers():
+        for process in processes:
+            try:
+                process.signalProcess("TERM")
+            except error.ProcessExitedAlready:
+                pass
+    reactor.addSystemEventTrigger("before", "shutdown", stopWorkers)
+
+
+def main(reactor, *argv):
+    args = parseArgs(argv)
+    site = makeSite(args)
+    if args.fd is not None:
+        reactor.adoptStreamPort(args.fd, socket.AF_INET, site)
+        return defer.Deferred()
+
+    port = reactor.listenTCP(args.port, site, interface=args.interface)
+    spawnWorkers(reactor, port, argv, args.workers)
+    address = port.getHost()
+    sys.stderr.write("Serving on http://{0}:{1}/ with {2} worker(s)\n"
+                     .format(address.host, address.port, args.workers))
+    return defer.Deferred()
 
 
-    def do_DoExpressCheckoutPayment (self, details):
-        checkout = self._checkouts.pop(details["TOKEN"])
-        self._completedCheckouts[checkout.token] = checkout
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,232 @@
+"""
+Storage of the checkouts made in a mock Paypal sandbox.
+"""
+import sqlite3
+import urllib
+from collections import OrderedDict
+
+from zope.interface import Interface, implements
+
+from twisted.internet import reactor
+
+from txievery.expresscheckout import api, encode, decode, nvp
+
+
+TOKEN_TTL = 3 * 60 * 60
+
+
+
+class ICheckoutStore(Interface):
+    """
+    Storage for the checkouts of a sandbox.
+
+    Like Paypal's tokens, stored checkouts expire some time after they
+    were made, whether or not they were completed.
+    """
+    def add(checkout):
+        """
+        Stores a new, pending checkout under its token.
+        """
+
+
+    def get(token):
+        """
+        Gets a pending checkout.
+
+        :raises KeyError: If there is no such checkout, or if it expired or
+            was completed.
+        """
+
+
+    def complete(token):
+        """
+        Marks a pending checkout as completed.
+
+        :return: The checkout.
+        :raises KeyError: If there is no such pending checkout.
+        """
+
+
+    def isCompleted(token):
+        """
+        Checks if a checkout was completed (and hasn't expired yet).
+        """
+
+
+    def __len__():
+        """
+        Gets the number of stored checkouts, including completed ones.
+        """
+
+
+
+class MemoryStore(object):
+    """
+    Stores checkouts in memory.
+
+    Checkouts expire ``ttl`` seconds after they were added. When there are
+    more than ``maxSize`` checkouts, the least recently used ones are
+    evicted.
+    """
+    implements(ICheckoutStore)
+
+    def __init__(self, maxSize=100000, ttl=TOKEN_TTL, clock=reactor):
+        """
+        Initializes a memory store.
+
+        :param clock: The clock used to expire checkouts.
+        :type clock: ``IReactorTime``
+        """
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def add(self, checkout):
+        self._entries.pop(checkout.token, None)
+        expiresAt = self.clock.seconds() + self.ttl
+        self._entries[checkout.token] = [expiresAt, checkout, False]
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+
+
+    def _getEntry(self, token):
+        """
+        Gets the entry for a token, marking it as recently used.
+
+        :raises KeyError: If there is no such entry, or if it expired.
+        """
+        entry = self._entries.pop(token)
+        if entry[0] <= self.clock.seconds():
+            raise KeyError(token)
+        self._entries[token] = entry
+        return entry
+
+
+    def get(self, token):
+        entry = self._getEntry(token)
+        if entry[2]:
+            raise KeyError(token)
+        return entry[1]
+
+
+    def complete(self, token):
+        checkout = self.get(token)
+        self._entries[token][2] = True
+        return checkout
+
+
+    def isCompleted(self, token):
+        try:
+            return self._getEntry(token)[2]
+        except KeyError:
+            return False
+
+
+
+class SQLiteStore(object):
+    """
+    Stores checkouts in an SQLite database, so that several sandbox
+    processes can share them.
+
+    Checkouts expire ``ttl`` seconds after they were added; expired
+    checkouts are deleted every ``purgeInterval`` additions. Checkouts are
+    stored in their NVP encoding, and decoded on every lookup.
+
+    All calls block, which is fine for a local database file.
+    """
+    implements(ICheckoutStore)
+
+    def __init__(self, path, ttl=TOKEN_TTL, purgeInterval=1000,
+                 clock=reactor):
+        """
+        Initializes an SQLite store, creating its table if necessary.
+
+        :param path: The path of the database file.
+        :param clock: The clock used to expire checkouts. When several
+            processes share a database, this must be the wall clock.
+        :type clock: ``IReactorTime``
+        """
+        self.ttl = ttl
+        self.purgeInterval = purgeInterval
+        self.clock = clock
+        self._additions = 0
+
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute("CREATE TABLE IF NOT EXISTS checkouts ("
+                         "token TEXT PRIMARY KEY, "
+                         "requests TEXT NOT NULL, "
+                         "expiresAt REAL NOT NULL, "
+                         "completed INTEGER NOT NULL DEFAULT 0)")
+
+
+    def close(self):
+        self._db.close()
+
+
+    def __len__(self):
+        query = "SELECT COUNT(*) FROM checkouts WHERE expiresAt > ?"
+        return self._db.execute(query, (self.clock.seconds(),)).fetchone()[0]
+
+
+    def add(self, checkout):
+        requests = urllib.urlencode(encode.encodeCheckout(checkout))
+        expiresAt = self.clock.seconds() + self.ttl
+        self._db.execute("INSERT OR REPLACE INTO checkouts "
+                         "(token, requests, expiresAt) VALUES (?, ?, ?)",
+                         (checkout.token, requests, expiresAt))
+
+        self._additions += 1
+        if self._additions % self.purgeInterval == 0:
+            self.purge()
+
+
+    def purge(self):
+        """
+        Deletes all expired checkouts.
+        """
+        self._db.execute("DELETE FROM checkouts WHERE expiresAt <= ?",
+                         (self.clock.seconds(),))
+
+
+    def _getRow(self, token):
+        query = ("SELECT requests, completed FROM checkouts "
+                 "WHERE token = ? AND expiresAt > ?")
+        row = self._db.execute(query, (token, self.clock.seconds()))
+        row = row.fetchone()
+        if row is None:
+            raise KeyError(token)
+        return row
+
+
+    def get(self, token):
+        requests, completed = self._getRow(token)
+        if completed:
+            raise KeyError(token)
+        pairs = nvp.NVPPairs(str(requests))
+        requests = decode._decodePaymentRequests(dict(pairs))
+        return api.Checkout(None, token, requests)
+
+
+    def complete(self, token):
+        checkout = self.get(token)
+        cursor = self._db.execute("UPDATE checkouts SET completed = 1 "
+                                  "WHERE token = ? AND completed = 0",
+                                  (token,))
+        if cursor.rowcount != 1:
+            raise KeyError(token)
+        return checkout
+
+
+    def isCompleted(self, token):
+        try:
+            return bool(self._getRow(token)[1])
+        except KeyError:
+            return False
@@ -0,0 +1,228 @@
+"""
+Tests for the load generator.
+"""
+import argparse
+import mock
+
+from twisted.internet import defer, error, task
+from twisted.trial import unittest
+
+from txievery import loadgen
+
+
+class HistogramTest(unittest.TestCase):
+    def setUp(self):
+        self.histogram = loadgen.Histogram(highest=10 ** 6)
+
+
+    def test_empty(self):
+        self.assertEqual(self.histogram.percentile(50), 0)
+        self.assertEqual(self.histogram.mean, 0)
+
+
+    def test_exactSmallValues(self):
+        for value in range(1, 101):
+            self.histogram.record(value)
+        self.assertEqual(self.histogram.percentile(50), 50)
+        self.assertEqual(self.histogram.percentile(99), 99)
+        self.assertEqual(self.histogram.percentile(100), 100)
+        self.assertEqual(self.histogram.mean, 50.5)
+        self.assertEqual((self.histogram.min, self.histogram.max), (1, 100))
+
+
+    def test_precision(self):
+        """
+        Tests that large values are recorded with two significant digits.
+        """
+        for value in [1234, 12345, 123456, 456789]:
+            histogram = loadgen.Histogram(highest=10 ** 6)
+            histogram.record(value)
+            histogram.record(10 ** 6)
+            reported = histogram.percentile(50)
+            self.assertTrue(0 <= reported - value < value / 100.0,
+                            (value, reported))
+
+
+    def test_clamped(self):
+        self.histogram.record(10 ** 9)
+        self.histogram.record(-5)
+        self.assertEqual(self.histogram.max, 10 ** 6)
+        self.assertEqual(self.histogram.min, 0)
+
+
+    def test_recordCorrected(self):
+        self.histogram.recordCorrected(100, 25)
+        self.assertEqual(self.histogram.count, 4)
+        self.assertEqual(self.histogram.total, 100 + 75 + 50 + 25)
+
+
+    def test_recordCorrectedShort(self):
+        self.histogram.recordCorrected(20, 25)
+        self.histogram.recordCorrected(20, 0)
+        self.assertEqual(self.histogram.count, 2)
+
+
+    def test_summary(self):
+        self.histogram.record(1000)
+        summary = self.histogram.summary()
+        self.assertEqual(summary["count"], 1)
+        self.assertEqual(summary["p99.99"], 1.0)
+        self.assertEqual(summary["max"], 1.0)
+
+
+
+class LoadGeneratorTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.client = mock.Mock()
+        self.calls = []
+        self.client.createCheckout.side_effect = self._call
+        self.client.getCheckoutDetails.side_effect = self._call
+        self.rolls = []
+        self.generator = loadgen.LoadGenerator(
+            self.client, ["cart"], {"create": 1, "details": 1}, self.clock,
+            lambda: self.rolls.pop(0) if self.rolls else 0.0)
+
+
+    def _call(self, *args):
+        d = defer.Deferred()
+        self.calls.append(d)
+        return d
+
+
+    def test_chooseOperation(self):
+        self.rolls = [0.6, 0.4, 0.6]
+        self.assertEqual(self.generator.chooseOperation(), "create")
+        self.generator._checkouts.append(mock.Mock())
+        self.assertEqual(self.generator.chooseOperation(), "create")
+        self.assertEqual(self.generator.chooseOperation(), "details")
+
+
+    def test_create(self):
+        d = self.generator.run()
+        self.client.createCheckout.assert_called_once_with("cart")
+        self.clock.advance(0.25)
+        checkout = mock.Mock()
+        self.calls[0].callback(checkout)
+        self.successResultOf(d)
+
+        self.assertEqual(self.generator._checkouts, [checkout])
+        statistics = self.generator.statistics["create"]
+        self.assertEqual(statistics.successes, 1)
+        self.assertEqual(statistics.serviceTimes.max, 250000)
+
+
+    def test_errors(self):
+        self.generator._checkouts.append(mock.Mock(token="1"))
+        self.rolls = [0.6, 0.0, 0.6, 0.0]
+        self.generator.run()
+        self.generator.run()
+        self.calls[0].errback(error.ConnectionLost())
+        self.calls[1].callback({"ACK": "Failure"})
+
+        statistics = self.generator.statistics["details"]
+        self.assertEqual(statistics.successes, 0)
+        self.assertEqual(dict(statistics.errors),
+                         {"ConnectionLost": 1, "CheckoutFailed": 1})
+
+
+    def test_complete(self):
+        generator = loadgen.LoadGenerator(self.client, [], {"complete": 1},
+                                          self.clock)
+        checkout = mock.Mock()
+        checkout.complete.return_value = defer.succeed({"ACK": "Success"})
+        generator._checkouts.append(checkout)
+        generator.run()
+        self.assertEqual(generator._checkouts, [])
+        self.assertEqual(generator.statistics["complete"].successes, 1)
+
+
+    def test_runAtRate(self):
+        d = self.generator.runAtRate(10, 1)
+        self.assertEqual(len(self.calls), 1)
+        self.clock.advance(0.45)
+        self.assertEqual(len(self.calls), 5)
+        for call in self.calls:
+            call.callback(mock.Mock())
+        self.clock.pump([0.1] * 6)
+        self.assertEqual(len(self.calls), 10)
+        self.assertNoResult(d)
+
+        self.calls[-1].callback(mock.Mock())
+        self.assertNoResult(d)
+        for call in self.calls[5:-1]:
+            call.callback(mock.Mock())
+        self.successResultOf(d)
+
+
+    def test_coordinatedOmission(self):
+        """
+        Tests that at a fixed rate, latencies are measured from when calls
+        were meant to be made.
+        """
+        self.generator.runAtRate(10, 1)
+        self.clock.advance(0.5)
+        for call in self.calls:
+            call.callback(mock.Mock())
+        statistics = self.generator.statistics["create"]
+        self.assertEqual(statistics.latencies.max, 500000)
+        self.assertEqual(statistics.serviceTimes.max, 500000)
+        self.assertEqual(statistics.serviceTimes.min, 0)
+        self.assertEqual(statistics.latencies.min, 0)
+        self.assertEqual(statistics.latencies.count, 6)
+
+
+    def test_runWithConcurrency(self):
+        d = self.generator.runWithConcurrency(2, 1)
+        self.assertEqual(len(self.calls), 2)
+        self.clock.advance(0.5)
+        self.calls[0].callback(mock.Mock())
+        self.clock.advance(0)
+        self.assertEqual(len(self.calls), 3)
+
+        self.clock.advance(0.5)
+        for call in self.calls:
+            if not call.called:
+                call.callback(mock.Mock())
+        self.clock.advance(0)
+        self.successResultOf(d)
+        self.assertEqual(len(self.calls), 3)
+
+
+    def test_expectedInterval(self):
+        self.generator.run(expectedInterval=0.1)
+        self.clock.advance(0.3)
+        self.calls[0].callback(mock.Mock())
+        latencies = self.generator.statistics["create"].latencies
+        self.assertEqual(latencies.count, 3)
+
+
+    def test_report(self):
+        self.generator.run()
+        self.calls[0].callback(mock.Mock())
+        report = self.generator.report(2.0)
+        self.assertEqual(report["create"]["throughput"], 0.5)
+        formatted = loadgen.formatReport(report, 2.0)
+        self.assertIn("create: 1 calls, 0 errors, 0.5 ok/s", formatted)
+        self.assertNotIn("details", formatted)
+
+
+
+class ParseArgsTest(unittest.TestCase):
+    def test_mix(self):
+        self.assertEqual(loadgen.parseMix("create=1,details=2.5"),
+                         {"create": 1, "details": 2.5})
+        for mix in ["bogus=1", "create=x", "create=-1", "create=0"]:
+            self.assertRaises(argparse.ArgumentTypeError, loadgen.parseMix,
+                              mix)
+
+
+    def test_cart(self):
+        self.assertEqual(loadgen.parseCart("2x10"), (2, 10))
+        self.assertRaises(argparse.ArgumentTypeError, loadgen.parseCart, "2")
+
+
+    def test_defaults(self):
+        args = loadgen.parseArgs(["--sandbox"])
+        self.assertEqual((args.rate, args.concurrency, args.cart),
+                         (None, 10, (1, 1)))
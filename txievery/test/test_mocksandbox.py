@@ -6,9 +6,12 @@ import StringIO
 import urllib
 import urlparse
 
+from twisted.internet import task
 from twisted.trial import unittest
+from twisted.web import server
+from twisted.web.test.requesthelper import DummyRequest
 
-from txievery.test import mocksandbox
+from txievery.test import mocksandbox, sandboxstore
 
 
 class APICallDetailsTest(unittest.TestCase):
@@ -72,6 +75,154 @@ class EndpointTest(unittest.TestCase):
 
 
 
+class ParseLatencyTest(unittest.TestCase):
+    def test_constant(self):
+        self.assertEqual(mocksandbox.parseLatency("constant:0.05")(), 0.05)
+
+
+    def test_distributions(self):
+        for spec in ["uniform:0.01,0.1", "exponential:0.05",
+                     "lognormal:0.05,0.5"]:
+            latency = mocksandbox.parseLatency(spec)()
+            self.assertTrue(latency >= 0, spec)
+
+
+    def test_unknownDistribution(self):
+        self.assertRaises(ValueError, mocksandbox.parseLatency, "bogus:1")
+
+
+    def test_badParameters(self):
+        for spec in ["constant", "uniform:1", "exponential:fast"]:
+            self.assertRaises(ValueError, mocksandbox.parseLatency, spec)
+
+
+
+class LoadProfileTest(unittest.TestCase):
+    def test_pad(self):
+        profile = mocksandbox.LoadProfile(responseSizes={"Big": 20})
+        padded = profile.pad("Big", "ACK=Success")
+        self.assertEqual(len(padded), 20)
+        self.assertEqual(urlparse.parse_qs(padded)["ACK"], ["Success"])
+
+
+    def test_noPadding(self):
+        profile = mocksandbox.LoadProfile(responseSizes={"Big": 5})
+        self.assertEqual(profile.pad("Big", "ACK=Success"), "ACK=Success")
+        self.assertEqual(profile.pad("Small", "ACK=Success"), "ACK=Success")
+
+
+
+class ProfiledEndpointTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.roll = 0.5
+        self.profile = mocksandbox.LoadProfile(random=lambda: self.roll)
+        self.sandbox = mock.Mock()
+        self.sandbox.do_Method.return_value = [("ACK", "Success")]
+        self.endpoint = mocksandbox.Endpoint(self.sandbox, self.profile,
+                                             self.clock)
+
+
+    def _render(self):
+        request = DummyRequest([])
+        request.content = StringIO.StringIO("METHOD=Method")
+        result = self.endpoint.render_POST(request)
+        if result is not server.NOT_DONE_YET:
+            request.write(result)
+            request.finish()
+        return request
+
+
+    def test_noLatency(self):
+        request = self._render()
+        self.assertEqual(request.written, ["ACK=Success"])
+
+
+    def test_latency(self):
+        self.profile.latency = lambda: 0.5
+        request = self._render()
+        self.clock.advance(0.4)
+        self.assertEqual(request.written, [])
+        self.clock.advance(0.1)
+        self.assertEqual(request.written, ["ACK=Success"])
+        self.assertEqual(request.finished, 1)
+
+
+    def test_disconnectedDuringLatency(self):
+        self.profile.latency = lambda: 0.5
+        request = self._render()
+        request.processingFailed(Exception())
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_error(self):
+        self.profile.errorRate = 0.6
+        request = self._render()
+        response = dict(urlparse.parse_qsl("".join(request.written)))
+        self.assertEqual(response["ACK"], "Failure")
+        self.assertEqual(response["L_ERRORCODE0"], "10001")
+        self.assertFalse(self.sandbox.do_Method.called)
+
+
+    def test_serverError(self):
+        self.profile.serverErrorRate = 0.3
+        self.profile.errorRate = 0.3
+        self.roll = 0.2
+        request = self._render()
+        self.assertEqual(request.responseCode, 500)
+        self.assertFalse(self.sandbox.do_Method.called)
+
+
+    def test_padding(self):
+        self.profile.responseSizes = {"Method": 100}
+        request = self._render()
+        self.assertEqual(len("".join(request.written)), 100)
+
+
+
+class ServerTest(unittest.TestCase):
+    def test_defaults(self):
+        args = mocksandbox.parseArgs([])
+        self.assertEqual((args.port, args.workers, args.fd), (8080, 1, None))
+        site = mocksandbox.makeSite(args)
+        checkout = site.resource.sandbox.do_SetExpressCheckout([])
+        self.assertEqual(dict(checkout)["TOKEN"], "0")
+
+
+    def test_profile(self):
+        args = mocksandbox.parseArgs(["--latency", "constant:0.1",
+                                      "--error-rate", "0.1",
+                                      "--response-size", "Method=100",
+                                      "--response-size", "Other=10"])
+        profile = mocksandbox.makeSite(args).resource.profile
+        self.assertEqual(profile.latency(), 0.1)
+        self.assertEqual(profile.errorRate, 0.1)
+        self.assertEqual(profile.responseSizes, {"Method": 100, "Other": 10})
+
+
+    def test_workerTokens(self):
+        """
+        Tests that every worker makes different tokens.
+        """
+        args = mocksandbox.parseArgs(["--workers", "2", "--worker", "1"])
+        site = mocksandbox.makeSite(args)
+        checkout = site.resource.sandbox.do_SetExpressCheckout([])
+        self.assertEqual(dict(checkout)["TOKEN"], "1-0")
+
+
+    def test_stores(self):
+        args = mocksandbox.parseArgs(["--ttl", "60", "--max-checkouts", "5"])
+        store = mocksandbox.makeSite(args).resource.sandbox.store
+        self.assertEqual((store.ttl, store.maxSize), (60, 5))
+
+        path = self.mktemp()
+        args = mocksandbox.parseArgs(["--store", path])
+        store = mocksandbox.makeSite(args).resource.sandbox.store
+        self.assertIsInstance(store, sandboxstore.SQLiteStore)
+        store.close()
+
+
+
 class SandboxTest(unittest.TestCase):
     def setUp(self):
         self.sandbox = mocksandbox.Sandbox()
@@ -79,9 +230,9 @@ class SandboxTest(unittest.TestCase):
 
     def test_setExpressCheckout(self):
         details = []
-        self.assertEqual(len(self.sandbox._checkouts), 0)
+        self.assertEqual(len(self.sandbox.store), 0)
         response = self.sandbox.do_SetExpressCheckout(details)
-        self.assertEqual(len(self.sandbox._checkouts), 1)
+        self.assertEqual(len(self.sandbox.store), 1)
         response = dict(response)
         for mandatoryKey in ("TOKEN", "ACK", "VERSION", "BUILD"):
             self.assertIn(mandatoryKey, response)
@@ -92,5 +243,16 @@ class SandboxTest(unittest.TestCase):
         token = dict(self.sandbox.do_SetExpressCheckout(details))["TOKEN"]
         details = {"TOKEN": token}
         response = dict(self.sandbox.do_GetExpressCheckoutDetails(details))
+        self.assertEqual(response["TOKEN"], token)
+        self.assertIn("PAYERID", response)
+
 
-        
\ No newline at end of file
+    def test_doExpressCheckoutPayment(self):
+        token = dict(self.sandbox.do_SetExpressCheckout([]))["TOKEN"]
+        details = {"TOKEN": token, "PAYERID": "PAYER"}
+        response = self.sandbox.do_DoExpressCheckoutPayment(details)
+        self.assertEqual(dict(response)["TOKEN"], token)
+        self.assertTrue(self.sandbox.store.isCompleted(token))
+        self.assertRaises(KeyError, self.sandbox.store.get, token)
+        self.assertRaises(KeyError,
+                          self.sandbox.do_DoExpressCheckoutPayment, details)
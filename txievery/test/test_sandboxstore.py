@@ -0,0 +1,111 @@
+"""
+Tests for mock sandbox checkout storage.
+"""
+from zope.interface.verify import verifyObject
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from txievery.expresscheckout import api
+from txievery.test import sandboxstore
+
+
+cup = api.Item("Cup of tea", "1.50")
+paymentRequests = [api.PaymentRequest([(cup, 2)])]
+
+
+
+class _StoreTests(object):
+    """
+    Tests that every checkout store should pass.
+    """
+    def _makeStore(self, clock):
+        raise NotImplementedError()
+
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.store = self._makeStore(self.clock)
+        self.checkout = api.Checkout(None, "1", paymentRequests)
+
+
+    def test_interface(self):
+        self.assertTrue(verifyObject(sandboxstore.ICheckoutStore, self.store))
+
+
+    def test_get(self):
+        self.store.add(self.checkout)
+        checkout = self.store.get("1")
+        self.assertEqual(checkout.token, "1")
+        [request] = checkout.paymentRequests
+        self.assertEqual(request.totalAmount, paymentRequests[0].totalAmount)
+        self.assertEqual(len(self.store), 1)
+
+
+    def test_missing(self):
+        self.assertRaises(KeyError, self.store.get, "1")
+        self.assertRaises(KeyError, self.store.complete, "1")
+        self.assertFalse(self.store.isCompleted("1"))
+
+
+    def test_complete(self):
+        self.store.add(self.checkout)
+        self.assertFalse(self.store.isCompleted("1"))
+        self.assertEqual(self.store.complete("1").token, "1")
+        self.assertTrue(self.store.isCompleted("1"))
+        self.assertRaises(KeyError, self.store.get, "1")
+        self.assertRaises(KeyError, self.store.complete, "1")
+
+
+    def test_expiry(self):
+        self.store.add(self.checkout)
+        self.clock.advance(59)
+        self.store.get("1")
+        self.clock.advance(1)
+        self.assertRaises(KeyError, self.store.get, "1")
+        self.assertFalse(self.store.isCompleted("1"))
+
+
+
+class MemoryStoreTest(_StoreTests, unittest.TestCase):
+    def _makeStore(self, clock):
+        return sandboxstore.MemoryStore(maxSize=2, ttl=60, clock=clock)
+
+
+    def test_leastRecentlyUsedEvicted(self):
+        for token in "123":
+            if token == "3":
+                self.store.get("1")
+            self.store.add(api.Checkout(None, token, []))
+        self.assertEqual(len(self.store), 2)
+        self.store.get("1")
+        self.assertRaises(KeyError, self.store.get, "2")
+
+
+
+class SQLiteStoreTest(_StoreTests, unittest.TestCase):
+    def _makeStore(self, clock):
+        self.path = self.mktemp()
+        store = sandboxstore.SQLiteStore(self.path, ttl=60, purgeInterval=2,
+                                         clock=clock)
+        self.addCleanup(store.close)
+        return store
+
+
+    def test_shared(self):
+        """
+        Tests that stores using the same database share checkouts.
+        """
+        other = sandboxstore.SQLiteStore(self.path, clock=self.clock)
+        self.addCleanup(other.close)
+        self.store.add(self.checkout)
+        other.complete("1")
+        self.assertTrue(self.store.isCompleted("1"))
+
+
+    def test_purge(self):
+        self.store.add(self.checkout)
+        self.clock.advance(60)
+        self.store.add(api.Checkout(None, "2", []))
+        count = "SELECT COUNT(*) FROM checkouts"
+        self.assertEqual(self.store._db.execute(count).fetchone()[0], 1)